@@ -0,0 +1,230 @@
+# ============================================
+# Approximate Nearest-Neighbour Index
+# File: ann_index.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-05-24
+#
+# Description:
+# This module defines the IVFIndex class, an inverted-file (IVF) index
+# written in NumPy that lets FaceRecognizer scan only part of a large gallery:
+# - The embeddings are grouped into clusters (k-means on the gallery rows).
+# - A query only visits the 'nprobe' clusters closest to it, which is the
+#   recall/latency knob (more clusters = better recall, slower search).
+# - Rows can be inserted, removed and moved one at a time, so the index
+#   follows the incremental gallery updates without being rebuilt.
+#
+# The index only proposes candidate rows: the recognizer computes the exact
+# distances of the candidates, so the threshold semantics do not change.
+#
+# Settings are read from the environment (or .env):
+# - FACEAUTH_ANN_INDEX: 'ivf' to enable the index, 'none' (default) to always scan everything.
+# - FACEAUTH_ANN_NPROBE: clusters visited per query (default: 8).
+# - FACEAUTH_ANN_MIN_ROWS: galleries smaller than this are scanned exactly (default: 2000).
+# ============================================
+
+import copy  # Copies of the index for new gallery snapshots
+import os  # To read the settings from the environment
+
+import numpy as np  # NumPy for the clustering and distance computations
+
+DEFAULT_NPROBE = 8  # Clusters visited per query
+DEFAULT_MIN_ROWS = 2000  # Below this size a full scan is faster than the index
+KMEANS_ITERATIONS = 10  # Lloyd iterations when training the clusters
+TRAIN_SAMPLE_SIZE = 20000  # Rows used to train the clusters (the rest are only assigned)
+
+
+def ann_options_from_env():
+    """
+    Reads the ANN index settings from the environment.
+    Returns None when the index is disabled, otherwise a dictionary with 'nprobe' and 'min_rows'.
+    """
+    if os.getenv("FACEAUTH_ANN_INDEX", "none").strip().lower() != "ivf":
+        return None
+    return {
+        "nprobe": max(1, int(os.getenv("FACEAUTH_ANN_NPROBE", DEFAULT_NPROBE))),
+        "min_rows": max(1, int(os.getenv("FACEAUTH_ANN_MIN_ROWS", DEFAULT_MIN_ROWS))),
+    }
+
+
+def squared_distances(vectors, centroids):
+    """
+    Squared Euclidean distances between every vector and every centroid (shape: [N, C]),
+    using |x|^2 - 2 x.c + |c|^2 so no [N, C, D] temporary is created.
+    """
+    distances = -2.0 * (vectors @ centroids.T)
+    distances += np.einsum("ij,ij->i", vectors, vectors)[:, None]
+    distances += np.einsum("ij,ij->i", centroids, centroids)[None, :]
+    return distances
+
+
+# === Class responsible for proposing candidate rows for a query ===
+class IVFIndex:
+    def __init__(self, matrix, nprobe=DEFAULT_NPROBE, nlist=None, seed=0):
+        """
+        Trains the clusters on 'matrix' (one embedding per row) and assigns every row.
+        - 'nlist': number of clusters (default: about sqrt(N)).
+        - 'nprobe': clusters visited per query.
+        'matrix' is only sliced (TRAIN_SAMPLE_SIZE rows at a time), so a memory map or the
+        MappedRows of gallery_snapshot.py is read in chunks instead of copied whole.
+        """
+        self.nprobe = nprobe
+        self.nlist = max(1, min(len(matrix), nlist or int(np.sqrt(len(matrix)))))
+        self.trained_rows = len(matrix)  # Gallery size at training time (used to decide when to retrain)
+        self.centroids = self._train(matrix, seed)
+
+        assignment = np.empty(len(matrix), dtype=np.int32)
+        for start in range(0, len(matrix), TRAIN_SAMPLE_SIZE):
+            chunk = np.asarray(matrix[start:start + TRAIN_SAMPLE_SIZE], dtype=np.float32)
+            assignment[start:start + len(chunk)] = self._assign(chunk)
+        self._build_lists(assignment)
+
+    def _train(self, matrix, seed):
+        """
+        Runs a few k-means iterations on (a sample of) the rows and returns the centroids.
+        """
+        rng = np.random.default_rng(seed)
+        if len(matrix) > TRAIN_SAMPLE_SIZE:
+            sample = matrix[np.sort(rng.choice(len(matrix), TRAIN_SAMPLE_SIZE, replace=False))]
+        else:
+            sample = matrix[:len(matrix)]
+        sample = np.asarray(sample, dtype=np.float32)
+
+        centroids = sample[rng.choice(len(sample), self.nlist, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = squared_distances(sample, centroids).argmin(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=self.nlist)
+            filled = counts > 0  # Empty clusters keep their previous centroid
+            centroids[filled] = sums[filled] / counts[filled, None]
+        return centroids
+
+    def _assign(self, vectors):
+        """
+        Returns the closest cluster of each vector.
+        """
+        return squared_distances(np.atleast_2d(vectors), self.centroids).argmin(axis=1)
+
+    def _build_lists(self, assignment):
+        """
+        Builds the cluster lists from the cluster of every row with array operations
+        (no Python object per row, so this stays cheap for every worker of a large gallery):
+        - _lists[c][:_list_sizes[c]]: the gallery rows of cluster c
+        - _row_cluster[row], _row_position[row]: the cluster of a row and its position there (-1: not indexed)
+        'assignment' is used as-is (it may be read-only, mapped from the shared gallery file).
+        """
+        order = np.argsort(assignment, kind="stable").astype(np.int64)
+        counts = np.bincount(assignment, minlength=self.nlist)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        self._lists = np.split(order, starts[1:])  # Cluster -> gallery rows (spare capacity past the size)
+        self._list_sizes = counts.astype(np.int64)
+        self._row_cluster = assignment
+        self._row_position = np.empty(len(assignment), dtype=np.int64)
+        self._row_position[order] = np.arange(len(order)) - starts[assignment[order]]
+        self._count = len(assignment)
+
+    def _reserve_row(self, row):
+        """
+        Makes sure 'row' fits in the (writable) per-row arrays; capacity grows geometrically.
+        """
+        if row < len(self._row_cluster) and self._row_cluster.flags.writeable:
+            return
+        capacity = max(row + 1, 2 * len(self._row_cluster))
+        clusters = np.full(capacity, -1, dtype=np.int32)
+        positions = np.zeros(capacity, dtype=np.int64)
+        clusters[:len(self._row_cluster)] = self._row_cluster
+        positions[:len(self._row_position)] = self._row_position
+        self._row_cluster, self._row_position = clusters, positions
+
+    def _insert(self, row, cluster):
+        self._reserve_row(row)
+        rows, size = self._lists[cluster], int(self._list_sizes[cluster])
+        if size == len(rows):
+            grown = np.empty(max(8, 2 * size), dtype=np.int64)
+            grown[:size] = rows
+            self._lists[cluster] = rows = grown
+        rows[size] = row
+        self._list_sizes[cluster] = size + 1
+        self._row_cluster[row], self._row_position[row] = cluster, size
+        self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    # === Sharing between processes (see shared_gallery.py) ===
+
+    def assignment(self):
+        """
+        Returns the cluster of every row (int32 array), for rows 0..len-1.
+        """
+        return np.asarray(self._row_cluster[:self._count], dtype=np.int32)
+
+    @classmethod
+    def from_assignment(cls, centroids, assignment, trained_rows, nprobe=DEFAULT_NPROBE):
+        """
+        Rebuilds an index from trained 'centroids' and the cluster of every row,
+        without running k-means again (the lists are built with array operations, see _build_lists).
+        """
+        index = cls.__new__(cls)
+        index.nprobe = nprobe
+        index.nlist = len(centroids)
+        index.trained_rows = trained_rows
+        index.centroids = centroids
+        index._build_lists(assignment)
+        return index
+
+    # === Incremental updates ===
+
+    def add(self, row, vector):
+        """
+        Indexes gallery row 'row' holding 'vector' (assigned to its closest cluster).
+        """
+        self._insert(row, int(self._assign(np.asarray(vector, dtype=np.float32))[0]))
+
+    def remove(self, row):
+        """
+        Removes gallery row 'row' (swap-remove inside its cluster list).
+        """
+        cluster, position = int(self._row_cluster[row]), int(self._row_position[row])
+        rows, last = self._lists[cluster], int(self._list_sizes[cluster]) - 1
+        moved = rows[last]
+        rows[position] = moved
+        self._row_position[moved] = position
+        self._list_sizes[cluster] = last
+        self._row_cluster[row] = -1
+        self._count -= 1
+
+    def move(self, old_row, new_row):
+        """
+        Records that the embedding stored in 'old_row' now lives in 'new_row'.
+        """
+        cluster, position = int(self._row_cluster[old_row]), int(self._row_position[old_row])
+        self._reserve_row(new_row)
+        self._lists[cluster][position] = new_row
+        self._row_cluster[new_row], self._row_position[new_row] = cluster, position
+        self._row_cluster[old_row] = -1
+
+    def copy(self):
+        """
+        Returns a copy that can be updated without changing this index (the centroids are shared).
+        """
+        index = copy.copy(self)
+        index._lists = [rows.copy() for rows in self._lists]
+        index._list_sizes = self._list_sizes.copy()
+        index._row_cluster = self._row_cluster.copy()
+        index._row_position = self._row_position.copy()
+        return index
+
+    # === Search ===
+
+    def candidates(self, probe, nprobe=None):
+        """
+        Returns the gallery rows stored in the 'nprobe' clusters closest to 'probe' (int64 array).
+        """
+        nprobe = max(1, min(nprobe or self.nprobe, self.nlist))
+        distances = squared_distances(np.asarray(probe, dtype=np.float32).reshape(1, -1), self.centroids)[0]
+        if nprobe < self.nlist:
+            closest = np.argpartition(distances, nprobe - 1)[:nprobe]
+        else:
+            closest = np.arange(self.nlist)
+        return np.concatenate([self._lists[cluster][:self._list_sizes[cluster]] for cluster in closest])
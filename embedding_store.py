@@ -0,0 +1,689 @@
+# ============================================
+# Packed Embedding Store
+# File: embedding_store.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-05-12
+#
+# Description:
+# This module defines the EmbeddingStore class, which keeps every face
+# embedding of every user in a single packed file instead of one .pkl per embedding:
+# - 'gallery_*.npy': one float32 matrix (one embedding per row) in .npy format,
+#   opened with zero-copy memory mapping. New rows are appended at its end.
+# - 'gallery_index.json': a snapshot of the index mapping each row to its user folder.
+# - 'gallery_*.log': an append-only log of the changes made since the snapshot.
+#   Each record carries a CRC32 of itself and of the rows it adds.
+#
+# A write appends its rows to the matrix, then one log record (the commit
+# point), both flushed to disk. A crash can only leave a torn record or rows
+# past the last record; both are ignored when reading and overwritten by the
+# next write. Opening the store reads the snapshot and replays only the log
+# tail, so startup does not slow down as history grows: a new snapshot is
+# written every SNAPSHOT_RECORDS records.
+#
+# Every write also bumps a generation counter and keeps the change in a
+# short change list. The generation is mirrored in a tiny 'gallery.stamp'
+# file, so other processes detect changes with one small read and, when it
+# changed, replay only the new changes.
+# Removed rows are marked as dead (label -1) so the remaining rows keep
+# their positions; the matrix is compacted once too many rows are dead.
+# Readers take no lock: a compaction or a snapshot keeps the previous
+# matrix/log file until the next one, and a reader that still finds its
+# file gone re-reads the index and retries.
+#
+# Legacy 'embeddings/<folder>/<folder>_NN.pkl' files are imported
+# automatically the first time the store is opened.
+# ============================================
+
+import fcntl  # Advisory file lock shared by all processes writing the store
+import json  # The snapshot and the log records are stored as JSON
+import os  # File and directory handling
+import pickle  # To import legacy .pkl embeddings
+import struct  # To write the .npy header and the log record headers
+import threading  # Lock shared by the threads of one process
+import zlib  # CRC32 checksums of the log records and rows
+from collections import Counter  # Most common embedding length of a legacy tree
+from contextlib import contextmanager
+
+import numpy as np  # NumPy for the embedding matrix
+
+INDEX_FILE = "gallery_index.json"  # Snapshot of the row -> user folder index
+LOCK_FILE = "gallery.lock"  # Lock file used to serialize writers
+STAMP_FILE = "gallery.stamp"  # "<generation> <compactions> <snapshots>", rewritten after every commit
+HEADER_SIZE = 128  # Fixed .npy header size, so the shape can be rewritten in place
+CHANGE_LOG_SIZE = 1000  # Number of recent changes kept for incremental reloads
+DEAD_ROW_RATIO = 0.25  # Compact the matrix once this fraction of rows is dead
+SNAPSHOT_RECORDS = 500  # Write a new snapshot once the log holds this many records
+RECORD_MAGIC = b"GLOG"  # Marks the start of every log record
+RECORD_HEADER = struct.Struct("<4sII")  # Magic, payload length, CRC32 of the payload
+READ_RETRIES = 3  # Re-reads of the index when a lock-free read finds its file removed
+
+
+# === Class responsible for reading and writing the packed embedding file ===
+class EmbeddingStore:
+    def __init__(self, base_dir, import_legacy=True):
+        """
+        Opens (or prepares) the packed store inside 'base_dir'.
+        - Creates the directory if needed.
+        - Imports legacy .pkl embeddings if no packed store exists yet
+          (unless 'import_legacy' is False, e.g. for tools/compact_embeddings.py).
+        """
+        self.base_dir = base_dir
+        self.index_path = os.path.join(base_dir, INDEX_FILE)
+        self.lock_path = os.path.join(base_dir, LOCK_FILE)
+        self.stamp_path = os.path.join(base_dir, STAMP_FILE)
+        self._thread_lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._cache = None  # Last replayed state: snapshot number, index, log offset, record count
+        os.makedirs(base_dir, exist_ok=True)
+
+        if import_legacy and not os.path.exists(self.index_path):
+            self.import_legacy()  # Checks again under the store lock
+
+    # === Locking, snapshot and log helpers ===
+
+    @contextmanager
+    def _locked(self):
+        """
+        Serializes writers across threads (threading.Lock) and processes (flock).
+        """
+        with self._thread_lock:
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_snapshot(self):
+        """
+        Reads the snapshot index from disk (defaults for a new store).
+        Returns a fresh replay state starting at the beginning of its log.
+        """
+        index = {
+            "version": 2, "matrix_file": "gallery.npy", "dim": None, "folders": [], "labels": [],
+            "generation": 0, "compactions": 0, "changes": [], "snapshots": 0, "log_file": "gallery.log",
+        }
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                index.update(json.load(f))
+        return {"snapshots": index["snapshots"], "index": index, "offset": 0, "records": 0}
+
+    def read_index(self):
+        """
+        Returns the current row index: the snapshot plus the replayed log.
+        Only the log records written since the previous call are read.
+        The dictionary has:
+        - 'matrix_file', 'dim': the packed matrix file and embedding length
+        - 'folders', 'labels': the folder index of each row (-1 for removed rows)
+        - 'generation', 'compactions', 'changes': the change tracking fields
+        """
+        with self._cache_lock:
+            stamp = (self.stamp() or "").split()
+            snapshots = int(stamp[2]) if len(stamp) > 2 else 0
+            cache = self._cache
+            if cache is None or cache["snapshots"] != snapshots:
+                cache = self._read_snapshot()
+
+            for attempt in range(READ_RETRIES):
+                try:
+                    self._replay_log(cache)
+                    break
+                except FileNotFoundError:
+                    # Newer snapshots replaced the log (or the matrix) while we read it:
+                    # start over from the current snapshot
+                    if attempt == READ_RETRIES - 1:
+                        raise
+                    cache = self._read_snapshot()
+
+            self._cache = cache
+            return self._copy_index(cache["index"])
+
+    @staticmethod
+    def _copy_index(index):
+        """
+        Copy of an index that callers can modify without touching the cache.
+        """
+        return dict(index, folders=list(index["folders"]), labels=list(index["labels"]),
+                    changes=list(index["changes"]))
+
+    def _replay_log(self, cache):
+        """
+        Applies the valid log records after cache['offset'] to cache['index'].
+        Reading stops at the first torn or corrupted record (the end of the committed log).
+        """
+        index = cache["index"]
+        log_path = os.path.join(self.base_dir, index["log_file"])
+        if cache["offset"] == 0 and not os.path.exists(log_path):
+            return  # Nothing committed since the snapshot
+
+        with open(log_path, "rb") as f:
+            f.seek(cache["offset"])
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                magic, length, crc = RECORD_HEADER.unpack(header)
+                if magic != RECORD_MAGIC:
+                    break
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                record = json.loads(payload)
+                if not self._rows_match(index, record):
+                    break
+                self._apply_record(index, record)
+                cache["offset"] = f.tell()
+                cache["records"] += 1
+
+    def _rows_match(self, index, record):
+        """
+        Checks the CRC32 of the rows added by a log record against the matrix file.
+        """
+        adds = [change for change in record["changes"] if change[0] == "add"]
+        if not adds:
+            return True
+        dim = record["dim"]
+        matrix_path = os.path.join(self.base_dir, index["matrix_file"])
+        with open(matrix_path, "rb") as f:  # FileNotFoundError: compacted meanwhile (read_index retries)
+            for (_, _, first_row, count), crc in zip(adds, record["crc"]):
+                f.seek(HEADER_SIZE + first_row * dim * 4)
+                if zlib.crc32(f.read(count * dim * 4)) != crc:
+                    return False
+        return True
+
+    @staticmethod
+    def _apply_record(index, record):
+        """
+        Applies the changes of one log record to 'index' (in memory).
+        """
+        generation = record["generation"]
+        if record.get("dim"):
+            index["dim"] = record["dim"]
+        for change in record["changes"]:
+            if change[0] == "add":
+                _, folder, _, count = change
+                if folder not in index["folders"]:
+                    index["folders"].append(folder)
+                index["labels"].extend([index["folders"].index(folder)] * count)
+            elif change[0] == "remove":
+                EmbeddingStore._drop_rows(index, change[1])
+        index["generation"] = generation
+        logged = [[generation] + change for change in record["changes"]]
+        index["changes"] = (index["changes"] + logged)[-CHANGE_LOG_SIZE:]
+
+    def _commit(self, index, changes, crcs=()):
+        """
+        Appends one checksummed record with 'changes' to the log, flushes it to disk
+        and applies it to 'index'. Changes committed together share one generation.
+        Writes a new snapshot (or compacts the matrix) when it is due.
+        Must be called with the store lock held, on the index returned by read_index().
+        """
+        record = {"generation": index["generation"] + 1, "changes": changes}
+        if crcs:
+            record["dim"] = index["dim"]
+            record["crc"] = list(crcs)
+        payload = json.dumps(record, separators=(",", ":")).encode()
+
+        with self._cache_lock:
+            cache = self._cache
+            log_path = os.path.join(self.base_dir, index["log_file"])
+            with open(log_path, "r+b" if os.path.exists(log_path) else "w+b") as f:
+                f.truncate(cache["offset"])  # Drop a torn record left by an interrupted write
+                f.seek(cache["offset"])
+                f.write(RECORD_HEADER.pack(RECORD_MAGIC, len(payload), zlib.crc32(payload)) + payload)
+                f.flush()
+                os.fsync(f.fileno())
+                cache["offset"] = f.tell()
+            cache["records"] += 1
+
+            self._apply_record(index, record)
+            cache["index"] = self._copy_index(index)
+            self._write_stamp(index)
+
+        if index["labels"].count(-1) > DEAD_ROW_RATIO * len(index["labels"]):
+            self._compact(index)
+        elif cache["records"] >= SNAPSHOT_RECORDS:
+            self._write_snapshot(index)
+
+    def _write_snapshot(self, index):
+        """
+        Writes 'index' as the new snapshot with an empty log, then removes the logs
+        older than the previous one (a reader may still be replaying the previous log).
+        Must be called with the store lock held.
+        """
+        old_log = index["log_file"]
+        index["version"] = 2
+        index["snapshots"] += 1
+        index["log_file"] = f"gallery_{index['snapshots']:04d}.log"
+
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+
+        with self._cache_lock:
+            self._cache = {"snapshots": index["snapshots"], "index": self._copy_index(index), "offset": 0, "records": 0}
+            self._write_stamp(index)
+
+        self._remove_stale(".log", keep=(old_log, index["log_file"]))
+
+    def _remove_stale(self, extension, keep):
+        """
+        Removes the 'gallery*<extension>' generation files other than those in 'keep'.
+        Must be called with the store lock held.
+        """
+        for file in os.listdir(self.base_dir):
+            if file.startswith("gallery") and file.endswith(extension) and file not in keep:
+                os.remove(os.path.join(self.base_dir, file))
+
+    def _write_stamp(self, index):
+        """
+        Publishes the new generation for other processes (after the commit is on disk).
+        """
+        tmp_path = self.stamp_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(f"{index['generation']} {index['compactions']} {index['snapshots']}")
+        os.replace(tmp_path, self.stamp_path)
+
+    @staticmethod
+    def _write_header(f, rows, dim):
+        """
+        Writes a .npy (version 1.0) header for a C-ordered float32 [rows, dim] matrix.
+        The header is padded to HEADER_SIZE bytes so it can be rewritten in place.
+        """
+        header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % (rows, dim)
+        header = header.ljust(HEADER_SIZE - 10 - 1) + "\n"
+        f.seek(0)
+        f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+    # === Reading ===
+
+    def stamp(self):
+        """
+        Returns a cheap stamp of the store (one small read of the stamp file).
+        The stamp changes on every write to the store.
+        """
+        try:
+            with open(self.stamp_path, "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def map_matrix(self, index):
+        """
+        Memory-maps the committed rows of the packed matrix (read-only, zero copy).
+        The shape comes from the index, not from the .npy header: the header is
+        rewritten in place on every append, so after a crash it may count rows
+        that never reached the file (or miss rows that did).
+        """
+        rows = len(index["labels"])
+        if rows == 0:
+            return np.empty((0, index["dim"] or 0), dtype=np.float32)
+        matrix_path = os.path.join(self.base_dir, index["matrix_file"])
+        return np.memmap(matrix_path, dtype="<f4", mode="r", offset=HEADER_SIZE, shape=(rows, index["dim"]))
+
+    def read_gallery(self, mapped=False):
+        """
+        Reads the current index and memory-maps its matrix (see load, or load_mapped
+        when 'mapped' is set).
+        If compactions removed the matrix between the two reads, the index is read again.
+        Returns a tuple (index, matrix, labels, folders), or (index, matrix, rows, labels, folders).
+        """
+        for attempt in range(READ_RETRIES):
+            index = self.read_index()
+            try:
+                return (index,) + (self.load_mapped(index) if mapped else self.load(index))
+            except FileNotFoundError:
+                if attempt == READ_RETRIES - 1:
+                    raise
+
+    def load(self, index=None):
+        """
+        Memory-maps the packed matrix (zero copy unless some rows were removed).
+        Returns a tuple (matrix, labels, folders):
+        - matrix: read-only float32 array of shape [N, D]
+        - labels: int32 array of shape [N] with the folder index of each row
+        - folders: list of user folders that the labels index into
+        Raises FileNotFoundError if the matrix of an old 'index' was removed by
+        later compactions (read_gallery retries with the current index).
+        """
+        if index is None:
+            return self.read_gallery()[1:]
+        matrix, rows, labels, folders = self.load_mapped(index)
+        if len(rows) != len(matrix):
+            matrix = matrix[rows]  # Drop dead rows (copy)
+        return matrix, labels, folders
+
+    def load_mapped(self, index):
+        """
+        Like load, but never copies the matrix, even when some rows were removed.
+        Returns a tuple (matrix, rows, labels, folders):
+        - matrix: read-only memory map of every committed row (removed rows included)
+        - rows: int64 array with the matrix row of each live embedding
+        - labels, folders: as returned by load (one label per live embedding)
+        """
+        matrix = self.map_matrix(index)
+        labels = np.asarray(index["labels"], dtype=np.int32)
+        folders = list(index["folders"])
+
+        alive = labels >= 0
+        rows = np.flatnonzero(alive)
+        if len(rows) != len(labels):
+            # Drop dead rows and the slots of removed folders
+            labels = labels[alive]
+            used = np.unique(labels)
+            remap = np.full(len(folders), -1, dtype=np.int32)
+            remap[used] = np.arange(len(used), dtype=np.int32)
+            labels = remap[labels]
+            folders = [folders[i] for i in used]
+        return matrix, rows, labels, folders
+
+    def read_rows(self, index, first, count):
+        """
+        Returns rows [first, first + count) of the matrix described by 'index'.
+        Raises FileNotFoundError if later compactions removed that matrix.
+        """
+        return self.map_matrix(index)[first:first + count]
+
+    def changes_since(self, generation, compactions):
+        """
+        Returns the index and the changes made after 'generation'.
+        Each change is [generation, "add", folder, first_row, count] or
+        [generation, "remove", folder], in the order they were made
+        (a replaced user logs both with one generation). The list is None when the changes
+        cannot be replayed (the matrix was compacted or the change list was trimmed)
+        and a full reload is needed.
+        """
+        index = self.read_index()
+        changes = [c for c in index["changes"] if c[0] > generation]
+        if index["compactions"] != compactions:
+            return index, None
+        if index["generation"] > generation and (not changes or changes[0][0] != generation + 1):
+            return index, None
+        return index, changes
+
+    def read_user(self, folder):
+        """
+        Returns a copy of the embeddings of 'folder' (float32 array of shape [n, D]).
+        """
+        index, matrix, labels, folders = self.read_gallery()
+        if folder not in folders:
+            return np.empty((0, index["dim"] or 0), dtype=np.float32)
+        return np.array(matrix[labels == folders.index(folder)])
+
+    def load_known_embeddings(self):
+        """
+        Returns the store as a {user_folder: [embedding, ...]} dictionary.
+        The embeddings are views into the memory-mapped matrix.
+        """
+        matrix, labels, folders = self.load()
+        known = {}
+        for row, label in enumerate(labels):
+            known.setdefault(folders[label], []).append(matrix[row])
+        return known
+
+    def has_user(self, folder):
+        """
+        Returns True if the store holds at least one embedding for 'folder'.
+        """
+        return folder in self.read_index()["folders"]
+
+    # === Writing ===
+
+    def _append_rows(self, index, vectors):
+        """
+        Writes 'vectors' after the committed rows of the matrix and flushes them to disk.
+        They only become visible once a log record that adds them is committed.
+        Must be called with the store lock held.
+        Returns a tuple (first_row, crc) for the log record.
+        """
+        dim = index["dim"] or vectors.shape[1]
+        if vectors.shape[1] != dim:
+            raise ValueError(f"Invalid embedding length: expected {dim}, got {vectors.shape[1]}")
+
+        rows = len(index["labels"])
+        data = np.ascontiguousarray(vectors, dtype="<f4").tobytes()
+        matrix_path = os.path.join(self.base_dir, index["matrix_file"])
+        mode = "r+b" if os.path.exists(matrix_path) else "w+b"
+        with open(matrix_path, mode) as f:
+            # Drop any uncommitted rows left by an interrupted write
+            f.truncate(HEADER_SIZE + rows * dim * 4)
+            f.seek(HEADER_SIZE + rows * dim * 4)
+            f.write(data)
+            self._write_header(f, rows + len(vectors), dim)
+            f.flush()
+            os.fsync(f.fileno())
+
+        index["dim"] = dim
+        return rows, zlib.crc32(data)
+
+    @staticmethod
+    def _drop_rows(index, folder):
+        """
+        Marks every row of 'folder' as dead in 'index' (in memory only) and frees its slot.
+        Returns the number of dropped rows.
+        """
+        label = index["folders"].index(folder)
+        index["folders"][label] = None  # Free the slot (labels of other folders stay valid)
+        labels = index["labels"]
+        removed = 0
+        for row, row_label in enumerate(labels):
+            if row_label == label:
+                labels[row] = -1
+                removed += 1
+        return removed
+
+    @staticmethod
+    def _rows_of(index, folder):
+        """
+        Returns the rows of 'folder' in 'index'.
+        """
+        label = index["folders"].index(folder)
+        return [row for row, row_label in enumerate(index["labels"]) if row_label == label]
+
+    def append(self, folder, embeddings):
+        """
+        Appends one or more embeddings for 'folder'.
+        The rows are written to the matrix file before the log record that
+        commits them, so a crash never exposes a half-written row.
+        Returns the list of row numbers assigned to the new embeddings.
+        """
+        vectors = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        if len(vectors) == 0:
+            return []
+
+        with self._locked():
+            return self._write_user(self.read_index(), folder, vectors, replace=False)
+
+    def remove_user(self, folder):
+        """
+        Removes every embedding of 'folder'.
+        The rows are marked as dead so the other rows keep their positions;
+        the matrix is compacted once too many rows are dead.
+        Returns the number of removed embeddings.
+        """
+        with self._locked():
+            index = self.read_index()
+            if folder not in index["folders"]:
+                return 0
+
+            removed = index["labels"].count(index["folders"].index(folder))
+            self._commit(index, [["remove", folder]])
+
+        return removed
+
+    def replace_user(self, folder, embeddings):
+        """
+        Replaces every embedding of 'folder' with 'embeddings' in a single commit:
+        the new rows are written first, then one log record drops the old rows
+        and exposes the new ones, so a crash leaves either the old or the new set.
+        Returns the list of row numbers assigned to the new embeddings.
+        """
+        vectors = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        with self._locked():
+            return self._write_user(self.read_index(), folder, vectors, replace=True)
+
+    def update_user(self, folder, update):
+        """
+        Read-modify-write of the embeddings of 'folder' under the store lock, so a
+        write made by another worker between the read and the write cannot be lost.
+        - update(stored) receives the stored embeddings (float32 array [n, D], read
+          under the lock) and returns a tuple (embeddings, replace): the embeddings
+          are appended to the user's rows, or replace them all when 'replace' is True.
+        Returns the list of row numbers assigned to the returned embeddings.
+        """
+        with self._locked():
+            index = self.read_index()
+            if folder in index["folders"]:
+                stored = np.array(self.map_matrix(index)[self._rows_of(index, folder)])
+            else:
+                stored = np.empty((0, index["dim"] or 0), dtype=np.float32)
+            embeddings, replace = update(stored)
+            vectors = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+            return self._write_user(index, folder, vectors, replace)
+
+    def _write_user(self, index, folder, vectors, replace):
+        """
+        Appends 'vectors' to the rows of 'folder' (or replaces them all) in one commit.
+        Must be called with the store lock held, on the index returned by read_index().
+        Returns the list of row numbers assigned to 'vectors'.
+        """
+        changes, crcs = [], []
+        if replace and folder in index["folders"]:
+            changes.append(["remove", folder])
+        if len(vectors):
+            rows, crc = self._append_rows(index, vectors)
+            changes.append(["add", folder, rows, len(vectors)])
+            crcs.append(crc)
+        if not changes:
+            return []
+
+        compactions = index["compactions"]
+        self._commit(index, changes, crcs)  # May compact and renumber the rows (updates 'index')
+        if not len(vectors):
+            return []
+        if index["compactions"] != compactions:
+            return self._rows_of(index, folder)[-len(vectors):]  # Renumbered by a compaction
+        return list(range(rows, rows + len(vectors)))
+
+    def _compact(self, index):
+        """
+        Rewrites the matrix without its dead rows (store lock held).
+        """
+        matrix, labels, folders = self.load(index)
+        self._replace_matrix(index, matrix, labels, folders)
+
+    def _replace_matrix(self, index, matrix, labels, folders):
+        """
+        Writes 'matrix' into a new file, which only replaces the old one once
+        a new snapshot points to it. Readers see a compaction and reload fully.
+        The old file is kept until the next compaction, for readers still using it.
+        Must be called with the store lock held.
+        """
+        kept = np.ascontiguousarray(matrix, dtype="<f4")
+
+        old_file = index["matrix_file"]
+        compactions = index["compactions"] + 1
+        new_file = f"gallery_{compactions:04d}.npy"
+        with open(os.path.join(self.base_dir, new_file), "w+b") as f:
+            f.seek(HEADER_SIZE)
+            f.write(kept.tobytes())
+            self._write_header(f, len(kept), kept.shape[1])
+            f.flush()
+            os.fsync(f.fileno())
+
+        index.update({
+            "matrix_file": new_file,
+            "dim": int(kept.shape[1]) if len(kept) else index["dim"],
+            "generation": index["generation"] + 1,
+            "compactions": compactions,
+            "folders": list(folders),
+            "labels": np.asarray(labels).tolist(),
+            "changes": [],  # Row numbers changed: readers must reload fully
+        })
+        self._write_snapshot(index)
+        self._remove_stale(".npy", keep=(old_file, new_file))
+
+    def rewrite(self, users):
+        """
+        Replaces the whole store in one bulk pass.
+        'users' is a list of (folder, embeddings) pairs; every embedding must have the same length.
+        Returns the number of stored embeddings.
+        """
+        folders, blocks, labels = [], [], []
+        for folder, embeddings in users:
+            vectors = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+            if len(vectors) == 0:
+                continue
+            labels.extend([len(folders)] * len(vectors))
+            folders.append(folder)
+            blocks.append(vectors)
+        matrix = np.vstack(blocks) if blocks else np.empty((0, 0), dtype=np.float32)
+
+        with self._locked():
+            self._replace_matrix(self.read_index(), matrix, labels, folders)
+        return len(matrix)
+
+    def import_legacy(self):
+        """
+        Imports legacy 'embeddings/<folder>/*.pkl' files into the packed store.
+        - Runs under the store lock and only while no snapshot exists, so when several
+          workers start on a fresh tree only the first one imports.
+        - Every embedding is committed in one log record, followed by the first snapshot
+          (which marks the import as done).
+        Unreadable (e.g. truncated) pickles are skipped with a warning, and so are embeddings
+        whose length differs from the most common one (e.g. 128-dim files from an older
+        model next to 192-dim ones), like tools/compact_embeddings.py does.
+        The .pkl files are left in place. Returns the number of imported embeddings.
+        """
+        with self._locked():
+            if os.path.exists(self.index_path):
+                return 0  # Another worker imported (or the store was created) meanwhile
+
+            users = []
+            for user_folder in sorted(os.listdir(self.base_dir)):
+                user_path = os.path.join(self.base_dir, user_folder)
+                if not os.path.isdir(user_path):
+                    continue
+                vectors = []
+                for file in sorted(os.listdir(user_path)):
+                    if file.endswith(".pkl"):
+                        try:
+                            with open(os.path.join(user_path, file), "rb") as f:
+                                vectors.append(np.asarray(pickle.load(f), dtype=np.float32).ravel())
+                        except Exception as e:
+                            print(f"[WARNING] Skipping unreadable embedding {file}: {e}")
+                if vectors:
+                    users.append((user_folder, vectors))
+
+            # Keep the most common embedding length (the store holds one matrix)
+            dims = Counter(len(vector) for _, vectors in users for vector in vectors)
+            dim = dims.most_common(1)[0][0] if dims else None
+            kept = []
+            for user_folder, vectors in users:
+                skipped = sum(len(vector) != dim for vector in vectors)
+                if skipped:
+                    print(f"[WARNING] Skipping {skipped} embeddings of {user_folder} "
+                          f"with a length other than {dim}")
+                vectors = [vector for vector in vectors if len(vector) == dim]
+                if vectors:
+                    kept.append((user_folder, np.vstack(vectors)))
+            users = kept
+
+            index = self.read_index()
+            imported = sum(len(vectors) for _, vectors in users)
+            if users:
+                row, _ = self._append_rows(index, np.vstack([vectors for _, vectors in users]))
+                changes, crcs = [], []
+                for user_folder, vectors in users:
+                    changes.append(["add", user_folder, row, len(vectors)])
+                    crcs.append(zlib.crc32(np.ascontiguousarray(vectors, dtype="<f4").tobytes()))
+                    row += len(vectors)
+                self._commit(index, changes, crcs)
+            self._write_snapshot(index)  # Marks the import as done
+
+        if imported:
+            print(f"[INFO] Imported {imported} legacy .pkl embeddings into {self.index_path}")
+        return imported
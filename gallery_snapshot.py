@@ -0,0 +1,390 @@
+# ============================================
+# Immutable Gallery Snapshot
+# File: gallery_snapshot.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-06-07
+#
+# Description:
+# This module defines the GallerySnapshot class, which holds everything
+# FaceRecognizer searches in one object:
+# - The gallery matrix (one embedding per row), the label of each row and
+#   the precomputed squared row norms.
+# - The user folders, the rows of each user and the known_embeddings dictionary.
+# - The per-user prototypes, the optional float16/int8 copy (quantization.py)
+#   and the optional IVF index (ann_index.py).
+#
+# With a float16/int8 copy and a private gallery ("compact" snapshots), the
+# float32 rows are not kept in memory at all: the snapshot only holds the
+# store row of each gallery row, and its matrix is a MappedRows view that
+# reads the few rows asked for (exact rescoring, verification, prototypes)
+# from the memory-mapped store file. Only the quantized rows, the norms and
+# the row numbers live in process memory.
+#
+# A published snapshot is never modified. Writers call edit() to get a
+# private copy, apply their changes to it, refresh its prototypes and publish
+# it by assigning one attribute, so a search that started on the previous snapshot finishes on
+# a consistent gallery and never waits for a writer.
+# The copy is cheap: the small per-user containers are copied, while the
+# row buffers are shared. New rows are written past the end of the old
+# snapshot (which never reads them); removals, which move rows, first give
+# the copy its own buffers.
+# ============================================
+
+import copy  # Shallow copies of a snapshot for edit()
+
+import numpy as np  # NumPy for the gallery buffers
+
+import scoring  # Squared row norms
+from ann_index import IVFIndex  # Optional approximate nearest-neighbour index
+from quantization import QuantizedRows  # Optional float16/int8 copy of the gallery
+
+
+def compute_prototypes(matrix, labels, users):
+    """
+    Computes the prototype of every user of a full gallery (see refresh_prototypes)
+    in two passes over the rows, read scoring.NORM_CHUNK_ROWS rows at a time.
+    Returns a tuple (centroids, radii, counts, alive) indexed by label.
+    """
+    dim = matrix.shape[1]
+    counts = np.bincount(labels, minlength=users).astype(np.int64)
+    sums = np.zeros((users, dim), dtype=np.float64)
+    for start in range(0, len(labels), scoring.NORM_CHUNK_ROWS):
+        chunk_labels = labels[start:start + scoring.NORM_CHUNK_ROWS]
+        order = np.argsort(chunk_labels, kind="stable")
+        present, first = np.unique(chunk_labels[order], return_index=True)
+        chunk = np.asarray(matrix[start:start + scoring.NORM_CHUNK_ROWS], dtype=np.float64)
+        sums[present] += np.add.reduceat(chunk[order], first, axis=0)
+    centroids = sums / np.maximum(counts, 1)[:, None]
+
+    radii = np.zeros(users, dtype=np.float64)
+    for start in range(0, len(labels), scoring.NORM_CHUNK_ROWS):
+        chunk_labels = labels[start:start + scoring.NORM_CHUNK_ROWS]
+        chunk = np.asarray(matrix[start:start + scoring.NORM_CHUNK_ROWS], dtype=np.float64)
+        np.maximum.at(radii, chunk_labels, np.sqrt(((chunk - centroids[chunk_labels]) ** 2).sum(axis=1)))
+    return centroids, radii, counts, counts > 0
+
+
+# === Read-only view of some rows of the memory-mapped store matrix ===
+class MappedRows:
+    def __init__(self, source, rows, normalize=False):
+        """
+        Rows 'rows' (store row numbers) of the memory-mapped matrix 'source', read on demand.
+        Indexing returns float32 copies of only the requested rows,
+        L2-normalized when 'normalize' is set (cosine mode).
+        Slicing in chunks (see scoring.squared_norms) reads the whole view with bounded memory.
+        """
+        self.source = source
+        self.rows = rows
+        self.normalize = normalize
+        self.shape = (len(rows), source.shape[1])
+        self.dtype = np.dtype(np.float32)
+        self.ndim = 2
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, key):
+        values = np.asarray(self.source[self.rows[key]], dtype=np.float32)
+        return scoring.l2_normalize(values) if self.normalize else values
+
+
+# === Class holding one immutable version of the gallery ===
+class GallerySnapshot:
+    def __init__(self, matrix, labels, users, norms=None, precision=None, ann_options=None,
+                 reference_norm=1.0, reference_pending=False, quantized=None, ann_index=None,
+                 source_rows=None, normalize_rows=False, prototypes=None):
+        """
+        Builds a snapshot from a full gallery:
+        - 'matrix', 'labels', 'users': rows in the scoring space, their labels and the user folders
+        - 'norms': precomputed squared row norms (computed here when None)
+        - 'precision': 'float16'/'int8' for a quantized copy, None for none
+        - 'ann_options': IVF index settings (see ann_index.py), None to disable it
+        - 'reference_norm', 'reference_pending': cosine mode threshold translation
+        - 'quantized', 'ann_index': the quantized copy and IVF index when already built
+          (e.g. mapped from the shared gallery file), instead of building them here
+        - 'source_rows': compact snapshot: 'matrix' is the memory-mapped store matrix (raw
+          embeddings, removed rows included) and 'source_rows' the store row of each label;
+          rows are read from it on demand, L2-normalized when 'normalize_rows' is set
+        - 'prototypes': (centroids, radii, counts, alive) when already computed
+          (e.g. mapped from the shared gallery file), instead of computing them here
+        The matrix is used as-is (it may be a read-only memory map) until the first update.
+        """
+        self.reference_norm = reference_norm  # Typical raw embedding norm (cosine mode)
+        self.reference_pending = reference_pending  # Empty cosine gallery: taken from the first embedding
+        self.ann_options = ann_options
+        self._source = None if source_rows is None else matrix  # Store matrix of a compact snapshot
+        self._normalize_rows = normalize_rows
+        # Backing storage (the rows, or their store rows when compact); rows past size are spare capacity
+        self._buffer = matrix if source_rows is None else np.asarray(source_rows, dtype=np.int64)
+        self._label_buffer = labels
+        if norms is None:
+            rows = matrix if source_rows is None else MappedRows(matrix, self._buffer, normalize_rows)
+            norms = scoring.squared_norms(rows)  # Read in chunks
+        self._norm_buffer = norms  # |x|^2 of every row
+        self._rows_shared = False  # True while the buffers are shared with the previous snapshot
+        self.size = len(labels)
+
+        # Bookkeeping used by the incremental updates
+        self.users = list(users)  # Label -> user folder (None for the slots of removed users)
+        self.user_labels = {name: label for label, name in enumerate(self.users)}
+        self.user_rows = {name: [] for name in self.users}  # User folder -> rows in the matrix
+        self.known = {name: [] for name in self.users}  # User folder -> embeddings (row views)
+        for row, label in enumerate(labels):
+            self.user_rows[self.users[label]].append(row)
+            self.known[self.users[label]].append(self._embedding(row))
+        self.free_labels = []  # Labels of removed users, reused by new users
+        self._publish()
+
+        if prototypes is None:
+            prototypes = compute_prototypes(self.matrix, self.labels, len(self.users))
+        self.prototype_centroids, self.prototype_radii, self.prototype_counts, self.prototype_alive = prototypes
+        self._dirty_prototypes = set()  # Users whose prototype must be refreshed before publishing
+
+        if quantized is None and precision:
+            quantized = QuantizedRows(precision, self.matrix)
+        self.quantized = quantized
+        self.ann_index = ann_index
+        self._update_ann_index()
+
+    def _publish(self):
+        """
+        Exposes the used part of the backing buffers as matrix / labels / norms.
+        """
+        if self._source is None:
+            self.matrix = self._buffer[:self.size]
+        else:
+            self.matrix = MappedRows(self._source, self._buffer[:self.size], self._normalize_rows)
+        self.labels = self._label_buffer[:self.size]
+        self.norms = self._norm_buffer[:self.size]
+
+    @property
+    def compact(self):
+        """
+        True when the float32 rows are read from the memory-mapped store (see MappedRows).
+        """
+        return self._source is not None
+
+    def _embedding(self, row):
+        """
+        The embedding of 'row' for the known_embeddings dictionary: a view into the
+        buffer, or into the store file for a compact snapshot (raw, as stored).
+        """
+        return self._buffer[row] if self._source is None else self._source[self._buffer[row]]
+
+    def remap(self, source):
+        """
+        Compact snapshots: switches to a newer mapping of the store matrix (the same
+        file, grown by appends), so rows appended since this snapshot was built can be added.
+        """
+        self._source = source
+        self._publish()
+
+    def edit(self):
+        """
+        Returns a private copy of this snapshot to apply changes to.
+        This snapshot is left untouched and can still be searched meanwhile.
+        """
+        gallery = copy.copy(self)
+        gallery.users = list(self.users)
+        gallery.user_labels = dict(self.user_labels)
+        gallery.user_rows = dict(self.user_rows)  # Row lists are replaced, never modified in place
+        gallery.known = dict(self.known)  # Same for the embedding lists
+        gallery.free_labels = list(self.free_labels)
+        gallery._rows_shared = True
+        gallery.prototype_centroids = self.prototype_centroids.copy()
+        gallery.prototype_radii = self.prototype_radii.copy()
+        gallery.prototype_alive = self.prototype_alive.copy()
+        gallery.prototype_counts = self.prototype_counts.copy()
+        gallery._dirty_prototypes = set()  # A published snapshot has no stale prototypes
+        if self.quantized is not None:
+            gallery.quantized = copy.copy(self.quantized)  # Appends only write past our size
+        if self.ann_index is not None:
+            gallery.ann_index = self.ann_index.copy()
+        return gallery
+
+    # === Row buffers ===
+
+    def _reserve_rows(self, extra, dim):
+        """
+        Makes sure the backing buffers are writable and can hold 'extra' more rows.
+        Capacity grows geometrically, so appending is O(1) amortized.
+        A compact snapshot only stores one store row number per row.
+        """
+        needed = self.size + extra
+        buffer = self._buffer
+        row_shape = (dim,) if self._source is None else ()
+        if buffer.flags.writeable and buffer.shape[0] >= needed and buffer.shape[1:] == row_shape:
+            return
+
+        capacity = max(64, needed, 2 * buffer.shape[0])
+        new_buffer = np.empty((capacity,) + row_shape, dtype=np.float32 if self._source is None else np.int64)
+        new_labels = np.empty(capacity, dtype=np.int32)
+        new_norms = np.empty(capacity, dtype=np.float32)
+        if self.size:
+            new_buffer[:self.size] = buffer[:self.size]
+            new_labels[:self.size] = self._label_buffer[:self.size]
+            new_norms[:self.size] = self._norm_buffer[:self.size]
+        self._buffer, self._label_buffer, self._norm_buffer = new_buffer, new_labels, new_norms
+
+    def _own_rows(self):
+        """
+        Gives this snapshot its own row buffers (and quantized rows) before rows are moved in place.
+        """
+        if self._rows_shared or not self._buffer.flags.writeable:
+            self._buffer = self._buffer.copy()
+            self._label_buffer = self._label_buffer.copy()
+            self._norm_buffer = self._norm_buffer.copy()
+            if self.quantized is not None:
+                self.quantized = self.quantized.copy()
+            self._rows_shared = False
+
+    # === Incremental updates (only on a snapshot returned by edit()) ===
+
+    def add(self, folder, vector, source_row=None):
+        """
+        Adds one embedding (already in the scoring space) for 'folder'.
+        New users get a free label (or a new one); no other rows are touched.
+        A compact snapshot also needs the store row holding the embedding ('source_row',
+        after remap() when it was appended since the snapshot was built).
+        """
+        if self._source is not None:
+            if source_row is None:
+                raise ValueError("Compact galleries add rows of the store matrix (source_row is required)")
+            dim = self._source.shape[1]
+        else:
+            dim = self._buffer.shape[1] if self.size else len(vector)
+        if len(vector) != dim:
+            raise ValueError(f"Invalid embedding length: expected {dim}, got {len(vector)}")
+
+        label = self.user_labels.get(folder)
+        if label is None:
+            if self.free_labels:
+                label = self.free_labels.pop()
+                self.users[label] = folder
+            else:
+                label = len(self.users)
+                self.users.append(folder)
+            self.user_labels[folder] = label
+            self.user_rows[folder] = []
+            self.known[folder] = []
+
+        self._reserve_rows(1, dim)
+        row = self.size
+        self._buffer[row] = vector if self._source is None else source_row
+        self._label_buffer[row] = label
+        self._norm_buffer[row] = vector @ vector
+        self.size += 1
+        self.user_rows[folder] = self.user_rows[folder] + [row]
+        self.known[folder] = self.known[folder] + [self._embedding(row)]
+        self._dirty_prototypes.add(folder)
+        if self.quantized is not None:
+            self.quantized.set_row(row, vector)
+        self._publish()
+        if self.ann_index is not None:
+            self.ann_index.add(row, vector)
+        self._update_ann_index()
+
+    def remove(self, folder):
+        """
+        Removes every embedding of 'folder'.
+        Each removed row is filled with the current last row (swap-remove),
+        so only the removed rows and the rows moved into them are touched.
+        Returns the number of removed embeddings.
+        """
+        label = self.user_labels.pop(folder, None)
+        if label is None:
+            return 0
+
+        rows = self.user_rows.pop(folder)
+        self.known.pop(folder, None)
+        self.users[label] = None  # Keep the slot so other labels stay valid
+        self.free_labels.append(label)
+        self._dirty_prototypes.discard(folder)
+        if label < len(self.prototype_alive):
+            self.prototype_alive[label] = False
+            self.prototype_counts[label] = 0
+
+        self._own_rows()  # Rows are moved in place below
+
+        # Highest rows first: the last row is then never a removed row still waiting its turn
+        for row in sorted(rows, reverse=True):
+            last = self.size - 1
+            if self.ann_index is not None:
+                self.ann_index.remove(row)
+                if row != last:
+                    self.ann_index.move(last, row)
+            if row != last:
+                # Move the last row into the hole and update its owner's row list
+                self._buffer[row] = self._buffer[last]
+                self._label_buffer[row] = self._label_buffer[last]
+                self._norm_buffer[row] = self._norm_buffer[last]
+                owner = self.users[self._label_buffer[row]]
+                owner_rows = list(self.user_rows[owner])
+                position = owner_rows.index(last)  # Same order as the owner's known embeddings
+                owner_rows[position] = row
+                self.user_rows[owner] = owner_rows
+                if self._source is None:  # Views into the store file stay valid
+                    owner_known = list(self.known[owner])
+                    owner_known[position] = self._buffer[row]
+                    self.known[owner] = owner_known
+                if self.quantized is not None:
+                    self.quantized.move(last, row)
+            self.size -= 1
+
+        if self.quantized is not None:
+            self.quantized.truncate(self.size)
+        self._publish()
+        self._update_ann_index()
+        return len(rows)
+
+    def _update_ann_index(self):
+        """
+        Builds the ANN index once the gallery reaches FACEAUTH_ANN_MIN_ROWS rows,
+        retrains it when the gallery has doubled since it was trained, and drops it
+        when the gallery shrinks below the minimum again.
+        """
+        if self.ann_options is None or self.size < self.ann_options["min_rows"]:
+            self.ann_index = None
+        elif self.ann_index is None or self.size > 2 * self.ann_index.trained_rows:
+            self.ann_index = IVFIndex(self.matrix, nprobe=self.ann_options["nprobe"])
+
+    # === Prototypes ===
+
+    def refresh_prototypes(self):
+        """
+        Recomputes the prototype of every user whose embeddings changed since the last refresh:
+        - centroid: mean of the user's embeddings
+        - radius: largest distance from the centroid to one of those embeddings
+        - count: number of embeddings
+        Prototypes are indexed by label, like users. Writers call this before publishing
+        an edited snapshot (the constructor computes them for a full gallery), so searches
+        never compute or wait for prototypes.
+        """
+        if not self._dirty_prototypes:
+            return
+        users = len(self.users)
+        dim = self.matrix.shape[1]
+        if len(self.prototype_radii) < users or self.prototype_centroids.shape[1] != dim:
+            capacity = max(users, 2 * len(self.prototype_radii))
+            centroids = np.zeros((capacity, dim), dtype=np.float64)
+            radii = np.zeros(capacity, dtype=np.float64)
+            counts = np.zeros(capacity, dtype=np.int64)
+            alive = np.zeros(capacity, dtype=bool)
+            if self.prototype_centroids.shape[1] == dim:
+                kept = len(self.prototype_radii)
+                centroids[:kept] = self.prototype_centroids
+                radii[:kept] = self.prototype_radii
+                counts[:kept] = self.prototype_counts
+                alive[:kept] = self.prototype_alive
+            self.prototype_centroids, self.prototype_radii, self.prototype_alive = centroids, radii, alive
+            self.prototype_counts = counts
+
+        for folder in self._dirty_prototypes:
+            label = self.user_labels[folder]
+            vectors = self.matrix[self.user_rows[folder]].astype(np.float64)
+            centroid = vectors.mean(axis=0)
+            self.prototype_centroids[label] = centroid
+            self.prototype_radii[label] = np.sqrt(((vectors - centroid) ** 2).sum(axis=1)).max()
+            self.prototype_counts[label] = len(vectors)
+            self.prototype_alive[label] = True
+        self._dirty_prototypes.clear()
@@ -9,42 +9,47 @@
 # - Detects faces using MediaPipe.
 # - Preprocesses face images.
 # - Generates facial embeddings using a TFLite model (MobileFaceNet).
-# - Saves embeddings as .pkl files for later recognition.
+# - Saves embeddings to the packed embedding store for later recognition.
 #
-# Embeddings are saved in the 'embeddings/<username>' directory.
+# Embeddings are appended to the packed store in the 'embeddings/' directory
+# (see embedding_store.py). Inside the web app the generator is given the
+# global FaceRecognizer, so it saves through the recognizer's store (per-user
+# cap and gallery sync included) instead of opening a store of its own.
 # Used in conjunction with recognize_m.py for real-time face recognition.
 #
 # ============================================
 
-import cv2  # OpenCV for image and video processing
-import numpy as np  # NumPy for numerical operations
 import os  # OS functions for directory and file management
-import pickle  # To save and load embeddings
-import tflite_runtime.interpreter as tflite  # Lightweight TFLite interpreter for inference
-import mediapipe as mp  # MediaPipe for face detection
+from embedding_store import EmbeddingStore  # Packed, memory-mapped embedding storage
+from inference_engine import get_engine  # Shared model, interpreter/detector pools and preprocessing
 
 # === Class responsible for generating face embeddings from images ===
 class EmbeddingGenerator:
-    def __init__(self, model_path=os.path.join(os.path.dirname(__file__), 'models/mobilefacenet.tflite'), save_base_path="embeddings/"):
+    def __init__(self, model_path=os.path.join(os.path.dirname(__file__), 'models/mobilefacenet.tflite'), save_base_path="embeddings/",
+                 recognizer=None):
         """
         Constructor method for the EmbeddingGenerator class.
         - Loads the MobileFaceNet TFLite model.
         - Sets up MediaPipe for face detection.
         - Ensures the base directory for saving embeddings exists.
+        The model and detectors live in the shared inference engine, so they
+        are loaded once per process even when FaceRecognizer is also used.
+        With a 'recognizer', embeddings are saved through it and 'save_base_path'
+        is not used (no second store is created next to the recognizer's).
         """
-        self.save_base_path = save_base_path  # Directory where embeddings will be saved
-        os.makedirs(save_base_path, exist_ok=True)  # Create the directory if it doesn't exist
+        self.recognizer = recognizer
+        if recognizer is not None:
+            self.save_base_path = recognizer.embeddings_dir
+            self.store = recognizer.store  # The store every FaceRecognizer reads
+        else:
+            self.save_base_path = save_base_path  # Directory where embeddings will be saved
+            os.makedirs(save_base_path, exist_ok=True)  # Create the directory if it doesn't exist
+            self.store = EmbeddingStore(save_base_path)  # Packed embedding file inside the base directory
 
         # Load the TensorFlow Lite model for face embeddings
-        self.interpreter = tflite.Interpreter(model_path=model_path)
-        self.interpreter.allocate_tensors()  # Allocate memory for inference
-        self.input_details = self.interpreter.get_input_details()  # Input tensor details
-        self.output_details = self.interpreter.get_output_details()  # Output tensor details
-
-        # Initialize MediaPipe face detector with a confidence threshold
-        self.face_detection = mp.solutions.face_detection.FaceDetection(
-            model_selection=0, min_detection_confidence=0.5
-        )
+        # and MediaPipe for face detection (shared with FaceRecognizer)
+        self.model_path = model_path
+        self.engine = get_engine(model_path)
 
     def preprocess_face(self, face_img):
         """
@@ -56,10 +61,7 @@ class EmbeddingGenerator:
         - Add batch dimension.
         Returns a NumPy array ready for model input.
         """
-        face_img = cv2.resize(face_img, (112, 112))  # Resize to expected input size
-        face_img = cv2.cvtColor(face_img, cv2.COLOR_BGR2RGB)  # Convert to RGB format
-        face_img = face_img.astype("float32") / 255.0  # Normalize pixel values
-        return np.expand_dims(face_img, axis=0)  # Add batch dimension
+        return self.engine.preprocess(face_img, swap_rb=True)
 
     def get_embedding(self, face_img):
         """
@@ -68,52 +70,40 @@ class EmbeddingGenerator:
         - Runs it through the TFLite model.
         - Returns the embedding vector.
         """
-        input_data = self.preprocess_face(face_img)  # Prepare the image
-        self.interpreter.set_tensor(self.input_details[0]['index'], input_data)  # Set input
-        self.interpreter.invoke()  # Run the model
-        embedding = self.interpreter.get_tensor(self.output_details[0]['index'])[0]  # Extract output
-        return embedding  # Return the embedding vector (typically length 192)
+        return self.engine.get_embedding(face_img, swap_rb=True)  # Embedding vector (typically length 192)
+
+    def get_embeddings(self, face_imgs):
+        """
+        Generates embeddings for several face images with one invoke per batch.
+        Returns an array of embeddings (shape: [len(face_imgs), 192]).
+        """
+        return self.engine.get_embeddings(face_imgs, swap_rb=True)
 
     def detect_faces(self, frame):
         """
         Detects faces in a given video frame using MediaPipe.
-        Returns a list of bounding boxes: (x, y, width, height).
+        Returns a list of bounding boxes: (x, y, width, height),
+        clipped to the image boundaries.
         """
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  # Convert to RGB for MediaPipe
-        results = self.face_detection.process(rgb_frame)  # Perform face detection
-        faces = []
-
-        if results.detections:
-            for detection in results.detections:
-                bboxC = detection.location_data.relative_bounding_box
-                ih, iw, _ = frame.shape  # Get image height and width
-                x = int(bboxC.xmin * iw)
-                y = int(bboxC.ymin * ih)
-                w = int(bboxC.width * iw)
-                h = int(bboxC.height * ih)
-
-                # Ensure the bounding box stays within image boundaries
-                x, y = max(0, x), max(0, y)
-                w, h = min(w, iw - x), min(h, ih - y)
+        return self.engine.detect_faces(frame, clip=True)
 
-                faces.append((x, y, w, h))  # Append bounding box to list
-
-        return faces  # Return list of detected faces
-
-    def save_embedding(self, embedding, username, counter):
+    def detect_faces_preview(self, frame, timeout=None):
         """
-        Saves a face embedding to a .pkl file in the user's directory.
-        - 'username' defines the folder.
-        - 'counter' ensures multiple embeddings can be saved per user.
-        Returns the filename for reference.
+        Same as detect_faces, but with the separate preview detector pool,
+        so bounding-box previews never wait for (or delay) enrollments and logins.
+        Raises TimeoutError if no preview detector frees up within 'timeout' seconds.
         """
-        user_dir = os.path.join(self.save_base_path, username)  # Path to user folder
-        os.makedirs(user_dir, exist_ok=True)  # Create user folder if not existing
-
-        # Filename pattern: embeddings/username/username_00.pkl
-        filename = os.path.join(user_dir, f"{username}_{counter:02d}.pkl")
+        return self.engine.detect_faces(frame, clip=True, preview=True, timeout=timeout)
 
-        with open(filename, "wb") as f:
-            pickle.dump(embedding, f)  # Save embedding as a binary file
-
-        return filename  # Return the full path to the saved file
+    def save_embedding(self, embedding, username, counter=None):
+        """
+        Appends a face embedding to the packed embedding store.
+        - 'username' defines the user folder the embedding belongs to.
+        - 'counter' is kept for backwards compatibility; rows are numbered by the store.
+        With a recognizer, FaceRecognizer.save_embeddings applies the per-user cap and
+        updates its gallery.
+        Returns the row number assigned to the embedding.
+        """
+        if self.recognizer is not None:
+            return self.recognizer.save_embeddings(username, [embedding])[0]
+        return self.store.append(username, [embedding])[0]  # Row of the saved embedding
@@ -0,0 +1,332 @@
+# ============================================
+# Shared Inference Engine
+# File: inference_engine.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-05-21
+#
+# Description:
+# This module defines the InferenceEngine class and a per-process model
+# registry (get_engine). The engine owns everything model related that
+# FaceRecognizer and EmbeddingGenerator used to duplicate:
+# - The MobileFaceNet TFLite model, read from disk once per process and
+#   shared by every interpreter through 'model_content'.
+# - The pools of TFLite interpreters and MediaPipe face detectors, plus a
+#   separate small pool of detectors for bounding-box previews, so preview
+#   traffic never takes a detector from enrollments and logins.
+# - Face preprocessing, (batched) embedding generation and face detection.
+#   Preprocessing writes straight into the interpreter's input tensor through
+#   reused buffers, so the hot path allocates no temporary images.
+#
+# Both classes delegate to the engine returned by get_engine(model_path),
+# so a process that uses both loads the model and the detector only once.
+#
+# Interpreter settings are read from the environment (or .env):
+# - FACEAUTH_TFLITE_THREADS: number of CPU threads per interpreter,
+#   or 'auto' to benchmark 1..cpu_count threads at startup and keep the fastest.
+# - FACEAUTH_TFLITE_DELEGATE: 'xnnpack' (default, the runtime's built-in
+#   CPU delegate), 'none' (plain built-in kernels), or the path of an
+#   external delegate library loaded with tflite.load_delegate.
+# - FACEAUTH_BENCHMARK_RUNS: if > 0, time that many warm invokes at startup
+#   and log the per-invoke latency.
+# - FACEAUTH_PREVIEW_POOL_SIZE: number of preview detectors (default 1), i.e.
+#   how many previews can run at the same time.
+# ============================================
+
+import os  # Path handling for the registry keys and environment settings
+import threading  # Lock protecting the registry
+import time  # For the startup self-benchmark
+
+import cv2  # OpenCV for image processing
+import numpy as np  # NumPy for array operations
+import tflite_runtime.interpreter as tflite  # TensorFlow Lite runtime
+import mediapipe as mp  # MediaPipe for face detection
+from inference_pool import ResourcePool, configured_pool_size  # Pools of interpreters/detectors
+
+MAX_BATCH_SIZE = 16  # Largest batch passed to the model in a single invoke
+INPUT_SIZE = 112  # MobileFaceNet input resolution (112x112)
+WARMUP_RUNS = 2  # Untimed invokes before the self-benchmark
+PREVIEW_POOL_SIZE = max(1, int(os.getenv("FACEAUTH_PREVIEW_POOL_SIZE", 1)))  # Detectors reserved for previews
+
+_engines = {}  # Registry: absolute model path -> InferenceEngine
+_engines_lock = threading.Lock()
+
+
+def preprocess_face(image, swap_rb=False):
+    """
+    Prepares a face image for the model (allocating version):
+    - Drops the alpha channel if present
+    - Resizes to 112x112
+    - Swaps the red and blue channels if 'swap_rb' is set (BGR <-> RGB)
+    - Normalizes pixel values to [0, 1]
+    Returns a new array of shape (1, 112, 112, 3).
+    """
+    if image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)  # Convert RGBA to RGB
+    resized = cv2.resize(image, (INPUT_SIZE, INPUT_SIZE))  # Resize to expected input size
+    if swap_rb:
+        resized = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+    normalized = resized.astype('float32') / 255.0  # Normalize pixel values
+    return np.expand_dims(normalized, axis=0)  # Add batch dimension
+
+
+def preprocess_face_into(image, out, swap_rb=False, resize_buffer=None, swap_buffer=None):
+    """
+    Same result as preprocess_face, written into 'out' (a float32 112x112x3 array,
+    typically a view of the interpreter input tensor) without temporary images:
+    - The resize writes into 'resize_buffer' when it has the right shape and dtype
+    - The red/blue swap writes into 'swap_buffer' (a contiguous copy: dividing through
+      a reversed-channel view is about twice as slow as the allocating path)
+    - Normalization divides straight into 'out'
+    """
+    if image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)  # Convert RGBA to RGB (rare path)
+    resized = cv2.resize(image, (INPUT_SIZE, INPUT_SIZE), dst=resize_buffer)
+    if swap_rb:
+        resized = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=swap_buffer)
+    np.divide(resized, 255.0, out=out, dtype=np.float32)  # Normalize pixel values in float32
+    return out
+
+
+def engine_options_from_env():
+    """
+    Reads the interpreter settings from the environment.
+    Returns a dictionary with 'num_threads' (int, 'auto' or None),
+    'delegate' (str) and 'benchmark_runs' (int).
+    """
+    threads = os.getenv("FACEAUTH_TFLITE_THREADS", "").strip().lower()
+    if threads and threads != "auto":
+        threads = int(threads)
+    return {
+        "num_threads": threads or None,
+        "delegate": os.getenv("FACEAUTH_TFLITE_DELEGATE", "xnnpack").strip() or "xnnpack",
+        "benchmark_runs": int(os.getenv("FACEAUTH_BENCHMARK_RUNS", "0")),
+    }
+
+
+def get_engine(model_path):
+    """
+    Returns the process-wide engine for 'model_path', creating it on first use
+    with the settings from engine_options_from_env().
+    Relative paths are resolved against the current directory, so different
+    spellings of the same file share one engine.
+    """
+    key = os.path.realpath(model_path)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = InferenceEngine(key, **engine_options_from_env())
+            _engines[key] = engine
+        return engine
+
+
+# === Class owning the model, the interpreter/detector pools and the preprocessing ===
+class InferenceEngine:
+    def __init__(self, model_path, num_threads=None, delegate="xnnpack", benchmark_runs=0):
+        """
+        Loads the model once and prepares the pools.
+        - The model file is read into memory and shared by all interpreters.
+        - 'num_threads' sets the CPU threads per interpreter (None = runtime default,
+          'auto' = benchmark the candidates and keep the fastest).
+        - 'delegate' selects 'xnnpack', 'none' or an external delegate library path.
+        - 'benchmark_runs' > 0 logs the per-invoke latency at startup.
+        - The first interpreter is created now to read the tensor details.
+        """
+        self.model_path = model_path
+        with open(model_path, "rb") as f:
+            self.model_content = f.read()  # Shared by every interpreter (no per-interpreter copy of the file)
+        self.delegate = delegate
+        self.num_threads = num_threads
+        self._local = threading.local()  # Per-thread resize buffers
+        if num_threads == "auto":
+            self.num_threads = self._pick_num_threads(max(benchmark_runs, 10))
+
+        pool_size = configured_pool_size()
+        name = os.path.basename(model_path)
+        self.interpreter_pool = ResourcePool(self._create_interpreters, pool_size, f"interpreter:{name}")
+        self.detector_pool = ResourcePool(self._create_detector, pool_size, "detector:mediapipe")
+        self.preview_detector_pool = ResourcePool(self._create_detector, PREVIEW_POOL_SIZE, "detector:mediapipe-preview")
+
+        interpreters = self._create_interpreters()
+        self.input_details = interpreters[1].get_input_details()  # Input tensor details
+        self.output_details = interpreters[1].get_output_details()  # Output tensor details
+        self.embedding_size = int(self.output_details[0]['shape'][-1])
+        self.interpreter_pool.put(interpreters)
+
+        if benchmark_runs > 0:
+            latency = self.benchmark(benchmark_runs)
+            print(f"[INFO] {name}: {latency:.2f} ms per invoke "
+                  f"(threads={self.num_threads or 'default'}, delegate={self.delegate}, runs={benchmark_runs})")
+
+    # === Interpreter settings and self-benchmark ===
+
+    def _new_interpreter(self, num_threads=None):
+        """
+        Creates an (unallocated) interpreter with the configured threads and delegate.
+        """
+        kwargs = {"model_content": self.model_content}
+        num_threads = num_threads or self.num_threads
+        if num_threads:
+            kwargs["num_threads"] = num_threads
+        if self.delegate == "none":
+            # Disable the default (XNNPACK) delegate and use the built-in kernels only
+            kwargs["experimental_op_resolver_type"] = tflite.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+        elif self.delegate != "xnnpack":
+            kwargs["experimental_delegates"] = [tflite.load_delegate(self.delegate)]
+        return tflite.Interpreter(**kwargs)
+
+    def benchmark(self, runs, num_threads=None):
+        """
+        Times 'runs' warm invokes of a batch-1 interpreter on a blank image.
+        Returns the mean latency per invoke in milliseconds.
+        """
+        interpreter = self._new_interpreter(num_threads)
+        interpreter.allocate_tensors()
+        input_details = interpreter.get_input_details()[0]
+        interpreter.set_tensor(input_details['index'], np.zeros(input_details['shape'], dtype=np.float32))
+
+        for _ in range(WARMUP_RUNS):
+            interpreter.invoke()
+        start = time.perf_counter()
+        for _ in range(runs):
+            interpreter.invoke()
+        return 1000 * (time.perf_counter() - start) / runs
+
+    def _pick_num_threads(self, runs):
+        """
+        Benchmarks 1, 2, 4, ... up to cpu_count threads and returns the fastest count.
+        """
+        cpu_count = os.cpu_count() or 1
+        candidates = sorted({min(1 << i, cpu_count) for i in range(cpu_count.bit_length())} | {cpu_count})
+        results = {threads: self.benchmark(runs, threads) for threads in candidates}
+        for threads, latency in results.items():
+            print(f"[INFO] threads={threads}: {latency:.2f} ms per invoke")
+        return min(results, key=results.get)
+
+    # === Pool factories ===
+
+    def _create_interpreters(self):
+        """
+        Creates one pool entry: a {batch_size: interpreter} dictionary that
+        starts with a single interpreter allocated for batch size 1.
+        """
+        interpreter = self._new_interpreter()
+        interpreter.allocate_tensors()  # Prepare the model for inference
+        return {1: interpreter}
+
+    def _create_detector(self):
+        """
+        Creates one MediaPipe face detector for the detector pool.
+        """
+        return mp.solutions.face_detection.FaceDetection(
+            model_selection=0, min_detection_confidence=0.5
+        )
+
+    def _get_batch_interpreter(self, interpreters, batch_size):
+        """
+        Returns an interpreter of a checked-out pool entry whose input is resized to 'batch_size' images.
+        Interpreters are cached per batch size, so repeated batch sizes
+        never resize or reallocate tensors again.
+        """
+        interpreter = interpreters.get(batch_size)
+        if interpreter is None:
+            interpreter = self._new_interpreter()
+            interpreter.resize_tensor_input(self.input_details[0]['index'], [batch_size, INPUT_SIZE, INPUT_SIZE, 3])
+            interpreter.allocate_tensors()
+            interpreters[batch_size] = interpreter
+        return interpreter
+
+    # === Preprocessing and inference ===
+
+    def preprocess(self, image, swap_rb=False):
+        """
+        Prepares a face image for the model (see preprocess_face).
+        Returns a new array of shape (1, 112, 112, 3).
+        """
+        return preprocess_face(image, swap_rb)
+
+    def _scratch_buffer(self, dtype, name):
+        """
+        Returns this thread's reusable 112x112x3 buffer 'name' ('resize' or 'swap') for images of 'dtype'.
+        """
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        buffer = buffers.get((dtype, name))
+        if buffer is None:
+            buffer = buffers[(dtype, name)] = np.empty((INPUT_SIZE, INPUT_SIZE, 3), dtype=dtype)
+        return buffer
+
+    def _fill_input(self, interpreter, images, swap_rb):
+        """
+        Preprocesses 'images' directly into the interpreter's input tensor.
+        Rows past len(images) (batch padding) are left as they are; their outputs are ignored.
+        """
+        batch = interpreter.tensor(self.input_details[0]['index'])()  # View of the input tensor
+        for i, image in enumerate(images):
+            swap_buffer = self._scratch_buffer(image.dtype, "swap") if swap_rb else None
+            preprocess_face_into(image, batch[i], swap_rb, self._scratch_buffer(image.dtype, "resize"), swap_buffer)
+        del batch  # The interpreter refuses to invoke while a view of its buffers is alive
+
+    def get_embedding(self, image, swap_rb=False):
+        """
+        Runs one face image through the model and returns its embedding vector.
+        """
+        with self.interpreter_pool.checkout() as interpreters:
+            interpreter = interpreters[1]
+            self._fill_input(interpreter, [image], swap_rb)
+            interpreter.invoke()  # Run inference
+            return interpreter.get_tensor(self.output_details[0]['index'])[0].copy()
+
+    def get_embeddings(self, images, swap_rb=False):
+        """
+        Runs several face images through the model with one invoke per batch.
+        - Batches are padded to the next power of two (up to MAX_BATCH_SIZE),
+          so only a few batch shapes are ever compiled.
+        Returns an array of embeddings (shape: [len(images), embedding_size]).
+        """
+        embeddings = []
+        for start in range(0, len(images), MAX_BATCH_SIZE):
+            chunk = images[start:start + MAX_BATCH_SIZE]
+            batch_size = 1 << (len(chunk) - 1).bit_length()  # Next power of two
+
+            with self.interpreter_pool.checkout() as interpreters:
+                interpreter = self._get_batch_interpreter(interpreters, batch_size)
+                self._fill_input(interpreter, chunk, swap_rb)
+                interpreter.invoke()
+                embeddings.append(interpreter.get_tensor(self.output_details[0]['index'])[:len(chunk)].copy())
+
+        if not embeddings:
+            return np.empty((0, self.embedding_size), dtype=np.float32)
+        return np.concatenate(embeddings)
+
+    def detect_faces(self, frame, clip=False, preview=False, timeout=None):
+        """
+        Detects faces in a frame using MediaPipe.
+        - If 'clip' is set, boxes are clipped to the image boundaries.
+        - If 'preview' is set, a detector of the preview pool is used instead of the main pool.
+        - 'timeout': seconds to wait for a free detector (TimeoutError after that).
+        Returns a list of bounding boxes (x, y, width, height).
+        """
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  # Convert image to RGB
+        pool = self.preview_detector_pool if preview else self.detector_pool
+        with pool.checkout(timeout) as face_detection:
+            results = face_detection.process(rgb_frame)  # Run face detection
+        faces = []
+
+        if results.detections:
+            ih, iw, _ = frame.shape  # Get image dimensions
+            for detection in results.detections:
+                bboxC = detection.location_data.relative_bounding_box
+                x = int(bboxC.xmin * iw)
+                y = int(bboxC.ymin * ih)
+                w = int(bboxC.width * iw)
+                h = int(bboxC.height * ih)
+
+                if clip:
+                    # Ensure the bounding box stays within image boundaries
+                    x, y = max(0, x), max(0, y)
+                    w, h = min(w, iw - x), min(h, ih - y)
+
+                faces.append((x, y, w, h))  # Append bounding box
+
+        return faces  # List of bounding boxes of detected faces
@@ -0,0 +1,128 @@
+# ============================================
+# Inference Resource Pool
+# File: inference_pool.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-05-19
+#
+# Description:
+# This module defines the ResourcePool class, a bounded, thread-safe pool
+# of objects that cannot be shared between threads (TFLite interpreters,
+# MediaPipe face detectors).
+# - Requests check an instance out, use it, and return it.
+# - Instances are created lazily, up to the configured pool size.
+# - Wait times are recorded so contention can be monitored.
+#
+# The pool size is read from the FACEAUTH_POOL_SIZE environment variable.
+# ============================================
+
+import os  # To read the pool size from the environment
+import queue  # Thread-safe queue holding the idle instances
+import threading  # Lock protecting the counters
+import time  # To measure wait times
+from contextlib import contextmanager
+
+DEFAULT_POOL_SIZE = 2  # Instances per pool when FACEAUTH_POOL_SIZE is not set
+
+
+def configured_pool_size():
+    """
+    Returns the pool size configured through FACEAUTH_POOL_SIZE (at least 1).
+    """
+    return max(1, int(os.getenv("FACEAUTH_POOL_SIZE", DEFAULT_POOL_SIZE)))
+
+
+# === Class responsible for lending out non thread-safe instances ===
+class ResourcePool:
+    def __init__(self, factory, size, name):
+        """
+        Creates an empty pool.
+        - 'factory' builds a new instance (called at most 'size' times).
+        - 'size' bounds how many instances can be in use at the same time.
+        - 'name' identifies the pool in the metrics.
+        """
+        self.factory = factory
+        self.size = size
+        self.name = name
+        self._idle = queue.LifoQueue()  # Most recently used first (warm caches)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0  # Checkouts that had to wait for an instance
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _acquire(self, timeout):
+        """
+        Takes an idle instance, creates a new one if the pool is not full yet,
+        or waits for another request to return one.
+        """
+        try:
+            return self._idle.get_nowait(), False
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self.factory(), False
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=timeout), True
+        except queue.Empty:
+            raise TimeoutError(f"No {self.name} instance available after {timeout} s")
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        """
+        Lends an instance for the duration of the 'with' block.
+        Raises TimeoutError if none becomes available within 'timeout' seconds.
+        """
+        start = time.perf_counter()
+        resource, waited = self._acquire(timeout)
+        wait = time.perf_counter() - start
+
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._waits += int(waited)
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+
+        try:
+            yield resource
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._idle.put(resource)
+
+    def put(self, resource):
+        """
+        Adds an already created instance to the pool (counts towards its size).
+        """
+        with self._lock:
+            self._created += 1
+        self._idle.put(resource)
+
+    def stats(self):
+        """
+        Returns the pool metrics as a dictionary (times in milliseconds).
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": self.size,
+                "created": self._created,
+                "in_use": self._in_use,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_avg_ms": 1000 * self._wait_total / self._checkouts if self._checkouts else 0.0,
+                "wait_max_ms": 1000 * self._wait_max,
+            }
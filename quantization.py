@@ -0,0 +1,205 @@
+# ============================================
+# Reduced-Precision Gallery Rows
+# File: quantization.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-05-26
+#
+# Description:
+# This module defines the QuantizedRows class, a compact copy of the gallery
+# matrix used by FaceRecognizer for the coarse scan of a search:
+# - 'float16': every value stored in half precision (2 bytes instead of 4).
+# - 'int8': every row scaled by its own factor (max |value| / 127) and
+#   rounded to int8 (1 byte per value plus one float32 scale per row).
+# The coarse scan only picks the most promising users; their embeddings are
+# then rescored with the float32 rows, so reported distances stay exact.
+#
+# Every scan reads 2x (float16) or about 4x (int8) fewer bytes. The float32
+# rows that the rescoring and the prototypes need are not kept next to the
+# copy: the recognizer reads them from the memory-mapped store file, only for
+# the few rows it rescores (see MappedRows in gallery_snapshot.py), so the
+# copy is the only per-row array held in process memory.
+#
+# The precision is read from FACEAUTH_GALLERY_PRECISION
+# ('float32' (default, no quantized copy), 'float16' or 'int8').
+# ============================================
+
+import os  # To read the precision from the environment
+
+import numpy as np  # NumPy for the quantized matrix
+
+PRECISIONS = ("float16", "int8")  # Supported reduced precisions
+SCAN_CHUNK_ROWS = 4096  # Rows converted back to float32 at a time during a scan
+
+
+def precision_from_env():
+    """
+    Returns the reduced precision configured through FACEAUTH_GALLERY_PRECISION,
+    or None for full float32 precision.
+    """
+    precision = os.getenv("FACEAUTH_GALLERY_PRECISION", "float32").strip().lower()
+    if precision in ("", "float32"):
+        return None
+    if precision not in PRECISIONS:
+        raise ValueError(f"Invalid FACEAUTH_GALLERY_PRECISION: {precision} (use float32, float16 or int8)")
+    return precision
+
+
+def quantize(matrix, precision):
+    """
+    Quantizes a float32 matrix (one embedding per row).
+    Returns a tuple (codes, scales); scales is None for float16.
+    """
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float32))
+    if precision == "float16":
+        return matrix.astype(np.float16), None
+
+    scales = np.abs(matrix).max(axis=1, initial=0.0) / 127.0
+    scales[scales == 0] = 1.0  # All-zero rows
+    codes = np.rint(matrix / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize(codes, scales):
+    """
+    Converts quantized rows back to float32.
+    """
+    values = codes.astype(np.float32)
+    if scales is not None:
+        values *= scales[:, None]
+    return values
+
+
+# === Class holding the reduced-precision copy of the gallery rows ===
+class QuantizedRows:
+    def __init__(self, precision, matrix=None):
+        """
+        Creates the quantized copy ('float16' or 'int8') of 'matrix' (may be empty).
+        Rows can then be set and moved one at a time, like the gallery buffers.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unsupported precision: {precision}")
+        self.precision = precision
+        self.reset(np.empty((0, 0), dtype=np.float32) if matrix is None else matrix)
+
+    @classmethod
+    def from_arrays(cls, precision, codes, scales, norms):
+        """
+        Wraps rows quantized elsewhere (e.g. mapped from the shared gallery file).
+        The arrays may be read-only: the first change gives the rows their own buffers.
+        """
+        rows = cls.__new__(cls)
+        rows.precision, rows.size = precision, len(codes)
+        rows.codes, rows.scales, rows.norms = codes, scales, norms
+        return rows
+
+    def reset(self, matrix):
+        """
+        Replaces every row with the quantized rows of 'matrix', converted SCAN_CHUNK_ROWS
+        rows at a time ('matrix' only needs len(), .shape and slicing, e.g. a memory map
+        or the MappedRows of gallery_snapshot.py: it is never copied as a whole).
+        """
+        self.size = 0
+        self.codes = np.zeros((0, 0), dtype=np.float16 if self.precision == "float16" else np.int8)
+        self.scales = np.ones(0, dtype=np.float32)  # All ones for float16: keeps row moves uniform
+        self.norms = np.zeros(0, dtype=np.float32)
+        self._reserve(len(matrix), matrix.shape[1] if len(matrix) else 0)
+        for start in range(0, len(matrix), SCAN_CHUNK_ROWS):
+            self.extend(matrix[start:start + SCAN_CHUNK_ROWS])
+
+    def extend(self, matrix):
+        """
+        Appends the quantized rows of 'matrix'.
+        """
+        codes, scales = quantize(matrix, self.precision)
+        start, stop = self.size, self.size + len(codes)
+        self._reserve(stop, codes.shape[1])
+        self.codes[start:stop] = codes
+        if scales is not None:
+            self.scales[start:stop] = scales
+        self.norms[start:stop] = self._squared_norms(codes, scales)
+        self.size = stop
+
+    def _squared_norms(self, codes, scales):
+        values = dequantize(codes, None if self.precision == "float16" else scales)
+        return np.einsum("ij,ij->i", values, values)
+
+    def _reserve(self, rows, dim):
+        """
+        Grows the buffers geometrically so they can hold 'rows' rows.
+        """
+        if self.codes.flags.writeable and len(self.codes) >= rows and self.codes.shape[1] == dim:
+            return
+        capacity = max(rows, 2 * len(self.codes)) if self.size else rows
+        codes = np.zeros((capacity, dim), dtype=np.float16 if self.precision == "float16" else np.int8)
+        scales = np.ones(capacity, dtype=np.float32)
+        norms = np.zeros(capacity, dtype=np.float32)
+        if self.size:
+            codes[:self.size] = self.codes[:self.size]
+            scales[:self.size] = self.scales[:self.size]
+            norms[:self.size] = self.norms[:self.size]
+        self.codes, self.scales, self.norms = codes, scales, norms
+
+    def set_row(self, row, vector):
+        """
+        Quantizes 'vector' into 'row' (appending when row == size).
+        """
+        codes, scales = quantize(vector, self.precision)
+        self._reserve(row + 1, codes.shape[1])
+        self.codes[row] = codes[0]
+        if scales is not None:
+            self.scales[row] = scales[0]
+        self.norms[row] = self._squared_norms(codes, scales)[0]
+        self.size = max(self.size, row + 1)
+
+    def move(self, source, target):
+        """
+        Copies row 'source' into row 'target' (used by the swap-remove of the gallery).
+        """
+        self.codes[target] = self.codes[source]
+        self.scales[target] = self.scales[source]
+        self.norms[target] = self.norms[source]
+
+    def copy(self):
+        """
+        Returns a copy whose rows can be changed without changing this one.
+        """
+        rows = QuantizedRows.__new__(QuantizedRows)
+        rows.precision, rows.size = self.precision, self.size
+        rows.codes, rows.scales, rows.norms = self.codes.copy(), self.scales.copy(), self.norms.copy()
+        return rows
+
+    def truncate(self, size):
+        """
+        Drops the rows past 'size'.
+        """
+        self.size = size
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the quantized rows (codes, scales and norms).
+        """
+        scales = self.size * 4 if self.precision == "int8" else 0
+        return self.size * (self.codes.shape[1] * self.codes.itemsize + 4) + scales
+
+    def squared_distances(self, probe, rows=None):
+        """
+        Approximate squared Euclidean distances from 'probe' to every row (or only to 'rows'),
+        computed as |x|^2 - 2 x.q + |q|^2 in chunks (bounded float32 temporaries).
+        """
+        probe = np.asarray(probe, dtype=np.float32).ravel()
+        if rows is None:
+            distances = np.empty(self.size, dtype=np.float32)
+            for start in range(0, self.size, SCAN_CHUNK_ROWS):
+                stop = min(start + SCAN_CHUNK_ROWS, self.size)
+                distances[start:stop] = self.codes[start:stop].astype(np.float32) @ probe
+            scales, norms = self.scales[:self.size], self.norms[:self.size]
+        else:
+            distances = self.codes[rows].astype(np.float32) @ probe
+            scales, norms = self.scales[rows], self.norms[rows]
+        if self.precision == "int8":
+            distances *= scales
+        distances *= -2.0
+        distances += norms
+        distances += probe @ probe
+        return distances
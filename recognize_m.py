@@ -6,24 +6,44 @@
 #
 # Description:
 # This script defines the FaceRecognizer class, which is responsible for:
-# - Loading pre-generated face embeddings from the 'embeddings/' directory.
+# - Loading pre-generated face embeddings from the packed store in 'embeddings/'.
 # - Using the MobileFaceNet TFLite model to generate embeddings from input images.
 # - Detecting faces in real-time using MediaPipe.
 # - Comparing the embeddings of detected faces with known embeddings to identify users.
+#   Large galleries can be searched through an optional IVF index (see ann_index.py);
+#   its candidates are always re-ranked with exact distances.
+#   Otherwise users are first ranked by a per-user prototype (centroid + radius)
+#   and only the users that can still be among the closest are scanned.
+# - Scoring raw embeddings by Euclidean distance (default) or L2-normalized
+#   embeddings by dot product (FACEAUTH_SCORING=cosine, see scoring.py).
+# - Optionally mapping one read-only gallery shared by every worker process
+#   of the node (FACEAUTH_SHARED_GALLERY, see shared_gallery.py).
+# The gallery is an immutable snapshot (see gallery_snapshot.py): updates
+# build a new snapshot and publish it with one reference swap, so searches
+# never block and never see a half-updated gallery.
 #
 # Usage:
 # This file is intended to be imported and used within other scripts,
 # such as the main GUI file (main_menu_2.py).
 # ============================================
 
-import cv2  # OpenCV for image processing
 import numpy as np  # NumPy for array operations
 import os  # OS module to interact with the filesystem
-import pickle  # For loading saved face embeddings
-from picamera2 import Picamera2  # Library for accessing the Raspberry Pi camera
-import tflite_runtime.interpreter as tflite  # TensorFlow Lite runtime for running lightweight models
-import mediapipe as mp  # MediaPipe for face detection
 from time import sleep  # To introduce delays if needed
+from embedding_store import EmbeddingStore  # Packed, memory-mapped embedding storage
+from inference_engine import get_engine  # Shared model, interpreter/detector pools and preprocessing
+from ann_index import IVFIndex, ann_options_from_env  # Optional approximate nearest-neighbour index
+from quantization import QuantizedRows, precision_from_env  # Optional float16/int8 copy of the gallery
+from gallery_snapshot import GallerySnapshot, MappedRows, compute_prototypes  # Immutable gallery, replaced by reference on updates
+from shared_gallery import SharedGallery, shared_gallery_path_from_env  # Optional gallery shared by all workers
+import scoring  # Euclidean (compatibility) or cosine scoring of embeddings
+import threading  # Lock serializing gallery updates
+
+PROTOTYPE_MIN_ROWS = 256  # Smaller galleries are scanned directly (the prefilter would not pay off)
+PROTOTYPE_MARGIN = 1e-4  # Relative slack on the prototype lower bound (covers float32 rounding)
+PROTOTYPE_MAX_SCAN = 0.5  # Fall back to a full scan when the prefilter keeps more than this fraction of rows
+RESCORE_USERS = 8  # Users rescored with exact float32 distances after a coarse scan
+DEFAULT_MAX_EMBEDDINGS_PER_USER = 20  # Per-user gallery cap when FACEAUTH_MAX_EMBEDDINGS_PER_USER is not set
 
 # === Class responsible for recognizing faces ===
 class FaceRecognizer:
@@ -33,40 +53,537 @@ class FaceRecognizer:
         - Loads the TFLite model for embedding generation.
         - Initializes MediaPipe face detection.
         - Loads known embeddings from disk.
+        The model and detectors live in the shared inference engine, so they
+        are loaded once per process even when EmbeddingGenerator is also used.
+        An absolute 'embeddings_dir' (tools, tests) is used as-is; otherwise the
+        project's 'embeddings/' directory is used.
         """
-        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'face-auth'))
-        self.embeddings_dir = os.path.join(project_root, 'embeddings')
+        if os.path.isabs(embeddings_dir):
+            self.embeddings_dir = embeddings_dir
+        else:
+            project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'face-auth'))
+            self.embeddings_dir = os.path.join(project_root, 'embeddings')
         print("FIXED: embeddings_dir =", self.embeddings_dir)
 
         self.threshold = threshold  # Threshold for distance comparison (lower = more strict)
-        self.interpreter = tflite.Interpreter(model_path="../models/mobilefacenet.tflite")
-        self.interpreter.allocate_tensors()  # Prepare the model for inference
-        self.input_details = self.interpreter.get_input_details()  # Get input tensor details
-        self.output_details = self.interpreter.get_output_details()  # Get output tensor details
-        self.face_detection = mp.solutions.face_detection.FaceDetection(
-            model_selection=0, min_detection_confidence=0.5
-        )  # Load MediaPipe face detector
+        self.max_embeddings_per_user = int(os.getenv("FACEAUTH_MAX_EMBEDDINGS_PER_USER", DEFAULT_MAX_EMBEDDINGS_PER_USER))  # 0 = no cap
+        self.scoring = scoring.scoring_mode_from_env()  # 'euclidean' (compatibility) or 'cosine'
+        self._fixed_reference_norm = scoring.reference_norm_from_env()
+        self.model_path = "../models/mobilefacenet.tflite"
+        self.engine = get_engine(self.model_path)  # Shared TFLite model and MediaPipe detectors
+        self._gallery_lock = threading.RLock()  # Serializes gallery writers (sync, save, delete); readers never take it
+        self.ann_options = ann_options_from_env()  # None when the ANN index is disabled
+        self.precision = precision_from_env()  # None for plain float32 scans
         print("DEBUG: embeddings_dir =", self.embeddings_dir)
-        self.known_embeddings = self.load_known_embeddings()  # Load embeddings from disk
+        self.store = EmbeddingStore(self.embeddings_dir)  # Packed embedding file (imports legacy .pkl once)
+        shared_path = shared_gallery_path_from_env(self.embeddings_dir)
+        self.shared_gallery = SharedGallery(shared_path) if shared_path else None  # None = private gallery
+        self.reload_gallery()  # Memory-map the known embeddings from disk
+
+    @property
+    def known_embeddings(self):
+        """
+        Dictionary of known embeddings ({user_folder: [embedding, ...]}) of the current snapshot.
+        Treat it as read-only: updates publish a new snapshot with a new dictionary.
+        """
+        return self.gallery.known
+
+    @known_embeddings.setter
+    def known_embeddings(self, known):
+        """
+        Replaces the known embeddings: builds a new snapshot and publishes it,
+        so routes that reassign this attribute keep the matrix in sync.
+        """
+        matrix, labels, users = self.build_gallery(known)
+        with self._gallery_lock:
+            self._set_gallery(matrix, labels, users)
+
+    # === Read-only views of the current snapshot ===
+
+    @property
+    def gallery_matrix(self):
+        return self.gallery.matrix
+
+    @property
+    def gallery_labels(self):
+        return self.gallery.labels
+
+    @property
+    def gallery_norms(self):
+        return self.gallery.norms
+
+    @property
+    def gallery_users(self):
+        return self.gallery.users
+
+    @property
+    def ann_index(self):
+        return self.gallery.ann_index
+
+    @property
+    def quantized(self):
+        return self.gallery.quantized
+
+    @property
+    def reference_norm(self):
+        return self.gallery.reference_norm
+
+    @staticmethod
+    def build_gallery(known_embeddings):
+        """
+        Packs a {user_folder: [embedding, ...]} dictionary into:
+        - A contiguous float32 matrix with one embedding per row (shape: [N, D])
+        - A parallel int32 label array with the user index of each row (shape: [N])
+        - The list of user folders that the labels index into
+        """
+        users = []
+        rows = []
+        labels = []
+        for name, embeddings_list in known_embeddings.items():
+            if len(embeddings_list) == 0:
+                continue
+            label = len(users)
+            users.append(name)
+            for known_emb in embeddings_list:
+                rows.append(np.asarray(known_emb, dtype=np.float32).ravel())
+                labels.append(label)
+
+        if not rows:
+            return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int32), users
+
+        matrix = np.ascontiguousarray(np.vstack(rows), dtype=np.float32)
+        return matrix, np.asarray(labels, dtype=np.int32), users
 
     def load_known_embeddings(self):
         """
         Loads all embeddings previously saved to disk.
         Returns a dictionary where keys are usernames and values are lists of embeddings.
         """
-        known = {}
-        for user_folder in os.listdir(self.embeddings_dir):
-            user_path = os.path.join(self.embeddings_dir, user_folder)
-            if os.path.isdir(user_path):  # Ensure it's a directory
-                for file in os.listdir(user_path):
-                    if file.endswith(".pkl"):  # Only load .pkl files
-                        path = os.path.join(user_path, file)
-                        with open(path, "rb") as f:
-                            embedding = pickle.load(f)  # Load the embedding
-                            if user_folder not in known:
-                                known[user_folder] = []  # Initialize list for user
-                            known[user_folder].append(embedding)  # Add embedding to the user
-        return known  # Return dictionary of all known embeddings
+        return self.store.load_known_embeddings()
+
+    def reload_gallery(self):
+        """
+        Reloads the gallery from the packed store without copying it:
+        the gallery matrix is the memory-mapped file itself and the
+        known_embeddings dictionary holds row views into it.
+        With FACEAUTH_GALLERY_PRECISION, the snapshot is compact: only the float16/int8
+        rows are built in memory and the float32 rows are read from the file on demand
+        (removed rows are skipped through row numbers instead of a copy).
+        With FACEAUTH_SHARED_GALLERY, the shared gallery file is mapped instead.
+        """
+        with self._gallery_lock:
+            stamp = self.store.stamp()  # Taken before reading, so a concurrent write is seen by the next sync
+            if self.shared_gallery is not None:
+                self._load_shared_gallery(stamp)
+                return
+
+            if self.precision:
+                index, source, rows, labels, users = self.store.read_gallery(mapped=True)
+                self._set_gallery(source, labels, users, source_rows=rows)
+            else:
+                index, matrix, labels, users = self.store.read_gallery()
+                self._set_gallery(matrix, labels, users)
+            self._store_stamp = stamp
+            self._store_generation = index["generation"]
+            self._store_compactions = index["compactions"]
+
+    def sync_gallery(self, wait=False):
+        """
+        Brings the in-memory gallery up to date with the packed store, which
+        may have been changed by another worker process.
+        - The check is a single stat of the store index.
+        - When it changed, only the new changes are replayed (added rows are
+          read from the memory-mapped matrix, removed users are dropped).
+        - A full reload only happens after a compaction of the store.
+        - With a shared gallery, the new version of the shared file is mapped
+          instead (built once for all workers, see _load_shared_gallery).
+        - Searches do not wait for a sync already running in another thread
+          (wait=False): they search the current snapshot meanwhile, and only the
+          thread holding the gallery lock replays the changes and swaps the snapshot.
+          wait=True blocks until the gallery is up to date.
+        Returns True if the gallery changed.
+        """
+        stamp = self.store.stamp()
+        if stamp == self._store_stamp:
+            return False
+
+        if not self._gallery_lock.acquire(blocking=wait):
+            return False  # Another thread is syncing (or writing): keep the current snapshot
+        try:
+            if self.shared_gallery is None:
+                return self._apply_store_changes(stamp)
+            if stamp == self._store_stamp:
+                return False  # Another thread synced while we waited for the lock
+            self._load_shared_gallery(stamp)
+            return True
+        finally:
+            self._gallery_lock.release()
+
+    def _load_shared_gallery(self, stamp):
+        """
+        Maps the version of the shared gallery file that matches the store 'stamp'.
+        If no worker has built it yet, builds it from the store and publishes it
+        (under the file lock, so every other worker then only maps it).
+        The quantized copy, the IVF index and the per-user prototypes are mapped from
+        the file too, so they are only built by the publishing worker.
+        """
+        version = [stamp, self.scoring, self.precision, self.ann_options]
+        gallery = self.shared_gallery.open(version)
+        if gallery is None:
+            with self.shared_gallery.locked():
+                gallery = self.shared_gallery.open(version)  # Another worker may have built it meanwhile
+                if gallery is None:
+                    self._publish_shared_gallery(version)
+                    gallery = self.shared_gallery.open(version)
+
+        matrix, labels, norms, arrays, meta = gallery
+        quantized = ann_index = prototypes = None
+        if "quantized_codes" in arrays:
+            quantized = QuantizedRows.from_arrays(self.precision, arrays["quantized_codes"],
+                                                  arrays["quantized_scales"], arrays["quantized_norms"])
+        if "ivf_centroids" in arrays:
+            ann_index = IVFIndex.from_assignment(arrays["ivf_centroids"], arrays["ivf_assignment"],
+                                                 meta["ivf_trained_rows"], nprobe=self.ann_options["nprobe"])
+        if "prototype_centroids" in arrays:
+            prototypes = (arrays["prototype_centroids"], arrays["prototype_radii"],
+                          arrays["prototype_counts"], arrays["prototype_alive"])
+        self._set_gallery(matrix, labels, meta["users"], norms=norms, reference_norm=meta["reference_norm"],
+                          quantized=quantized, ann_index=ann_index, prototypes=prototypes)
+        self._store_stamp = stamp
+        self._store_generation = meta["generation"]
+        self._store_compactions = meta["compactions"]
+
+    def _publish_shared_gallery(self, version):
+        """
+        Builds the gallery from the packed store, in the scoring space
+        (L2-normalized rows in cosine mode), with its quantized copy and IVF index
+        (when enabled) and the per-user prototypes, and writes it to the shared file.
+        """
+        index, matrix, labels, users = self.store.read_gallery()
+        reference_norm = None
+        if self.scoring == "cosine":
+            reference_norm = scoring.median_norm(matrix) if len(matrix) else None
+            matrix = scoring.l2_normalize(matrix)
+
+        centroids, radii, counts, alive = compute_prototypes(matrix, labels, len(users))
+        arrays = dict(prototype_centroids=centroids, prototype_radii=radii, prototype_counts=counts,
+                      prototype_alive=alive)
+        ivf_trained_rows = None
+        if self.precision and len(matrix):
+            quantized = QuantizedRows(self.precision, matrix)
+            arrays.update(quantized_codes=quantized.codes, quantized_scales=quantized.scales,
+                          quantized_norms=quantized.norms)
+        if self.ann_options is not None and len(matrix) >= self.ann_options["min_rows"]:
+            ann_index = IVFIndex(matrix, nprobe=self.ann_options["nprobe"])
+            arrays.update(ivf_centroids=ann_index.centroids, ivf_assignment=ann_index.assignment())
+            ivf_trained_rows = ann_index.trained_rows
+
+        self.shared_gallery.publish(version, matrix, labels, scoring.squared_norms(matrix), arrays=arrays,
+                                    users=users, generation=index["generation"], compactions=index["compactions"],
+                                    reference_norm=reference_norm, ivf_trained_rows=ivf_trained_rows)
+        print(f"[INFO] Published shared gallery ({len(matrix)} embeddings) to {self.shared_gallery.path}")
+
+    def _apply_store_changes(self, stamp):
+        """
+        Replays the store changes made since the last sync (called with the gallery lock held).
+        """
+        if stamp == self._store_stamp:
+            return False  # Another thread synced while we waited for the lock
+
+        index, changes = self.store.changes_since(self._store_generation, self._store_compactions)
+        if changes is None:
+            self.reload_gallery()
+            return True
+
+        gallery = self.gallery.edit()
+        try:
+            if gallery.compact:
+                gallery.remap(self.store.map_matrix(index))  # Includes the appended rows
+            for change in changes:
+                if change[1] == "add":
+                    _, _, folder, first_row, count = change
+                    for offset, vector in enumerate(self.store.read_rows(index, first_row, count)):
+                        source_row = first_row + offset if gallery.compact else None
+                        self._add_to(gallery, folder, np.array(vector), source_row=source_row)
+                elif change[1] == "remove":
+                    gallery.remove(change[2])
+        except FileNotFoundError:
+            # The store was compacted twice since 'index' was read: its row numbers are gone
+            self.reload_gallery()
+            return True
+        gallery.refresh_prototypes()  # Here, so searches on the new snapshot never compute them
+        self.gallery = gallery  # Publish every replayed change at once
+
+        self._store_stamp = stamp
+        self._store_generation = index["generation"]
+        return bool(changes)
+
+    def save_embeddings(self, folder, embeddings):
+        """
+        Appends embeddings for 'folder' to the packed store and adds them to
+        the in-memory gallery (replayed from the store, so changes made by
+        other workers in the meantime are picked up in the same order).
+        - If the user would exceed FACEAUTH_MAX_EMBEDDINGS_PER_USER, the new
+          embeddings are kept and the most redundant old ones are dropped
+          (see select_diverse), so the user's gallery size stays fixed.
+        Returns the list of rows assigned by the store to the new embeddings.
+        """
+        embeddings = [np.asarray(embedding, dtype=np.float32).ravel() for embedding in embeddings]
+        if not embeddings:
+            return []
+        with self._gallery_lock:
+            if self.max_embeddings_per_user:
+                rows = self._save_capped(folder, embeddings)
+            else:
+                rows = self.store.append(folder, embeddings)
+            self.sync_gallery(wait=True)
+        return rows
+
+    def _save_capped(self, folder, embeddings):
+        """
+        Saves the new embeddings under the per-user cap, in a single store commit.
+        The stored embeddings are read, and the diverse subset of (stored + new)
+        embeddings seeded with the new ones is picked, under the store lock, so a
+        concurrent save by another worker cannot be overwritten.
+        Returns the rows of the new embeddings that were kept.
+        """
+        kept_new = []  # For each returned embedding: True if it is one of the new ones
+
+        def select(stored):
+            if len(stored) + len(embeddings) <= self.max_embeddings_per_user:
+                kept_new.extend([True] * len(embeddings))
+                return embeddings, False  # Below the cap: plain append
+
+            pool = list(stored) + embeddings
+            seeds = list(range(len(stored), len(pool)))
+            kept = self.select_diverse(np.array([self.normalize(vector) for vector in pool]),
+                                       self.max_embeddings_per_user, seeds)
+            print(f"[INFO] {folder}: keeping {len(kept)} of {len(pool)} embeddings "
+                  f"(cap {self.max_embeddings_per_user})")
+            kept_new.extend(i >= len(stored) for i in kept)
+            return [pool[i] for i in kept], True
+
+        rows = self.store.update_user(folder, select)
+        return [row for row, new in zip(rows, kept_new) if new]
+
+    @staticmethod
+    def select_diverse(vectors, count, seeds=()):
+        """
+        k-center greedy selection: starting from 'seeds' (or the first vector),
+        repeatedly picks the vector farthest from everything picked so far.
+        The vectors left out are the ones closest to a picked vector, i.e. the
+        most redundant, so the picked subset keeps the coverage of the whole set.
+        When there are more seeds than 'count' (a batch larger than the cap),
+        the selection runs over the seeds only.
+        Returns the sorted indices of the 'count' picked vectors.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) <= count:
+            return list(range(len(vectors)))
+
+        seeds = list(seeds)
+        if len(seeds) > count:
+            picked = FaceRecognizer.select_diverse(vectors[seeds], count)
+            return sorted(seeds[i] for i in picked)
+
+        selected = seeds or [0]
+        nearest = np.full(len(vectors), np.inf, dtype=np.float32)  # Distance to the closest picked vector
+        for index in selected:
+            nearest = np.minimum(nearest, np.linalg.norm(vectors - vectors[index], axis=1))
+        nearest[selected] = -np.inf
+
+        while len(selected) < count:
+            index = int(np.argmax(nearest))
+            selected.append(index)
+            nearest = np.minimum(nearest, np.linalg.norm(vectors - vectors[index], axis=1))
+            nearest[index] = -np.inf
+        return sorted(selected)
+
+    def delete_user(self, folder):
+        """
+        Removes every embedding of 'folder' from the packed store and from the in-memory gallery.
+        Returns the number of removed embeddings.
+        """
+        with self._gallery_lock:
+            removed = self.store.remove_user(folder)
+            self.sync_gallery(wait=True)
+        return removed
+
+    # === Gallery mutators (thin wrappers: every change goes through the packed store) ===
+
+    def add_embedding(self, folder, embedding):
+        """
+        Adds one embedding for 'folder' (see save_embeddings, including the per-user cap).
+        Returns the row assigned by the store.
+        """
+        return self.save_embeddings(folder, [embedding])[0]
+
+    def remove_user(self, folder):
+        """
+        Removes every embedding of 'folder' (see delete_user).
+        Returns the number of removed embeddings.
+        """
+        return self.delete_user(folder)
+
+    def replace_user(self, folder, embeddings):
+        """
+        Replaces all embeddings of 'folder' with the given list of embeddings in one
+        store commit, then brings the in-memory gallery up to date.
+        Returns the list of rows assigned by the store to the new embeddings.
+        """
+        embeddings = [np.asarray(embedding, dtype=np.float32).ravel() for embedding in embeddings]
+        with self._gallery_lock:
+            rows = self.store.replace_user(folder, embeddings)
+            self.sync_gallery(wait=True)
+        return rows
+
+    def _set_gallery(self, matrix, labels, users, norms=None, reference_norm=None, quantized=None, ann_index=None,
+                     source_rows=None, prototypes=None):
+        """
+        Builds a snapshot of a full gallery and publishes it (called with the gallery lock held).
+        In cosine mode the rows are L2-normalized here, once, and the reference norm is
+        the median norm of the raw rows. When 'norms' is given (shared gallery), the rows
+        are already in the scoring space and 'reference_norm' comes with them, as well as
+        the prebuilt 'quantized' copy, 'ann_index' and 'prototypes' (None: built by the snapshot).
+        With 'source_rows' (compact snapshot), 'matrix' is the store matrix and stays
+        raw: rows are normalized when they are read.
+        """
+        if source_rows is not None:
+            if self.scoring == "cosine" and len(source_rows) and self._fixed_reference_norm is None:
+                reference_norm = scoring.median_norm(MappedRows(matrix, source_rows))
+        elif self.scoring == "cosine" and norms is None:
+            if len(matrix) and self._fixed_reference_norm is None:
+                reference_norm = scoring.median_norm(matrix)
+            matrix = scoring.l2_normalize(matrix)
+        pending = self.scoring == "cosine" and reference_norm is None and self._fixed_reference_norm is None
+
+        self.gallery = GallerySnapshot(matrix, labels, users, norms=norms, precision=self.precision,
+                                       ann_options=self.ann_options,
+                                       reference_norm=self._fixed_reference_norm or reference_norm or 1.0,
+                                       reference_pending=pending, quantized=quantized, ann_index=ann_index,
+                                       source_rows=source_rows, normalize_rows=self.scoring == "cosine",
+                                       prototypes=prototypes)
+
+    def _prototype_distances(self, gallery, probe, k):
+        """
+        Two-stage search: returns the per-user minimum distances of (at least) the k closest users.
+        - By the triangle inequality, no embedding of a user is closer to the probe
+          than d(probe, centroid) - radius, a lower bound computed for every user at once.
+        - The users with the lowest bounds are scanned first; then every user whose
+          bound is below the k-th best exact distance found so far is scanned too.
+          Any other user is provably farther than the current top k, so the
+          result equals a full scan.
+        - With FACEAUTH_GALLERY_PRECISION, the candidate users are scanned with the
+          float16/int8 rows instead and, as in _coarse_distances, only the RESCORE_USERS
+          (at least 2k) closest of them are rescored in float32: reported distances stay
+          exact, the choice of users is approximate like the coarse scan's.
+        - When the bound prunes too little, the whole gallery is scanned directly.
+        Returns None in that case; users that were not scanned keep an infinite distance.
+        """
+        coarse = gallery.quantized is not None
+        users = len(gallery.users)
+        centroid_distances = np.sqrt(((gallery.prototype_centroids[:users] - probe) ** 2).sum(axis=1))
+        radii = gallery.prototype_radii[:users]
+        bounds = centroid_distances - radii - PROTOTYPE_MARGIN * (centroid_distances + radii + 1.0)
+        bounds[~gallery.prototype_alive[:users]] = np.inf  # Slots of removed users
+
+        user_distances = np.full(users, np.inf, dtype=np.float32)
+
+        # Stage 1: the most promising users
+        first = min(max(2 * k, 8), int(np.isfinite(bounds).sum()))
+        promising = np.argpartition(bounds, first - 1)[:first]
+        self._scan_users(gallery, probe, promising, user_distances, coarse)
+
+        # Stage 2: every other user that could still beat the k-th best distance
+        kth_distance = np.partition(user_distances, k - 1)[k - 1]
+        remaining = bounds < kth_distance
+        remaining[promising] = False
+        if gallery.prototype_counts[:users][remaining].sum() > PROTOTYPE_MAX_SCAN * gallery.size:
+            return None
+        if remaining.any():
+            self._scan_users(gallery, probe, np.flatnonzero(remaining), user_distances, coarse)
+        if coarse:
+            user_distances = self._rescore(gallery, probe, user_distances, k)
+        return user_distances
+
+    def _scan_users(self, gallery, probe, labels, user_distances, coarse=False):
+        """
+        Computes the distances to every embedding of the users in 'labels' and stores
+        each user's minimum in 'user_distances': exact (float32) distances, or approximate
+        ones from the float16/int8 rows when 'coarse' is set.
+        """
+        rows = np.concatenate([gallery.user_rows[gallery.users[label]] for label in labels])
+        if coarse:
+            distances = np.sqrt(np.maximum(gallery.quantized.squared_distances(probe, rows), 0.0))
+        else:
+            distances = np.linalg.norm(gallery.matrix[rows] - probe, axis=1)
+        np.minimum.at(user_distances, gallery.labels[rows], distances)
+
+    def _rescore(self, gallery, probe, approximate, k):
+        """
+        Rescores the RESCORE_USERS (at least 2k) users with the smallest approximate distances
+        with exact float32 distances; the other users get an infinite distance.
+        """
+        count = min(max(RESCORE_USERS, 2 * k), int(np.isfinite(approximate).sum()))
+        candidates = np.argpartition(approximate, count - 1)[:count]
+
+        user_distances = np.full(len(gallery.users), np.inf, dtype=np.float32)
+        self._scan_users(gallery, probe, candidates, user_distances)
+        return user_distances
+
+    def _coarse_distances(self, gallery, probe, k):
+        """
+        Coarse scan of the whole gallery, then exact rescoring:
+        - Each user gets an approximate minimum distance from one matrix-vector
+          product with the precomputed row norms (|x|^2 - 2 x.q + |q|^2), or from
+          the float16/int8 copy when FACEAUTH_GALLERY_PRECISION is set.
+        - The RESCORE_USERS (at least 2k) closest users are rescored with the
+          same exact distances as before, so the threshold decisions do not change;
+          the other users keep an infinite distance.
+        """
+        if gallery.quantized is not None:
+            squared = gallery.quantized.squared_distances(probe)
+        else:
+            squared = scoring.squared_distances(gallery.matrix, gallery.norms, probe)
+        approximate = np.full(len(gallery.users), np.inf, dtype=np.float32)
+        np.minimum.at(approximate, gallery.labels, squared)
+        return self._rescore(gallery, probe, approximate, k)
+
+    # === Scoring mode helpers ===
+
+    def normalize(self, embedding):
+        """
+        Returns the embedding as a flat float32 vector, L2-normalized in cosine mode.
+        """
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        return scoring.l2_normalize(vector) if self.scoring == "cosine" else vector
+
+    def distance(self, embedding_a, embedding_b):
+        """
+        Distance between two embeddings in the current scoring mode
+        (compare it with translate_threshold(...) of a Euclidean threshold).
+        """
+        return float(np.linalg.norm(self.normalize(embedding_a) - self.normalize(embedding_b)))
+
+    def translate_threshold(self, threshold):
+        """
+        Converts a threshold on raw Euclidean distances to the current scoring mode:
+        unchanged in euclidean mode, divided by the reference norm in cosine mode.
+        """
+        return threshold / self.reference_norm if self.scoring == "cosine" else threshold
+
+    # === Incremental gallery updates (replayed from the store, see _apply_store_changes) ===
+
+    def _add_to(self, gallery, folder, embedding, source_row=None):
+        """
+        Adds one embedding to a snapshot being edited, in the scoring space
+        ('source_row': its store row, for compact snapshots).
+        """
+        if self.scoring == "cosine" and gallery.reference_pending:
+            # Empty gallery so far: take the reference norm from the first embedding
+            gallery.reference_norm = float(np.linalg.norm(embedding)) or 1.0
+            gallery.reference_pending = False
+        gallery.add(folder, self.normalize(embedding), source_row=source_row)
 
     def preprocess_image(self, image):
         """
@@ -76,20 +593,20 @@ class FaceRecognizer:
         - Normalizes pixel values to [0, 1]
         - Expands dimensions to match model input
         """
-        if image.shape[2] == 4:
-            image = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)  # Convert RGBA to RGB
-        resized = cv2.resize(image, (112, 112))  # Resize to expected input size
-        normalized = resized.astype('float32') / 255.0  # Normalize pixel values
-        return np.expand_dims(normalized, axis=0)  # Add batch dimension (1, 112, 112, 3)
+        return self.engine.preprocess(image)
 
     def get_embedding(self, image):
         """
         Runs the image through the TFLite model and returns the resulting embedding vector.
         """
-        input_data = self.preprocess_image(image)  # Preprocess input
-        self.interpreter.set_tensor(self.input_details[0]['index'], input_data)  # Set input tensor
-        self.interpreter.invoke()  # Run inference
-        return self.interpreter.get_tensor(self.output_details[0]['index'])[0]  # Return the embedding (shape: [192])
+        return self.engine.get_embedding(image)  # Return the embedding (shape: [192])
+
+    def get_embeddings(self, images):
+        """
+        Runs several face images through the TFLite model with one invoke per batch.
+        Returns an array of embeddings (shape: [len(images), 192]).
+        """
+        return self.engine.get_embeddings(images)
 
     def recognize_face(self, embedding, known_embeddings):
         """
@@ -99,37 +616,96 @@ class FaceRecognizer:
         - The distance to that match
         Otherwise returns ("Unknown", None)
         """
-        best_match = "Unknown"
-        best_distance = float('inf')  # Start with a very large distance
+        best_match, best_distance, _ = self.search(embedding, k=1, known_embeddings=known_embeddings)
+        return best_match, best_distance
 
-        # This should use `known_embeddings`, not `self.known_embeddings`
-        for name, embeddings_list in known_embeddings.items():
-            for known_emb in embeddings_list:
-                distance = np.linalg.norm(embedding - known_emb)  # Euclidean distance
-                if distance < best_distance:
-                    best_distance = distance
-                    best_match = name
+    def search(self, embedding, k=3, known_embeddings=None, nprobe=None):
+        """
+        Scans the gallery once and returns the best match plus the k closest users.
+        - Each user is scored by the minimum distance over all of their embeddings.
+        - The top-k users are found with a partial selection (no full sort).
+        - When the ANN index is active, only the rows of the 'nprobe' closest
+          clusters are scored (exact distances, so the threshold keeps its meaning).
+        - Otherwise, large galleries go through the per-user prototype prefilter,
+          which returns exactly the same users and distances as a full scan
+          (with FACEAUTH_GALLERY_PRECISION, it scans the candidate users' float16/int8
+          rows and rescores the closest ones, like the coarse scan).
+        - Otherwise, a coarse scan (one matrix-vector product with precomputed norms,
+          or the float16/int8 copy) picks the users that are rescored exactly.
+        - Distances and the threshold follow the scoring mode (see scoring.py).
+        Returns a tuple (name, distance, top_k):
+        - name/distance follow the recognize_face contract ("Unknown", None when above threshold)
+        - top_k is a list of (user_folder, distance) sorted by increasing distance
+        """
+        probe = self.normalize(embedding)
+
+        # Reuse the cached gallery matrix when matching against our own embeddings
+        gallery = None
+        if known_embeddings is None or known_embeddings is self.gallery.known:
+            self.sync_gallery()  # Pick up enrollments made by other worker processes
+            gallery = self.gallery  # One snapshot for the whole search, even if a writer publishes a new one
+            matrix, labels, users = gallery.matrix, gallery.labels, gallery.users
+            if gallery.ann_index is not None:
+                # Exact re-rank of the candidate rows proposed by the index
+                candidates = gallery.ann_index.candidates(probe, nprobe)
+                matrix, labels = matrix[candidates], labels[candidates]
+        else:
+            matrix, labels, users = self.build_gallery(known_embeddings)
+            if self.scoring == "cosine":
+                matrix = scoring.l2_normalize(matrix)
+
+        if len(matrix) == 0:
+            return "Unknown", None, []
+
+        k = max(1, min(k, len(users)))
+        user_distances = None
+        full_gallery = gallery is not None and matrix is gallery.matrix  # Not narrowed by the ANN index
+        if full_gallery and len(matrix) >= PROTOTYPE_MIN_ROWS:
+            # Rank users by prototype first and scan only the promising ones (exact result)
+            user_distances = self._prototype_distances(gallery, probe, k)
+        if user_distances is None and full_gallery:
+            # One matrix-vector product (or a float16/int8 scan), then exact rescoring of the closest users
+            user_distances = self._coarse_distances(gallery, probe, k)
+        if user_distances is None:
+            # Euclidean distance to every known embedding in a single vectorized operation
+            distances = np.linalg.norm(matrix - probe, axis=1)
+
+            # Minimum distance per user (labels index into `users`)
+            user_distances = np.full(len(users), np.inf, dtype=np.float32)
+            np.minimum.at(user_distances, labels, distances)
+
+        # Partial selection of the k closest users, then sort only those k
+        closest = np.argpartition(user_distances, k - 1)[:k]
+        closest = closest[np.argsort(user_distances[closest])]
+        top_k = [(users[i], float(user_distances[i])) for i in closest if np.isfinite(user_distances[i])]  # Skip slots of removed users
 
         # Return best match only if it's below the threshold
-        return (best_match, best_distance) if best_distance < self.threshold else ("Unknown", None)
+        best_match, best_distance = top_k[0]
+        if best_distance < self.translate_threshold(self.threshold):
+            return best_match, best_distance, top_k
+        return "Unknown", None, top_k
+
+    def verify(self, folder, embedding):
+        """
+        1:1 verification: compares the embedding only with the embeddings of 'folder'
+        (O(embeddings of that user) instead of a scan of the whole gallery).
+        Returns a tuple (verified, distance):
+        - verified: True if the closest embedding of the user is below the threshold
+        - distance: that closest distance, or None if the user has no embeddings
+        """
+        self.sync_gallery()  # Pick up enrollments made by other worker processes
+        gallery = self.gallery
+        rows = gallery.user_rows.get(folder)
+        if not rows:
+            return False, None
+
+        probe = self.normalize(embedding)
+        distance = float(np.linalg.norm(gallery.matrix[rows] - probe, axis=1).min())
+        return distance < self.translate_threshold(self.threshold), distance
 
     def detect_faces(self, frame):
         """
         Detects faces in a given frame using MediaPipe.
         Returns a list of bounding boxes (x, y, width, height).
         """
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  # Convert image to RGB
-        results = self.face_detection.process(rgb_frame)  # Run face detection
-        faces = []
-
-        if results.detections:
-            for detection in results.detections:
-                bboxC = detection.location_data.relative_bounding_box
-                ih, iw, _ = frame.shape  # Get image dimensions
-                x = int(bboxC.xmin * iw)
-                y = int(bboxC.ymin * ih)
-                w = int(bboxC.width * iw)
-                h = int(bboxC.height * ih)
-                faces.append((x, y, w, h))  # Append bounding box
-
-        return faces  # List of bounding boxes of detected faces
+        return self.engine.detect_faces(frame)  # List of bounding boxes of detected faces
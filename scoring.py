@@ -0,0 +1,84 @@
+# ============================================
+# Embedding Scoring Helpers
+# File: scoring.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-05-28
+#
+# Description:
+# Helpers shared by FaceRecognizer, the web routes and the tools to compare
+# embeddings in one of two scoring modes (FACEAUTH_SCORING):
+# - 'euclidean' (default, compatibility mode): raw embeddings and the
+#   original Euclidean thresholds, so decisions are the same as before.
+# - 'cosine': embeddings are L2-normalized once, when they enter the gallery,
+#   and compared with a single dot product (|a - b|^2 = 2 - 2 a.b).
+#   The Euclidean thresholds are translated to unit vectors by dividing
+#   them by a reference embedding norm: FACEAUTH_REFERENCE_NORM, or the
+#   median norm of the gallery when it is not set.
+# ============================================
+
+import os  # To read the scoring settings from the environment
+
+import numpy as np  # NumPy for the vector operations
+
+SCORING_MODES = ("euclidean", "cosine")
+NORM_CHUNK_ROWS = 4096  # Rows read at a time when computing row norms
+
+
+def scoring_mode_from_env():
+    """
+    Returns the scoring mode configured through FACEAUTH_SCORING.
+    """
+    mode = os.getenv("FACEAUTH_SCORING", "euclidean").strip().lower() or "euclidean"
+    if mode not in SCORING_MODES:
+        raise ValueError(f"Invalid FACEAUTH_SCORING: {mode} (use euclidean or cosine)")
+    return mode
+
+
+def reference_norm_from_env():
+    """
+    Returns the reference embedding norm set through FACEAUTH_REFERENCE_NORM, or None.
+    """
+    value = os.getenv("FACEAUTH_REFERENCE_NORM", "").strip()
+    return float(value) if value else None
+
+
+def l2_normalize(vectors):
+    """
+    Scales each row (or a single vector) to unit length; zero vectors are left unchanged.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0).astype(np.float32)
+
+
+def squared_norms(matrix):
+    """
+    Squared length of every row (precomputed once per gallery row), computed
+    NORM_CHUNK_ROWS rows at a time: 'matrix' may be a memory map or the MappedRows
+    of gallery_snapshot.py, which is then read in chunks instead of copied whole.
+    """
+    norms = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), NORM_CHUNK_ROWS):
+        chunk = np.asarray(matrix[start:start + NORM_CHUNK_ROWS], dtype=np.float32)
+        norms[start:start + len(chunk)] = np.einsum("ij,ij->i", chunk, chunk)
+    return norms
+
+
+def squared_distances(matrix, norms, probe):
+    """
+    Squared Euclidean distances from 'probe' to every row of 'matrix' with one
+    matrix-vector product: |x|^2 - 2 x.q + |q|^2, using the precomputed row norms.
+    """
+    distances = matrix @ probe
+    distances *= -2.0
+    distances += norms
+    distances += probe @ probe
+    return distances
+
+
+def median_norm(matrix):
+    """
+    Median row length of 'matrix' (the typical norm of a raw embedding), read in chunks
+    like squared_norms.
+    """
+    return float(np.median(np.sqrt(squared_norms(matrix))))
@@ -0,0 +1,164 @@
+# ============================================
+# Shared Gallery File
+# File: shared_gallery.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-06-05
+#
+# Description:
+# This module defines the SharedGallery class, which lets every worker
+# process of a node (e.g. preforked gunicorn workers) map ONE read-only
+# copy of the gallery instead of each building its own:
+# - The gallery (rows already in the scoring space, labels and squared norms)
+#   is written once to a file in /dev/shm (RAM-backed), next to a small
+#   header with a format version and a JSON metadata block.
+# - Structures derived from the rows (the float16/int8 copy, the IVF
+#   centroids and cluster assignments, the per-user prototypes) are stored as
+#   extra named arrays, so they are also built once by the publishing worker,
+#   not by every worker. What each worker still builds per embedding is small
+#   bookkeeping: the known_embeddings row views and per-user row lists of its
+#   snapshot, and the IVF row arrays (built from the mapped assignments with
+#   array operations).
+# - The metadata carries the version of the gallery (the store stamp and the
+#   scoring mode). A worker only maps the file when its version matches the
+#   store; otherwise one worker rebuilds it (under a file lock) for everyone.
+# - A new version is written to a temporary file and renamed over the old
+#   one, so workers swap atomically: a mapping of the old file stays valid
+#   until the worker drops it, and the kernel frees it afterwards.
+# The file is a cache of the packed store: it is never the only copy of the data.
+#
+# Enabled through FACEAUTH_SHARED_GALLERY ('1' for the default file in
+# /dev/shm, or the path of the file to use).
+# ============================================
+
+import fcntl  # Advisory file lock so only one worker rebuilds the file
+import json  # Metadata block of the file
+import mmap  # Read-only shared mapping of the file
+import os  # File handling and settings from the environment
+import struct  # Fixed-size file header
+import zlib  # Short hash of the embeddings directory for the default file name
+from contextlib import contextmanager
+
+import numpy as np  # NumPy views over the mapped file
+
+MAGIC = b"FAGALLRY"  # Identifies a shared gallery file
+FORMAT_VERSION = 2  # Bumped whenever the layout below changes
+HEADER = struct.Struct("<8sII")  # Magic, format version, metadata length
+ALIGNMENT = 64  # The arrays start on a cache-line boundary
+
+
+def shared_gallery_path_from_env(embeddings_dir):
+    """
+    Returns the shared gallery file configured through FACEAUTH_SHARED_GALLERY,
+    or None when the shared gallery is disabled.
+    """
+    value = os.getenv("FACEAUTH_SHARED_GALLERY", "").strip()
+    if value.lower() in ("", "0", "off", "no", "false"):
+        return None
+    if value.lower() in ("1", "on", "yes", "true"):
+        base = "/dev/shm" if os.path.isdir("/dev/shm") else embeddings_dir
+        digest = zlib.crc32(os.path.abspath(embeddings_dir).encode())  # One file per store
+        return os.path.join(base, f"faceauth-{digest:08x}.gallery")
+    return value
+
+
+def _align(offset):
+    """
+    Rounds 'offset' up to ALIGNMENT.
+    """
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _data_offset(meta_length):
+    """
+    Offset of the first array: header + metadata, rounded up to ALIGNMENT.
+    """
+    return _align(HEADER.size + meta_length)
+
+
+# === Class responsible for publishing and mapping the shared gallery file ===
+class SharedGallery:
+    def __init__(self, path):
+        """
+        Uses 'path' for the shared file and 'path.lock' to serialize rebuilds.
+        """
+        self.path = path
+        self.lock_path = path + ".lock"
+
+    @contextmanager
+    def locked(self):
+        """
+        Serializes rebuilds across processes (flock), so a new version is built only once.
+        """
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def open(self, version):
+        """
+        Maps the shared file read-only if it holds 'version' of the gallery.
+        Returns a tuple (matrix, labels, norms, arrays, meta) of views into the mapping
+        ('arrays': {name: array} of the extra arrays given to publish),
+        or None when the file is missing, from another format or another version.
+        """
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return None
+
+        with f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return None
+            magic, format_version, meta_length = HEADER.unpack(header)
+            if magic != MAGIC or format_version != FORMAT_VERSION:
+                return None
+            meta = json.loads(f.read(meta_length))
+            if meta["version"] != version:
+                return None
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # Stays valid after the file is closed
+
+        rows, dim = meta["rows"], meta["dim"]
+        offset = _data_offset(meta_length)
+        matrix = np.frombuffer(mapped, dtype=np.float32, count=rows * dim, offset=offset).reshape(rows, dim)
+        offset += matrix.nbytes
+        labels = np.frombuffer(mapped, dtype=np.int32, count=rows, offset=offset)
+        offset += labels.nbytes
+        norms = np.frombuffer(mapped, dtype=np.float32, count=rows, offset=offset)
+        offset += norms.nbytes
+
+        arrays = {}
+        for name, dtype, shape in meta["arrays"]:
+            offset = _align(offset)
+            count = int(np.prod(shape))
+            arrays[name] = np.frombuffer(mapped, dtype=dtype, count=count, offset=offset).reshape(shape)
+            offset += arrays[name].nbytes
+        return matrix, labels, norms, arrays, meta
+
+    def publish(self, version, matrix, labels, norms, arrays=None, **meta):
+        """
+        Writes a new version of the gallery and swaps it in with one rename.
+        - 'arrays': optional {name: array} of extra arrays (e.g. the IVF centroids),
+          each stored on an aligned offset after the rows.
+        Extra keyword arguments (e.g. the user folders) are stored in the metadata.
+        Must be called with locked() held.
+        """
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        arrays = {name: np.ascontiguousarray(array) for name, array in (arrays or {}).items()}
+        meta = dict(meta, version=version, rows=len(matrix), dim=int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+                    arrays=[[name, array.dtype.str, list(array.shape)] for name, array in arrays.items()])
+        meta_bytes = json.dumps(meta, separators=(",", ":")).encode()
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            head = HEADER.pack(MAGIC, FORMAT_VERSION, len(meta_bytes)) + meta_bytes
+            f.write(head.ljust(_data_offset(len(meta_bytes)), b"\0"))  # Padding up to the aligned arrays
+            f.write(matrix.tobytes())
+            f.write(np.ascontiguousarray(labels, dtype=np.int32).tobytes())
+            f.write(np.ascontiguousarray(norms, dtype=np.float32).tobytes())
+            for array in arrays.values():
+                f.write(b"\0" * (_align(f.tell()) - f.tell()))
+                f.write(array.tobytes())
+        os.replace(tmp_path, self.path)  # Workers still mapping the old version keep it until they swap
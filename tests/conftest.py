@@ -0,0 +1,62 @@
+# ============================================
+# Pytest Configuration
+# File: conftest.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-06-12
+#
+# Description:
+# Shared setup for the automated tests:
+# - Makes the project root importable (like the scripts in tools/).
+# - Skips the hardware scripts of this folder, which need a camera.
+# - Provides the 'make_recognizer' fixture: a FaceRecognizer over a
+#   temporary packed store, without loading the TFLite model.
+# ============================================
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+collect_ignore = ["test_camera.py"]  # Camera check meant to be run by hand on the Raspberry Pi
+
+
+def synthetic_gallery(users, per_user, dim=192, spread=0.35, seed=0):
+    """
+    Returns a {folder: [embedding, ...]} gallery of well separated users
+    (embedding norms around 10, like MobileFaceNet's raw outputs).
+    """
+    rng = np.random.default_rng(seed)
+    gallery = {}
+    for user in range(users):
+        center = rng.normal(size=dim).astype(np.float32)
+        center *= 10.0 / np.linalg.norm(center)
+        gallery[f"user{user:03d}"] = list(center + spread * rng.normal(size=(per_user, dim)).astype(np.float32))
+    return gallery
+
+
+@pytest.fixture
+def make_recognizer(tmp_path, monkeypatch):
+    """
+    Returns a factory make_recognizer(gallery, **env) that stores 'gallery' in a
+    temporary packed store and opens a FaceRecognizer on it with the given
+    FACEAUTH_* settings (e.g. FACEAUTH_SCORING="cosine").
+    """
+    import recognize_m
+    from embedding_store import EmbeddingStore
+
+    monkeypatch.setattr(recognize_m, "get_engine", lambda model_path: None)  # Searches never run the model
+    monkeypatch.setenv("FACEAUTH_MAX_EMBEDDINGS_PER_USER", "0")
+
+    def factory(gallery, **env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        store_dir = tmp_path / f"store{len(list(tmp_path.iterdir()))}"
+        store = EmbeddingStore(str(store_dir))
+        for folder, embeddings in gallery.items():
+            store.append(folder, embeddings)
+        return recognize_m.FaceRecognizer(embeddings_dir=str(store_dir))
+
+    return factory
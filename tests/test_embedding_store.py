@@ -0,0 +1,131 @@
+# ============================================
+# Packed Embedding Store Tests
+# File: test_embedding_store.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-06-14
+#
+# Description:
+# Checks the crash-safety and lock-free reading claims of embedding_store.py:
+# - a torn log record (interrupted commit) is ignored, then overwritten
+# - rows written to the matrix without their log record are ignored
+# - a matrix header counting rows the file does not hold (power loss) is ignored
+# - readers holding an index from before one or more compactions
+#   still read a consistent gallery
+# - the legacy .pkl import skips embeddings of another length
+#
+# Run with: python -m pytest tests
+# ============================================
+
+import os
+
+import numpy as np
+import pytest
+
+from embedding_store import EmbeddingStore
+
+
+def vectors(count, seed):
+    return np.random.default_rng(seed).normal(size=(count, 192)).astype(np.float32)
+
+
+def log_path(store):
+    return os.path.join(store.base_dir, store.read_index()["log_file"])
+
+
+@pytest.fixture
+def store(tmp_path):
+    return EmbeddingStore(str(tmp_path / "store"))
+
+
+def test_torn_record_is_ignored_and_overwritten(store):
+    alice, bob, carol = vectors(3, 1), vectors(2, 2), vectors(4, 3)
+    store.append("alice", alice)
+    committed = os.path.getsize(log_path(store))
+    store.append("bob", bob)
+
+    # Crash in the middle of bob's record: only part of it reached the disk
+    with open(log_path(store), "r+b") as f:
+        f.truncate(committed + (os.path.getsize(log_path(store)) - committed) // 2)
+
+    reopened = EmbeddingStore(store.base_dir)
+    known = reopened.load_known_embeddings()
+    assert list(known) == ["alice"]
+    np.testing.assert_array_equal(known["alice"], alice)
+
+    # The next write replaces the torn record
+    reopened.append("carol", carol)
+    known = EmbeddingStore(store.base_dir).load_known_embeddings()
+    assert sorted(known) == ["alice", "carol"]
+    np.testing.assert_array_equal(known["carol"], carol)
+
+
+def test_unlogged_rows_are_ignored_and_overwritten(store):
+    alice, lost, bob = vectors(3, 1), vectors(5, 2), vectors(2, 3)
+    store.append("alice", alice)
+
+    # Crash after writing rows to the matrix but before their log record
+    with store._locked():
+        store._append_rows(store.read_index(), lost)
+
+    reopened = EmbeddingStore(store.base_dir)
+    matrix, labels, folders = reopened.load()
+    assert folders == ["alice"] and len(matrix) == 3
+
+    # The next write reuses those rows
+    assert reopened.append("bob", bob) == [3, 4]
+    known = EmbeddingStore(store.base_dir).load_known_embeddings()
+    np.testing.assert_array_equal(known["bob"], bob)
+    np.testing.assert_array_equal(known["alice"], alice)
+
+
+def test_header_past_the_file_end_is_ignored(store):
+    alice = vectors(3, 1)
+    store.append("alice", alice)
+
+    # Power loss after the header was rewritten for 5 rows, before those rows reached the file
+    index = store.read_index()
+    with open(os.path.join(store.base_dir, index["matrix_file"]), "r+b") as f:
+        EmbeddingStore._write_header(f, 5, index["dim"])
+
+    matrix, labels, folders = EmbeddingStore(store.base_dir).load()
+    assert folders == ["alice"]
+    np.testing.assert_array_equal(matrix, alice)
+
+
+def test_readers_survive_compactions(store, monkeypatch):
+    store.append("alice", vectors(3, 1))
+    reader = EmbeddingStore(store.base_dir)
+    stale = reader.read_index()
+
+    # One compaction: the previous matrix and log are kept for readers still using them
+    store.rewrite([("bob", vectors(2, 2))])
+    matrix, labels, folders = reader.load(stale)
+    assert folders == ["alice"] and len(matrix) == 3
+
+    # Two compactions: the stale matrix is gone, read_gallery reads the new index
+    store.rewrite([("carol", vectors(4, 3))])
+    with pytest.raises(FileNotFoundError):
+        reader.load(stale)
+    assert len([file for file in os.listdir(store.base_dir) if file.endswith(".npy")]) == 2
+
+    read_index = reader.read_index
+    indexes = iter([stale])
+    monkeypatch.setattr(reader, "read_index", lambda: next(indexes, None) or read_index())
+    index, matrix, labels, folders = reader.read_gallery()
+    assert folders == ["carol"] and len(matrix) == 4
+    assert index["compactions"] == store.read_index()["compactions"]
+
+
+def test_legacy_import_skips_other_lengths(tmp_path):
+    import pickle
+
+    legacy = {"alice": vectors(3, 1), "bob": vectors(2, 2), "carol": [np.ones(128, dtype=np.float32)]}
+    for folder, embeddings in legacy.items():
+        os.makedirs(tmp_path / folder)
+        for i, embedding in enumerate(embeddings):
+            with open(tmp_path / folder / f"{folder}_{i:02d}.pkl", "wb") as f:
+                pickle.dump(embedding, f)
+
+    known = EmbeddingStore(str(tmp_path)).load_known_embeddings()
+    assert sorted(known) == ["alice", "bob"]  # The 128-dim embedding of carol is skipped
+    np.testing.assert_array_equal(known["alice"], legacy["alice"])
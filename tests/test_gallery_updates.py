@@ -0,0 +1,40 @@
+# ============================================
+# Gallery Mutator Tests
+# File: test_gallery_updates.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-06-15
+#
+# Description:
+# Checks that FaceRecognizer.add_embedding, remove_user and replace_user
+# write through the packed store: the in-memory gallery is updated, and a
+# second recognizer on the same store (another worker) sees the change.
+#
+# Run with: python -m pytest tests
+# ============================================
+
+import numpy as np
+
+import recognize_m
+from conftest import synthetic_gallery
+
+
+def test_mutators_write_through_the_store(make_recognizer):
+    gallery = synthetic_gallery(users=4, per_user=3)
+    recognizer = make_recognizer(gallery)
+    other = recognize_m.FaceRecognizer(embeddings_dir=recognizer.store.base_dir)
+    new = synthetic_gallery(users=1, per_user=2, seed=7)["user000"]
+
+    recognizer.add_embedding("user001", new[0])
+    assert len(recognizer.gallery.user_rows["user001"]) == 4
+    assert len(recognizer.store.read_user("user001")) == 4
+
+    assert len(recognizer.replace_user("user002", new)) == 2  # Store rows (the gallery numbers its own)
+    assert len(recognizer.gallery.user_rows["user002"]) == 2
+    np.testing.assert_array_equal(recognizer.store.read_user("user002"), np.array(new))
+
+    assert recognizer.remove_user("user003") == 3
+    assert "user003" not in recognizer.gallery.user_rows
+
+    other.sync_gallery(wait=True)
+    assert {name: len(rows) for name, rows in other.gallery.user_rows.items() if rows} == \
+        {"user000": 3, "user001": 4, "user002": 2}
@@ -0,0 +1,205 @@
+# ============================================
+# Gallery Search Tests
+# File: test_search.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-06-12
+#
+# Description:
+# Checks FaceRecognizer.search against a brute-force reference (minimum
+# distance over every embedding of every user) on synthetic galleries:
+# - exact path (small gallery: coarse scan + exact rescoring)
+# - prototype prefilter path (gallery of at least PROTOTYPE_MIN_ROWS rows)
+# - cosine scoring (L2-normalized embeddings)
+# - IVF index: top-1 recall against the exact result
+# - compact galleries (float16/int8): float32 rows read from the store file
+# - searches do not wait for a gallery sync running in another thread
+# - published snapshots carry up-to-date prototypes (searches never refresh them)
+#
+# Run with: python -m pytest tests
+# ============================================
+
+import threading
+
+import numpy as np
+import pytest
+
+import recognize_m
+import scoring
+from conftest import synthetic_gallery
+from gallery_snapshot import GallerySnapshot, MappedRows
+
+
+def brute_force(gallery, probe, k, cosine=False):
+    """
+    Reference top-k: (folder, distance) of the k users with the smallest
+    minimum distance to 'probe', sorted by increasing distance.
+    """
+    normalize = scoring.l2_normalize if cosine else (lambda x: x)
+    probe = normalize(np.asarray(probe, dtype=np.float32))
+    distances = {folder: float(np.linalg.norm(normalize(np.array(embeddings)) - probe, axis=1).min())
+                 for folder, embeddings in gallery.items()}
+    return sorted(distances.items(), key=lambda item: item[1])[:k]
+
+
+def probes(gallery, count, seed=1):
+    """
+    Probes near random enrolled embeddings, plus a few far from everyone.
+    """
+    rng = np.random.default_rng(seed)
+    folders = list(gallery)
+    near = [gallery[folders[rng.integers(len(folders))]][0] + 0.3 * rng.normal(size=192) for _ in range(count)]
+    far = [10.0 * rng.normal(size=192) / np.sqrt(192) for _ in range(3)]
+    return [np.asarray(probe, dtype=np.float32) for probe in near + far]
+
+
+def assert_same_top_k(result, expected):
+    assert [folder for folder, _ in result] == [folder for folder, _ in expected]
+    np.testing.assert_allclose([d for _, d in result], [d for _, d in expected], rtol=1e-4, atol=1e-5)
+
+
+def test_exact_search_matches_brute_force(make_recognizer):
+    gallery = synthetic_gallery(users=12, per_user=5)
+    recognizer = make_recognizer(gallery)
+    assert recognizer.gallery.size < recognize_m.PROTOTYPE_MIN_ROWS  # Coarse scan + exact rescoring
+
+    for probe in probes(gallery, 20):
+        name, distance, top_k = recognizer.search(probe, k=3)
+        expected = brute_force(gallery, probe, 3)
+        assert_same_top_k(top_k, expected)
+        if expected[0][1] < recognizer.threshold:
+            assert name == expected[0][0]
+        else:
+            assert (name, distance) == ("Unknown", None)
+
+
+def test_prototype_search_matches_brute_force(make_recognizer):
+    gallery = synthetic_gallery(users=60, per_user=8)
+    recognizer = make_recognizer(gallery)
+    assert recognizer.gallery.size >= recognize_m.PROTOTYPE_MIN_ROWS
+
+    queries = probes(gallery, 30)
+    for probe in queries[:30]:
+        # Near an enrolled user, the best match is found by scanning only a few users
+        # (far probes, or k > 1 on equidistant synthetic users, may fall back to a full scan)
+        user_distances = recognizer._prototype_distances(recognizer.gallery, recognizer.normalize(probe), 1)
+        assert user_distances is not None
+        assert np.isinf(user_distances).any()
+        best = int(np.argmin(user_distances))
+        expected_folder, expected_distance = brute_force(gallery, probe, 1)[0]
+        assert recognizer.gallery.users[best] == expected_folder
+        assert float(user_distances[best]) == pytest.approx(expected_distance, rel=1e-4)
+
+    for probe in queries:
+        _, _, top_k = recognizer.search(probe, k=3)
+        assert_same_top_k(top_k, brute_force(gallery, probe, 3))
+
+
+@pytest.mark.parametrize("users, per_user", [(12, 5), (60, 8)])
+def test_cosine_search_matches_brute_force(make_recognizer, users, per_user):
+    gallery = synthetic_gallery(users=users, per_user=per_user)
+    recognizer = make_recognizer(gallery, FACEAUTH_SCORING="cosine")
+
+    for probe in probes(gallery, 20):
+        name, _, top_k = recognizer.search(probe, k=3)
+        expected = brute_force(gallery, probe, 3, cosine=True)
+        assert_same_top_k(top_k, expected)
+        if expected[0][1] < recognizer.translate_threshold(recognizer.threshold):
+            assert name == expected[0][0]
+
+
+def test_ivf_top1_recall(make_recognizer):
+    gallery = synthetic_gallery(users=250, per_user=12, seed=3)
+    recognizer = make_recognizer(gallery, FACEAUTH_ANN_INDEX="ivf", FACEAUTH_ANN_MIN_ROWS=1000)
+    assert recognizer.ann_index is not None
+
+    queries = probes(gallery, 200, seed=4)[:200]
+    hits = sum(recognizer.search(probe, k=1)[2][0][0] == brute_force(gallery, probe, 1)[0][0]
+               for probe in queries)
+    assert hits / len(queries) >= 0.95
+
+
+@pytest.mark.parametrize("precision", ["float16", "int8"])
+def test_quantized_prototype_search(make_recognizer, monkeypatch, precision):
+    gallery = synthetic_gallery(users=60, per_user=8)
+    recognizer = make_recognizer(gallery, FACEAUTH_GALLERY_PRECISION=precision)
+    assert recognizer.gallery.size >= recognize_m.PROTOTYPE_MIN_ROWS
+
+    # The prefilter scans the candidate users with the compact rows
+    calls = []
+    squared_distances = recognizer.quantized.squared_distances
+    monkeypatch.setattr(recognizer.quantized, "squared_distances",
+                        lambda probe, rows=None: calls.append(rows) or squared_distances(probe, rows))
+
+    for probe in probes(gallery, 20):
+        name, _, top_k = recognizer.search(probe, k=1)
+        expected = brute_force(gallery, probe, 1)
+        assert_same_top_k(top_k, expected)  # Rescored in float32: exact distance
+    assert any(rows is not None for rows in calls)  # Far probes may still fall back to a full coarse scan
+
+
+@pytest.mark.parametrize("mode", ["euclidean", "cosine"])
+def test_compact_gallery_reads_rows_from_store(make_recognizer, mode):
+    gallery = synthetic_gallery(users=60, per_user=8)
+    recognizer = make_recognizer(gallery, FACEAUTH_GALLERY_PRECISION="int8", FACEAUTH_SCORING=mode)
+    cosine = mode == "cosine"
+
+    # No float32 copy of the gallery: only the store row of each embedding is kept
+    assert recognizer.gallery.compact and isinstance(recognizer.gallery_matrix, MappedRows)
+    assert recognizer.gallery._buffer.dtype == np.int64
+
+    # Incremental updates replayed from the store keep the search exact
+    rng = np.random.default_rng(2)
+    gallery["newcomer"] = list(10.0 * rng.normal(size=(3, 192)).astype(np.float32) / np.sqrt(192))
+    recognizer.save_embeddings("newcomer", gallery["newcomer"])
+    recognizer.delete_user("user005")
+    del gallery["user005"]
+    assert recognizer.gallery.compact
+
+    for probe in probes(gallery, 15) + [gallery["newcomer"][1]]:
+        _, _, top_k = recognizer.search(probe, k=1)
+        assert_same_top_k(top_k, brute_force(gallery, probe, 1, cosine))
+
+
+def test_search_does_not_wait_for_sync(make_recognizer):
+    gallery = synthetic_gallery(users=12, per_user=5)
+    recognizer = make_recognizer(gallery)
+    probe = gallery["user003"][0]
+
+    # Another worker enrolls a user while a thread of this worker holds the gallery lock
+    recognizer.store.append("newcomer", [probe])
+    acquired, release = threading.Event(), threading.Event()
+
+    def hold_lock():
+        with recognizer._gallery_lock:
+            acquired.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    acquired.wait(5)
+    try:
+        assert recognizer.search(probe, k=1)[0] == "user003"  # Current snapshot, no waiting
+    finally:
+        release.set()
+        holder.join()
+
+    assert recognizer.sync_gallery(wait=True)
+    assert "newcomer" in recognizer.gallery.users
+
+
+def test_published_prototypes_are_up_to_date(make_recognizer, monkeypatch):
+    gallery = synthetic_gallery(users=60, per_user=8)
+    recognizer = make_recognizer(gallery)
+
+    # Another worker enrolls a user next to user003; the sync computes its prototype before publishing
+    gallery["newcomer"] = [gallery["user003"][0] + 0.01]
+    recognizer.store.append("newcomer", gallery["newcomer"])
+    assert recognizer.sync_gallery(wait=True)
+
+    def fail(self):
+        raise AssertionError("prototypes refreshed by a search")
+    monkeypatch.setattr(GallerySnapshot, "refresh_prototypes", fail)
+
+    for probe in probes(gallery, 10) + [gallery["newcomer"][0]]:
+        _, _, top_k = recognizer.search(probe, k=2)
+        assert_same_top_k(top_k, brute_force(gallery, probe, 2))
@@ -0,0 +1,89 @@
+# ============================================
+# Enrollment Cap Tests
+# File: test_select_diverse.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-06-14
+#
+# Description:
+# Checks that FaceRecognizer.select_diverse keeps one embedding per
+# pose cluster when a user's embeddings are capped:
+# - below the cap: the new embeddings (seeds) are kept and the stored
+#   ones fill the remaining slots with the most distinct poses
+# - batch larger than the cap: the selection runs over the new
+#   embeddings themselves instead of keeping the first frames
+# - two workers saving to the same capped user at once: neither save is lost
+#
+# Run with: python -m pytest tests
+# ============================================
+
+import numpy as np
+
+from recognize_m import FaceRecognizer
+
+
+def clustered(sizes, dim=192, seed=0):
+    """
+    Returns (vectors, cluster of each vector): tight clusters of the given
+    sizes, stacked in order (like consecutive frames of the same pose).
+    """
+    rng = np.random.default_rng(seed)
+    vectors, clusters = [], []
+    for cluster, size in enumerate(sizes):
+        center = 10.0 * rng.normal(size=dim) / np.sqrt(dim)
+        vectors.extend(center + 0.01 * rng.normal(size=(size, dim)))
+        clusters.extend([cluster] * size)
+    return np.asarray(vectors, dtype=np.float32), clusters
+
+
+def test_below_cap_keeps_seeds_and_diverse_stored():
+    # Stored: 4 frames of pose 0, 4 of pose 1, 4 of pose 2; new: 2 frames of pose 3
+    vectors, clusters = clustered([4, 4, 4, 2])
+    seeds = [12, 13]
+
+    kept = FaceRecognizer.select_diverse(vectors, 5, seeds)
+    assert len(kept) == 5
+    assert set(seeds) <= set(kept)
+    assert {clusters[i] for i in kept} == {0, 1, 2, 3}
+
+
+def test_batch_larger_than_cap_is_diversified():
+    # Stored: 3 frames of pose 0; new batch: 6 frames of pose 1, then 1 of pose 2 and 1 of pose 3
+    vectors, clusters = clustered([3, 6, 1, 1])
+    seeds = list(range(3, 11))
+
+    kept = FaceRecognizer.select_diverse(vectors, 3, seeds)
+    assert len(kept) == 3
+    assert set(kept) <= set(seeds)  # Only the new embeddings are kept
+    assert sorted(clusters[i] for i in kept) == [1, 2, 3]  # Not the first 3 frames (all pose 1)
+
+
+def test_concurrent_capped_saves_keep_both(tmp_path, monkeypatch):
+    import threading
+
+    import recognize_m
+    from embedding_store import EmbeddingStore
+
+    monkeypatch.setattr(recognize_m, "get_engine", lambda model_path: None)
+    monkeypatch.setenv("FACEAUTH_MAX_EMBEDDINGS_PER_USER", "3")
+    vectors, _ = clustered([3, 1, 1])  # Stored: 3 frames of one pose; two workers each add a new pose
+    store = EmbeddingStore(str(tmp_path / "store"))
+    store.append("alice", vectors[:3])
+
+    workers = [recognize_m.FaceRecognizer(embeddings_dir=store.base_dir) for _ in range(2)]
+    barrier = threading.Barrier(2)
+    results = [None, None]
+
+    def save(i):
+        barrier.wait()
+        results[i] = workers[i].save_embeddings("alice", [vectors[3 + i]])
+
+    threads = [threading.Thread(target=save, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stored = store.read_user("alice")
+    assert len(stored) == 3 and all(len(rows) == 1 for rows in results)
+    for vector in vectors[3:]:
+        assert np.abs(stored - vector).max(axis=1).min() < 1e-6  # Neither new pose was lost
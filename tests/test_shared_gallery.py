@@ -0,0 +1,63 @@
+# ============================================
+# Shared Gallery Tests
+# File: test_shared_gallery.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-06-14
+#
+# Description:
+# Checks that workers mapping the shared gallery file (FACEAUTH_SHARED_GALLERY)
+# reuse the quantized rows, the IVF index and the per-user prototypes built by
+# the publishing worker instead of training k-means, quantizing the gallery and
+# computing the prototypes again, and that their searches match the publisher's.
+#
+# Run with: python -m pytest tests
+# ============================================
+
+import numpy as np
+
+import ann_index
+import gallery_snapshot
+import quantization
+import recognize_m
+from conftest import synthetic_gallery
+from embedding_store import EmbeddingStore
+
+
+def test_workers_map_the_published_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(recognize_m, "get_engine", lambda model_path: None)
+    for name, value in {"FACEAUTH_MAX_EMBEDDINGS_PER_USER": "0", "FACEAUTH_GALLERY_PRECISION": "int8",
+                        "FACEAUTH_ANN_INDEX": "ivf", "FACEAUTH_ANN_MIN_ROWS": "100",
+                        "FACEAUTH_SHARED_GALLERY": str(tmp_path / "shared.gallery")}.items():
+        monkeypatch.setenv(name, value)
+
+    gallery = synthetic_gallery(users=40, per_user=5)
+    store = EmbeddingStore(str(tmp_path / "store"))
+    for folder, embeddings in gallery.items():
+        store.append(folder, embeddings)
+
+    publisher = recognize_m.FaceRecognizer(embeddings_dir=store.base_dir)
+    assert publisher.ann_index is not None and publisher.quantized is not None
+
+    # Any k-means training or quantization of the whole gallery in another worker fails the test
+    def fail(*args, **kwargs):
+        raise AssertionError("rebuilt instead of mapped from the shared gallery")
+    monkeypatch.setattr(ann_index.IVFIndex, "_train", fail)
+    monkeypatch.setattr(quantization.QuantizedRows, "reset", fail)
+    monkeypatch.setattr(gallery_snapshot, "compute_prototypes", fail)
+
+    worker = recognize_m.FaceRecognizer(embeddings_dir=store.base_dir)
+    np.testing.assert_array_equal(worker.ann_index.centroids, publisher.ann_index.centroids)
+    np.testing.assert_array_equal(worker.quantized.codes, publisher.quantized.codes[:publisher.quantized.size])
+    np.testing.assert_allclose(worker.gallery.prototype_centroids, publisher.gallery.prototype_centroids)
+
+    rng = np.random.default_rng(1)
+    for folder in list(gallery)[:10]:
+        probe = gallery[folder][0] + 0.3 * rng.normal(size=192).astype(np.float32)
+        assert worker.search(probe, k=3) == publisher.search(probe, k=3)
+
+    # Incremental updates on top of the mapped (read-only) structures
+    worker.gallery = worker.gallery.edit()
+    worker._add_to(worker.gallery, "user000", gallery["user001"][0])
+    worker.gallery.remove("user002")
+    worker.gallery.refresh_prototypes()
+    assert worker.search(gallery["user001"][0], k=1)[2][0][1] == 0.0
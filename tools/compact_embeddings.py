@@ -0,0 +1,204 @@
+# ============================================
+# Embedding Compaction and Migration Script
+# File: compact_embeddings.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-06-02
+#
+# Description:
+# Non-interactive tool that migrates the legacy 'embeddings/<user>/*.pkl'
+# tree into the packed store (gallery .npy + index) in one bulk pass:
+# - Every pickle is validated (loads, numeric float vector, 128 or 192
+#   dimensions, no NaN/inf values); invalid files are reported and skipped.
+# - Near-duplicate embeddings of the same user are removed.
+# - User folders are processed in parallel with a process pool.
+# - Timings and sizes before/after are printed at the end.
+# The .pkl files are left in place. Replacing an existing packed store is
+# refused when it holds embeddings that are not in the legacy tree (e.g.
+# enrollments made after the migration), unless --force is given.
+# ============================================
+
+import argparse
+import os
+import pickle
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT_DIR)
+from embedding_store import INDEX_FILE, EmbeddingStore  # noqa: E402
+
+VALID_DIMS = (128, 192)  # Embedding lengths accepted (same as check_embedding.py)
+
+
+def validate_embedding(file_path):
+    """
+    Loads one .pkl embedding and validates it.
+    Returns (vector, None) if it is valid, otherwise (None, reason).
+    """
+    try:
+        with open(file_path, "rb") as f:
+            embedding = pickle.load(f)
+    except Exception as e:
+        return None, f"cannot be loaded ({e.__class__.__name__})"
+
+    vector = np.asarray(embedding)
+    if vector.dtype.kind != "f":
+        return None, f"invalid dtype {vector.dtype}"
+    vector = vector.astype(np.float32).ravel()
+    if len(vector) not in VALID_DIMS:
+        return None, f"invalid length {len(vector)}"
+    if not np.isfinite(vector).all():
+        return None, "contains NaN or inf values"
+    return vector, None
+
+
+def remove_near_duplicates(vectors, threshold):
+    """
+    Keeps each embedding only if it is at least 'threshold' away from every
+    embedding already kept for the same user (first come, first kept).
+    """
+    kept = []
+    for vector in vectors:
+        if not kept or np.linalg.norm(np.asarray(kept) - vector, axis=1).min() >= threshold:
+            kept.append(vector)
+    return kept
+
+
+def process_user(task):
+    """
+    Validates and deduplicates the embeddings of one user folder (runs in a worker process).
+    Returns a dictionary with the kept vectors and the per-folder statistics.
+    """
+    user_path, dedup_threshold = task
+    vectors, invalid, size = [], [], 0
+    for file in sorted(os.listdir(user_path)):
+        if not file.endswith(".pkl"):
+            continue
+        file_path = os.path.join(user_path, file)
+        size += os.path.getsize(file_path)
+        vector, reason = validate_embedding(file_path)
+        if reason:
+            invalid.append((file_path, reason))
+        else:
+            vectors.append(vector)
+
+    # Only same-length vectors can be compared (the majority length is chosen later)
+    by_dim = {}
+    for vector in vectors:
+        by_dim.setdefault(len(vector), []).append(vector)
+    if dedup_threshold > 0:
+        by_dim = {dim: remove_near_duplicates(group, dedup_threshold) for dim, group in by_dim.items()}
+
+    return {
+        "folder": os.path.basename(user_path),
+        "files": len(vectors) + len(invalid),
+        "valid": len(vectors),
+        "by_dim": by_dim,
+        "invalid": invalid,
+        "bytes": size,
+    }
+
+
+def missing_from_legacy(store, users, tolerance):
+    """
+    Compares an existing packed store with the legacy embeddings about to replace it.
+    Returns {folder: count} of the stored embeddings that have no legacy embedding
+    of the same user within 'tolerance' (they would be lost by the replacement).
+    """
+    legacy = {folder: np.asarray(vectors) for folder, vectors in users}
+    missing = {}
+    for folder, embeddings in store.load_known_embeddings().items():
+        vectors = legacy.get(folder)
+        if vectors is None or vectors.shape[1] != len(embeddings[0]):
+            missing[folder] = len(embeddings)
+            continue
+        distances = np.linalg.norm(np.asarray(embeddings)[:, None, :] - vectors[None, :, :], axis=2)
+        lost = int((distances.min(axis=1) > tolerance).sum())
+        if lost:
+            missing[folder] = lost
+    return missing
+
+
+# === INPUT ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate, deduplicate and pack legacy .pkl embeddings")
+    parser.add_argument("--embeddings", default=os.path.join(ROOT_DIR, "embeddings"),
+                        help="Directory with one folder of .pkl files per user (default: embeddings/)")
+    parser.add_argument("--output", default=None,
+                        help="Directory of the packed store (default: same as --embeddings)")
+    parser.add_argument("--dedup-threshold", type=float, default=0.05,
+                        help="Drop embeddings closer than this to one already kept for the user (0 = keep all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes (default: number of CPUs)")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Replace an existing packed store in the output directory")
+    parser.add_argument("--force", action="store_true",
+                        help="With --overwrite, replace the store even if it holds embeddings missing from the .pkl files")
+    args = parser.parse_args()
+
+    output = args.output or args.embeddings
+    if not os.path.isdir(args.embeddings):
+        print(f"[ERROR] Embeddings directory not found: {args.embeddings}")
+        sys.exit(1)
+    if os.path.exists(os.path.join(output, INDEX_FILE)) and not args.overwrite:
+        print(f"[ERROR] A packed store already exists in {output} (use --overwrite to replace it)")
+        sys.exit(1)
+
+    # === Validation and deduplication (parallel, one task per user) ===
+    start = time.perf_counter()
+    user_paths = sorted(os.path.join(args.embeddings, name) for name in os.listdir(args.embeddings)
+                        if os.path.isdir(os.path.join(args.embeddings, name)))
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        results = list(pool.map(process_user, [(path, args.dedup_threshold) for path in user_paths],
+                                chunksize=max(1, len(user_paths) // (4 * max(1, args.workers)))))
+    scan_time = time.perf_counter() - start
+
+    # All stored embeddings must have the same length: keep the most common one
+    dims = Counter()
+    for result in results:
+        for dim, group in result["by_dim"].items():
+            dims[dim] += len(group)
+    dim = dims.most_common(1)[0][0] if dims else None
+
+    users, invalid, duplicates = [], [], 0
+    for result in results:
+        invalid.extend(result["invalid"])
+        for other_dim, group in result["by_dim"].items():
+            if other_dim != dim:
+                invalid.append((result["folder"], f"{len(group)} embeddings of length {other_dim} (store uses {dim})"))
+        kept = result["by_dim"].get(dim, [])
+        duplicates += result["valid"] - sum(len(group) for group in result["by_dim"].values())
+        if kept:
+            users.append((result["folder"], kept))
+
+    # === Bulk write ===
+    store = EmbeddingStore(output, import_legacy=False)
+    missing = missing_from_legacy(store, users, max(args.dedup_threshold, 1e-4))
+    if missing:
+        for folder, count in sorted(missing.items()):
+            print(f"[WARNING] {folder}: {count} stored embeddings are not in the .pkl files")
+        if not args.force:
+            print(f"[ERROR] Replacing the packed store in {output} would lose "
+                  f"{sum(missing.values())} embeddings (use --force to replace it anyway)")
+            sys.exit(1)
+
+    start = time.perf_counter()
+    stored = store.rewrite(users)
+    write_time = time.perf_counter() - start
+
+    # === Report ===
+    index = store.read_index()
+    size_before = sum(result["bytes"] for result in results)
+    size_after = os.path.getsize(os.path.join(output, index["matrix_file"])) + os.path.getsize(store.index_path)
+    files = sum(result["files"] for result in results)
+
+    for path, reason in invalid:
+        print(f"❌ {path}: {reason}")
+    print(f"\n📁 Users: {len(users)} of {len(results)} folders")
+    print(f"📦 Embeddings: {files} files, {len(invalid)} invalid, {duplicates} near-duplicates removed, {stored} stored")
+    print(f"🔢 Size: {size_before / 1024:.1f} KiB of .pkl files -> {size_after / 1024:.1f} KiB packed")
+    print(f"⏱️ Validation: {scan_time:.2f} s ({max(1, args.workers)} workers), write: {write_time:.2f} s")
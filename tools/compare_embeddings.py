@@ -12,6 +12,10 @@
 import pickle
 import numpy as np
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from scoring import l2_normalize  # Same normalization as the recognizer's cosine mode
 
 def load_embedding(file_path):
     """Loads a .pkl embedding file and validates it"""
@@ -41,6 +45,12 @@ try:
     distance = np.linalg.norm(emb1 - emb2)
     print(f"\nDistance between embeddings: {distance:.4f}")
 
+    # Same comparison as FACEAUTH_SCORING=cosine: unit vectors and one dot product
+    cosine = float(l2_normalize(emb1) @ l2_normalize(emb2))
+    reference_norm = np.sqrt(np.linalg.norm(emb1) * np.linalg.norm(emb2))
+    print(f"Cosine similarity: {cosine:.4f} (normalized distance {np.sqrt(max(2 - 2 * cosine, 0)):.4f}, "
+          f"thresholds 0.8/1.3 become {0.8 / reference_norm:.4f}/{1.3 / reference_norm:.4f})")
+
     # === INTERPRETATION ===
     if distance < 0.8:
         print("Same person (high similarity)")
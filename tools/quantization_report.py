@@ -0,0 +1,120 @@
+# ============================================
+# Gallery Quantization Report
+# File: quantization_report.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-05-26
+#
+# Description:
+# Measures what the reduced-precision gallery modes (FACEAUTH_GALLERY_PRECISION)
+# would change on the real gallery in 'embeddings/':
+# - Bytes read by one scan in float32, float16 and int8, and the process memory
+#   of the gallery: with float16/int8 the float32 rows stay in the memory-mapped
+#   store file (only the rescored rows are read), so the process only holds the
+#   quantized rows plus a row number and a norm per embedding.
+# - Accuracy: every stored embedding is used as a probe against the rest of
+#   the gallery (leave-one-out), and the best match / accept decision of the
+#   quantized search (coarse scan + float32 rescoring) is compared with the
+#   exact float32 search.
+# ============================================
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT_DIR)
+from embedding_store import EmbeddingStore  # noqa: E402
+from quantization import PRECISIONS, QuantizedRows  # noqa: E402
+
+
+def per_user_minimum(distances, labels, users):
+    """
+    Returns the minimum distance of each user (inf for users without rows).
+    """
+    minimum = np.full(users, np.inf, dtype=np.float32)
+    np.minimum.at(minimum, labels, distances)
+    return minimum
+
+
+def compare_precision(matrix, labels, users, precision, threshold, rescore_users, queries):
+    """
+    Runs the leave-one-out comparison for one precision.
+    Returns a dictionary with the memory used and the observed differences.
+    """
+    quantized = QuantizedRows(precision, matrix)
+    top1_changed = decision_changed = 0
+    errors = []
+
+    for row in queries:
+        probe = matrix[row]
+        exact = np.linalg.norm(matrix - probe, axis=1)
+        exact[row] = np.inf  # Leave the probe itself out
+        exact_users = per_user_minimum(exact, labels, users)
+
+        approximate = np.sqrt(np.maximum(quantized.squared_distances(probe), 0.0))
+        approximate[row] = np.inf
+        finite = np.isfinite(exact)
+        errors.append(np.abs(approximate[finite] - exact[finite]).max(initial=0.0))
+
+        # Coarse scan, then exact rescoring of the closest users (as in FaceRecognizer)
+        approximate_users = per_user_minimum(approximate, labels, users)
+        count = min(rescore_users, int(np.isfinite(approximate_users).sum()))
+        if count == 0:
+            continue  # The probe's user is the only one in the gallery with a single row
+        candidates = np.argpartition(approximate_users, count - 1)[:count]
+        rescored = np.full(users, np.inf, dtype=np.float32)
+        rescored[candidates] = exact_users[candidates]
+
+        exact_best, quantized_best = int(np.argmin(exact_users)), int(np.argmin(rescored))
+        top1_changed += exact_best != quantized_best
+        decision_changed += (exact_users[exact_best] < threshold) != (rescored[quantized_best] < threshold)
+
+    return {
+        "precision": precision,
+        "bytes": quantized.nbytes,
+        "top1_changed": top1_changed,
+        "decision_changed": decision_changed,
+        "max_distance_error": float(max(errors, default=0.0)),
+    }
+
+
+# === INPUT ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report memory and accuracy of the quantized gallery modes")
+    parser.add_argument("--embeddings", default=os.path.join(ROOT_DIR, "embeddings"),
+                        help="Embeddings directory (default: embeddings/)")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Match threshold (default: 0.8)")
+    parser.add_argument("--rescore", type=int, default=8, help="Users rescored in float32 (default: 8)")
+    parser.add_argument("--queries", type=int, default=1000, help="Maximum number of probes (default: 1000)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.embeddings):
+        print(f"[ERROR] Embeddings directory not found: {args.embeddings}")
+        sys.exit(1)
+
+    matrix, labels, folders = EmbeddingStore(args.embeddings, import_legacy=False).load()
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    if len(matrix) < 2:
+        print("[ERROR] The gallery needs at least two embeddings.")
+        sys.exit(1)
+
+    rng = np.random.default_rng(0)
+    queries = np.arange(len(matrix))
+    if len(queries) > args.queries:
+        queries = np.sort(rng.choice(len(matrix), args.queries, replace=False))
+
+    print(f"📦 Gallery: {len(matrix)} embeddings, {len(folders)} users, {matrix.shape[1]} dimensions")
+    float32_bytes = matrix.nbytes + 4 * len(matrix)  # Rows + squared norms
+    print(f"🔢 float32: {float32_bytes / 1024:.1f} KiB scanned and in memory")
+    for precision in PRECISIONS:
+        report = compare_precision(matrix, labels, len(folders), precision, args.threshold, args.rescore, queries)
+        total = report['bytes'] + 12 * len(matrix)  # + store row (int64) and norm (float32) of every row
+        print(f"🔢 {precision}: {report['bytes'] / 1024:.1f} KiB scanned "
+              f"({100 * (1 - report['bytes'] / float32_bytes):.0f}% fewer bytes per scan), "
+              f"{total / 1024:.1f} KiB in memory ({100 * (1 - total / float32_bytes):.0f}% less, "
+              f"float32 rows read from the store file), "
+              f"max distance error {report['max_distance_error']:.5f}, "
+              f"best match changed {report['top1_changed']}/{len(queries)}, "
+              f"decision changed {report['decision_changed']}/{len(queries)}")
@@ -30,7 +30,7 @@ app.secret_key = os.getenv("SECRET_KEY")
 
 # === Register route Blueprints ===
 # These files define separate route groups for modularity
-from web.routes.auth_routes import auth_bp       # Routes for login/logout
+from web.routes.auth_routes import auth_bp, sock # Routes for login/logout (and the WebSocket login stream)
 from web.routes.admin_routes import admin_bp     # Routes for admin dashboard and user control
 from web.routes.face_routes import face_bp       # Routes for facial recognition and embedding management
 
@@ -43,6 +43,7 @@ from recognize_m import FaceRecognizer
 from generate_multiple_embeddings_m import EmbeddingGenerator
 
 # === Register blueprints to attach their routes to the Flask app ===
+sock.init_app(app)  # WebSocket support (flask-sock) for the streaming face login
 app.register_blueprint(auth_bp)
 app.register_blueprint(admin_bp)
 app.register_blueprint(face_bp)
@@ -10,15 +10,17 @@
 # - Access the dashboard
 # - Add new users
 # - Remove users
+# - Inspect the inference pool metrics
 # - Logout of their session
 # ============================================
 
 # === Flask and Python standard imports ===
-from flask import Blueprint, render_template, request, redirect, url_for, session
+from flask import Blueprint, render_template, request, redirect, url_for, session, jsonify
 
 # === Internal helper functions to read/write users from JSON file ===
 from utils.user_db import load_users, save_users
 from web.routes.auth_routes import recognizer
+from web.routes.face_routes import embedder
 
 # === Password hashing and file system handling ===
 import bcrypt  # Secure password hashing
@@ -137,15 +139,36 @@ def admin_remove():
         )
 
 
+        # Remove the user's embeddings from the packed store and from the global face recognizer
+        removed = recognizer.delete_user(folder)
+        print(f"[INFO] {removed} embeddings de {folder} removidos do ficheiro de embeddings")
+
+        # Legacy .pkl folder (from before the packed store)
         folder_path = os.path.join('..', 'embeddings', folder)
         if os.path.exists(folder_path):
             shutil.rmtree(folder_path)
             print(f"[INFO] Pasta de embeddings {folder_path} removida")
-
-                # Reload embeddings in the global face recognizer
-        recognizer.known_embeddings = recognizer.load_known_embeddings()
-        print("[DEBUG] Embeddings recarregados após remoção do utilizador")
     else:
         print("[WARN] Nenhum utilizador encontrado com o folder fornecido")
 
-    return redirect(url_for('admin.dashboard'))
\ No newline at end of file
+    return redirect(url_for('admin.dashboard'))
+
+# === Inference Pool Metrics ===
+@admin_bp.route('/admin/pool-stats')
+def pool_stats():
+    """
+    Returns the interpreter/detector pool metrics (checkouts, waits, wait times)
+    so contention between concurrent requests can be monitored.
+    """
+    if 'user' not in session or session.get('role') != 'admin':
+        return redirect(url_for('auth.manual_login'))
+
+    # Both classes usually share one engine; list each pool once
+    engines = {id(engine): engine for engine in (recognizer.engine, embedder.engine)}.values()
+    pools = [pool for engine in engines
+             for pool in (engine.interpreter_pool, engine.detector_pool, engine.preview_detector_pool)]
+    return jsonify({
+        "success": True,
+        "message": "Inference pool metrics.",
+        "data": [pool.stats() for pool in pools]
+    })
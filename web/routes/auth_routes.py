@@ -8,16 +8,21 @@
 # This module handles all authentication-related routes for the FaceAuth platform.
 # It supports:
 # - Manual login using email and password
-# - Face recognition login via webcam
+# - Face recognition login via webcam (single frames over HTTP, or a
+#   continuous frame stream over a WebSocket)
+# - Face verification login for a claimed email (1:1 match)
 # - Logout
 # - Redirecting users to their respective dashboard based on their role
 # ============================================
 
 # === Flask and utility imports ===
-from flask import Blueprint, render_template, request, redirect, url_for, session, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, session, jsonify, current_app
+from flask_sock import Sock                  # WebSocket routes (streaming face login)
+from itsdangerous import URLSafeTimedSerializer, BadSignature  # Signed login tokens (shipped with Flask)
 
 # === Import custom user DB utilities ===
-from utils.user_db import load_users
+from utils.user_db import load_users, get_user_folder
+from utils.image_io import read_request_frame, request_fields, decode_image
 
 from utils.discord import send_discord_notification
 from datetime import datetime
@@ -29,18 +34,22 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.
 
 # === Standard Python imports ===
 from datetime import datetime  # Used to store login time in session
-import base64                  # For decoding image sent from client
+import json                    # For the messages of the login stream
+import time                    # For the login stream timeout
 import numpy as np             # For image array handling
-from PIL import Image          # For handling and converting image files
-from io import BytesIO         # For reading image bytes
 import bcrypt                  # For verifying hashed passwords
-import pickle
 
 # === Import facial recognition logic ===
 from recognize_m import FaceRecognizer
 
 # === Define authentication Blueprint ===
 auth_bp = Blueprint('auth', __name__)
+sock = Sock()  # Initialized with the app in app.py
+
+# === Streaming login settings ===
+STREAM_STABLE_FRAMES = int(os.getenv("FACEAUTH_STREAM_STABLE_FRAMES", 2))  # Consecutive frames with the same match
+STREAM_TIMEOUT = float(os.getenv("FACEAUTH_STREAM_TIMEOUT", 15))  # Seconds before the stream gives up
+LOGIN_TOKEN_MAX_AGE = 30  # Seconds a stream login token stays valid
 
 # === Initialize face recognizer once when the module is loaded ===
 recognizer = FaceRecognizer()
@@ -92,26 +101,16 @@ def face_login_page():
     """
     return render_template('face_login.html')
 
-# === Face Login POST Handler ===
-@auth_bp.route('/face-login', methods=['POST'])
-def face_login():
+def recognize_frame(frame):
     """
-    Receives an image from the front-end (Base64),
-    runs facial recognition, and logs the user in if matched.
-    Returns a JSON response indicating success or failure.
+    Detects the first face in 'frame' and searches the gallery for it.
+    Returns a tuple (name, suggestions, embedding):
+    - name: the matched user folder, or "Unknown"
+    - suggestions: the 3 closest user folders
+    - embedding: the face embedding (None if no valid face was found)
     """
-    data = request.get_json()
-
-    # Decode base64 image
-    image_data = data['image'].split(',')[1]
-    image_bytes = base64.b64decode(image_data)
-    image = Image.open(BytesIO(image_bytes)).convert('RGB')
-    frame = np.array(image)
-
     # Detect faces
     faces = recognizer.detect_faces(frame)
-    suggestions = []
-
     if faces:
         (x, y, w, h) = faces[0]
 
@@ -122,58 +121,59 @@ def face_login():
             # Double-check validity
             if face_crop.size > 0:
                 embedding = recognizer.get_embedding(face_crop)
-                name, dist = recognizer.recognize_face(embedding, recognizer.known_embeddings)
 
-                if name != "Unknown":
-                    session['temp_embedding'] = embedding.tolist() 
-                    users = load_users()
-                    for email, user in users.items():
-                        if user.get('folder') == name:
-                            session['user'] = email
-                            session['login_time'] = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-                            session['role'] = user.get('role')
-
-                            # Suggest similar users
-                            all_distances = []
-                            for folder_name, embeddings_list in recognizer.known_embeddings.items():
-                                for known_emb in embeddings_list:
-                                    dist = np.linalg.norm(embedding - known_emb)
-                                    all_distances.append((folder_name, dist))
-
-                            all_distances.sort(key=lambda x: x[1])
-                            seen = set()
-                            for folder_name, _ in all_distances:
-                                if folder_name not in seen:
-                                    suggestions.append(folder_name)
-                                    seen.add(folder_name)
-                                    if len(suggestions) == 3:
-                                        break
-
-                            return jsonify({
-                                "success": True,
-                                "message": "User recognized successfully.",
-                                "data": {
-                                    "user": name,
-                                    "redirect": "/admin/dashboard" if user.get('role') == 'admin' else "/user",
-                                    "suggestions": suggestions
-                                }
-                            })
-
-                # Fallback: generate suggestions if embedding exists
-                all_distances = []
-                for folder_name, embeddings_list in recognizer.known_embeddings.items():
-                    for known_emb in embeddings_list:
-                        dist = np.linalg.norm(embedding - known_emb)
-                        all_distances.append((folder_name, dist))
-
-                all_distances.sort(key=lambda x: x[1])
-                seen = set()
-                for folder_name, _ in all_distances:
-                    if folder_name not in seen:
-                        suggestions.append(folder_name)
-                        seen.add(folder_name)
-                        if len(suggestions) == 3:
-                            break
+                # Single gallery scan: best match plus the 3 closest users as suggestions
+                name, dist, closest_users = recognizer.search(embedding, k=3)
+                return name, [folder_name for folder_name, _ in closest_users], embedding
+
+    return "Unknown", [], None
+
+def find_user_by_folder(folder):
+    """
+    Returns (email, user) of the user whose embedding folder is 'folder', or (None, None).
+    """
+    for email, user in load_users().items():
+        if user.get('folder') == folder:
+            return email, user
+    return None, None
+
+def login_token_serializer():
+    """
+    Signs the tokens that turn a stream match into a session (see /face-login/complete).
+    """
+    return URLSafeTimedSerializer(current_app.secret_key, salt='face-login-stream')
+
+# === Face Login POST Handler ===
+@auth_bp.route('/face-login', methods=['POST'])
+def face_login():
+    """
+    Receives an image from the front-end (raw JPEG body, multipart upload
+    or Base64 JSON), runs facial recognition, and logs the user in if matched.
+    Returns a JSON response indicating success or failure.
+    """
+    # Decode the image (at a reduced scale for large JPEG frames)
+    frame, _ = read_request_frame(request)
+    if frame is None:
+        return jsonify({"success": False, "message": "No image provided."}), 400
+
+    name, suggestions, embedding = recognize_frame(frame)
+    if name != "Unknown":
+        email, user = find_user_by_folder(name)
+        if email:
+            session['temp_embedding'] = embedding.tolist()
+            session['user'] = email
+            session['login_time'] = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+            session['role'] = user.get('role')
+
+            return jsonify({
+                "success": True,
+                "message": "User recognized successfully.",
+                "data": {
+                    "user": name,
+                    "redirect": "/admin/dashboard" if user.get('role') == 'admin' else "/user",
+                    "suggestions": suggestions
+                }
+            })
 
     send_discord_notification("🔴 Tentativa de login falhada. Rosto não reconhecido.")
 
@@ -186,6 +186,135 @@ def face_login():
         }
     })
 
+# === Streaming Face Login (WebSocket) ===
+@sock.route('/face-login/stream', bp=auth_bp)
+def face_login_stream(ws):
+    """
+    Receives a continuous stream of JPEG frames (binary messages) over one
+    WebSocket and answers as soon as the match is stable:
+    - Only the latest frame is processed; frames that arrived meanwhile are dropped.
+    - Each processed frame is answered with a 'progress' message; frames that
+      cannot be decoded are skipped.
+    - Once the same user is matched in STREAM_STABLE_FRAMES consecutive frames,
+      a 'success' message carries a signed token that the page exchanges for a
+      session at /face-login/complete (cookies cannot be set over a WebSocket).
+    - After STREAM_TIMEOUT seconds without a stable match, a 'failure' message is sent.
+    """
+    deadline = time.monotonic() + STREAM_TIMEOUT
+    candidate, streak, suggestions = None, 0, []
+
+    while time.monotonic() < deadline:
+        data = ws.receive(timeout=deadline - time.monotonic())
+        if data is None:
+            break  # Timed out waiting for a frame
+        while True:
+            newer = ws.receive(timeout=0)  # Drop stale frames: keep only the most recent one
+            if newer is None:
+                break
+            data = newer
+        if isinstance(data, str):
+            continue  # Only binary JPEG frames are expected
+
+        try:
+            frame, _ = decode_image(data)
+        except (OSError, ValueError):
+            print("[WARNING] Skipping an undecodable frame in the login stream.")
+            continue  # A corrupted frame must not end the stream
+        name, suggestions, embedding = recognize_frame(frame)
+        streak = streak + 1 if name != "Unknown" and name == candidate else int(name != "Unknown")
+        candidate = name
+        ws.send(json.dumps({"type": "progress", "match": None if name == "Unknown" else name, "stable": streak}))
+
+        if streak >= STREAM_STABLE_FRAMES:
+            email, user = find_user_by_folder(name)
+            if email:
+                token = login_token_serializer().dumps({"email": email, "embedding": embedding.tolist()})
+                ws.send(json.dumps({
+                    "type": "success",
+                    "token": token,
+                    "user": name,
+                    "redirect": "/admin/dashboard" if user.get('role') == 'admin' else "/user",
+                    "suggestions": suggestions
+                }))
+                return
+
+    send_discord_notification("🔴 Tentativa de login falhada. Rosto não reconhecido.")
+    ws.send(json.dumps({"type": "failure", "message": "User not recognized.", "suggestions": suggestions}))
+
+@auth_bp.route('/face-login/complete', methods=['POST'])
+def face_login_complete():
+    """
+    Exchanges the token sent by the login stream for a session.
+    Returns a JSON response indicating success or failure.
+    """
+    token = (request.get_json() or {}).get('token', '')
+    try:
+        data = login_token_serializer().loads(token, max_age=LOGIN_TOKEN_MAX_AGE)
+    except BadSignature:
+        return jsonify({"success": False, "message": "Invalid or expired token."}), 403
+
+    user = load_users().get(data['email'])
+    if not user:
+        return jsonify({"success": False, "message": "Unknown user."}), 403
+
+    session['temp_embedding'] = data['embedding']
+    session['user'] = data['email']
+    session['login_time'] = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+    session['role'] = user.get('role')
+    return jsonify({"success": True, "message": "User recognized successfully."})
+
+# === Face Verification POST Handler (claimed identity) ===
+@auth_bp.route('/face-verify', methods=['POST'])
+def face_verify():
+    """
+    Receives an email and an image (raw JPEG body with ?email=..., multipart
+    upload or Base64 JSON) and checks the face only against the embeddings
+    of that user (1:1), instead of searching every user.
+    Logs the user in if the face matches.
+    Returns a JSON response indicating success or failure. An unknown email gets
+    the same answer as a face that does not match, so accounts cannot be enumerated.
+    """
+    email = request_fields(request).get('email', '').strip()
+    folder = get_user_folder(email)  # None for an unknown email: treated as a mismatch below
+
+    # Decode the image (at a reduced scale for large JPEG frames)
+    frame, _ = read_request_frame(request)
+    if frame is None:
+        return jsonify({"success": False, "message": "No image provided."}), 400
+
+    # Detect faces
+    faces = recognizer.detect_faces(frame)
+    if faces:
+        (x, y, w, h) = faces[0]
+
+        # Validate coordinates
+        if x >= 0 and y >= 0 and w > 0 and h > 0 and x + w <= frame.shape[1] and y + h <= frame.shape[0]:
+            face_crop = frame[y:y+h, x:x+w]
+
+            if face_crop.size > 0:
+                embedding = recognizer.get_embedding(face_crop)
+                verified, dist = recognizer.verify(folder, embedding) if folder else (False, None)
+                print(f"[DEBUG] Verification of {email}: distance {dist}")
+
+                if verified:
+                    users = load_users()
+                    session['temp_embedding'] = embedding.tolist()
+                    session['user'] = email
+                    session['login_time'] = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+                    session['role'] = users.get(email, {}).get('role')
+
+                    return jsonify({
+                        "success": True,
+                        "message": "User verified successfully.",
+                        "data": {
+                            "user": folder,
+                            "redirect": "/admin/dashboard" if session['role'] == 'admin' else "/user"
+                        }
+                    })
+
+    send_discord_notification(f"🔴 Verificação facial falhada para {email}.")
+    return jsonify({"success": False, "message": "Face does not match this user."})
+
 @auth_bp.route('/confirm-face-login', methods=['POST'])
 def confirm_face_login():
     if 'user' not in session or 'temp_embedding' not in session:
@@ -199,35 +328,29 @@ def confirm_face_login():
     users = load_users()
     folder = users[email]['folder']
 
+    recognizer.sync_gallery(wait=True)  # Another worker may have enrolled embeddings for this user
     existing_embeddings = recognizer.known_embeddings.get(folder, [])
     should_save = False
+    # Euclidean thresholds translated to the scoring mode (unchanged in compatibility mode)
+    known_limit = recognizer.translate_threshold(0.5)
+    save_limit = recognizer.translate_threshold(1.2)
 
     for emb in existing_embeddings:
-        dist = np.linalg.norm(new_embedding - emb)
+        dist = recognizer.distance(new_embedding, emb)
         print(f"[DEBUG] Distance to existing embedding: {dist:.3f}")
-        if dist < 0.5:
+        if dist < known_limit:
             print("[DEBUG] Embedding already known. Will not be saved.")
             return jsonify({"success": True, "message": "Embedding already exists. No need to save."})
-        elif 0.5 < dist < 1.2:
+        elif known_limit < dist < save_limit:
             should_save = True
 
     if not should_save:
         print("[DEBUG] Embedding outside allowed range. Not saved.")
         return jsonify({"success": False, "message": "Embedding too different. Not saved."})
 
-    user_dir = os.path.join('..', 'embeddings', folder)
-    os.makedirs(user_dir, exist_ok=True)
-
-    existing_files = [f for f in os.listdir(user_dir) if f.endswith(".pkl")]
-    next_index = len(existing_files)
-    filename = os.path.join(user_dir, f"{folder}_{next_index:02d}.pkl")
-
-    with open(filename, "wb") as f:
-        pickle.dump(new_embedding, f)
-
-    print(f"[DEBUG] New embedding saved in{filename}")
+    row = recognizer.save_embeddings(folder, [new_embedding])[0]
 
-    recognizer.known_embeddings = recognizer.load_known_embeddings()
+    print(f"[DEBUG] New embedding saved for {folder} at row {row}")
 
     return jsonify({"success": True, "message": "New embedding saved to improve recognition accuracy."})
 
@@ -7,36 +7,40 @@
 # Description:
 # This module defines all the routes for:
 # - User creation by the admin
-# - Capturing and saving facial embeddings
-# - Face detection visualization for bounding box preview
+# - Capturing and saving facial embeddings (one frame or a batch of frames)
+# - Server-side capture jobs (uploaded frames, video file or camera) with a status route
+# - Face detection visualization for bounding box preview (detection-only
+#   fast path on a downscaled frame, with its own detectors)
 # ============================================
 
 # === Flask and standard libraries ===
 from flask import Blueprint, render_template, request, jsonify, redirect, url_for, session
 import sys
 import os
+import tempfile
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 from datetime import datetime
 
 # === Custom Modules ===
 from generate_multiple_embeddings_m import EmbeddingGenerator
 from utils.user_db import load_users, save_users
+from utils.image_io import decode_image, read_request_frame, request_fields, request_images_bytes
 from web.routes.auth_routes import recognizer
 from utils.email_notify import send_email_notification
+from utils.capture_jobs import FRAME_SOURCES, start_capture_job, get_capture_job
 
 # === Data processing and security ===
-import base64
-import numpy as np
-import pickle
-from PIL import Image
-from io import BytesIO
 import bcrypt
 
 # === Define Blueprint for face-related routes ===
 face_bp = Blueprint('face', __name__)
 
 # === Initialize embedding generator globally (loads model once) ===
-embedder = EmbeddingGenerator()
+embedder = EmbeddingGenerator(recognizer=recognizer)  # Saves through the recognizer's store
+
+# === Bounding-box preview settings ===
+PREVIEW_MAX_SIDE = int(os.getenv("FACEAUTH_PREVIEW_MAX_SIDE", 320))  # Longest side previews are decoded at
+PREVIEW_WAIT = 0.2  # Seconds a preview waits for a free preview detector before giving up (429)
 
 # === Admin view to access the user registration page ===
 @face_bp.route('/admin/generate')
@@ -69,8 +73,8 @@ def create_user():
     if email in users:
         return "Email already exists", 400
 
-    # Check if folder with same name exists
-    if os.path.exists(folder_path):
+    # Check if folder with same name exists (legacy folder or packed store)
+    if os.path.exists(folder_path) or recognizer.store.has_user(folder):
         return "Folder name already exists", 400
 
     # Hash and store the password securely
@@ -104,22 +108,27 @@ def create_user():
 @face_bp.route('/admin/save-embedding', methods=['POST'])
 def save_embedding():
     """
-    Receives a base64 image, detects a face, and saves the embedding.
+    Receives an image (multipart upload, raw JPEG body with the fields in the
+    query string, or Base64 JSON), detects a face, and saves the embedding.
     Supports:
-      - 'drawOnly' mode: returns bounding box for preview
-      - 'save' mode: stores the embedding on disk
+      - 'drawOnly' mode: returns bounding box for preview (handled by face_preview)
+      - 'save' mode: appends the embedding to the packed embedding store
 
-    Returns status and bounding box coordinates if applicable.
+    Returns status and bounding box coordinates if applicable
+    (in the coordinates of the uploaded image).
     """
-    data = request.get_json()
-    folder = data['folder']
-    draw_only = data.get('drawOnly', False)
+    data = request_fields(request)
+    folder = data.get('folder')
+    draw_only = data.get('drawOnly', False) in (True, 'true', '1')
+    if not folder:
+        return "folder not provided", 400
+    if draw_only:
+        return face_preview()  # Older clients: same detection-only fast path
 
-    # Decode base64 image into NumPy array
-    image_data = data['image'].split(',')[1]
-    image_bytes = base64.b64decode(image_data)
-    image = Image.open(BytesIO(image_bytes)).convert('RGB')
-    frame = np.array(image)
+    # Decode the image into a NumPy array (at a reduced scale for large JPEG frames)
+    frame, _ = read_request_frame(request)
+    if frame is None:
+        return "No image provided", 400
 
     # Detect faces in image
     faces = embedder.detect_faces(frame)
@@ -131,48 +140,108 @@ def save_embedding():
     if face_crop.size == 0:
         return "Invalid face crop", 400
 
-    if draw_only:
-        return jsonify({
-            "success": True,
-            "message": "Face detected. Returning bounding box.",
-            "data": {
-                "x": int(x),
-                "y": int(y),
-                "w": int(w),
-                "h": int(h)
-            }
-        })
-
     # Get face embedding
     embedding = embedder.get_embedding(face_crop)
 
-    # Create path if not exists
-    path = os.path.join('..', 'embeddings', folder)
-    os.makedirs(path, exist_ok=True)
+    # Append the embedding to the packed embedding store and to the global recognizer gallery
+    row = recognizer.save_embeddings(folder, [embedding])[0]
 
-    # Find next available index to avoid overwriting
-    existing_files = [f for f in os.listdir(path) if f.endswith('.pkl') and f.startswith(folder + "_")]
-    indices = []
-    for fname in existing_files:
-        try:
-            number = int(fname.replace(folder + "_", "").replace(".pkl", ""))
-            indices.append(number)
-        except:
-            continue
-    next_index = max(indices) + 1 if indices else 0
+    print(f"[DEBUG] Saved embedding for {folder} at row {row}")
+
+
+    return "Saved successfully", 200
+
+@face_bp.route('/admin/face-preview', methods=['POST'])
+def face_preview():
+    """
+    Detection-only fast path for the bounding-box preview of the enrollment pages.
+    - Decodes the frame at a small size (FACEAUTH_PREVIEW_MAX_SIDE)
+    - Runs face detection only, on the separate preview detector pool, so previews
+      never take a detector from enrollments and logins
+    - Answers 429 instead of queuing when every preview detector is busy
+
+    Returns the bounding box in the coordinates of the uploaded image.
+    Only accessible to authenticated admins.
+    """
+    if 'user' not in session or session.get('role') != 'admin':
+        return redirect(url_for('auth.manual_login'))
+    frame, scale = read_request_frame(request, max_side=PREVIEW_MAX_SIDE)
+    if frame is None:
+        return "No image provided", 400
+
+    try:
+        faces = embedder.detect_faces_preview(frame, timeout=PREVIEW_WAIT)
+    except TimeoutError:
+        return jsonify({"success": False, "message": "Preview busy, try again."}), 429
+    if not faces:
+        return "No face detected", 400
+
+    (x, y, w, h) = faces[0]
+    return jsonify({
+        "success": True,
+        "message": "Face detected. Returning bounding box.",
+        "data": {
+            "x": int(x * scale),
+            "y": int(y * scale),
+            "w": int(w * scale),
+            "h": int(h * scale)
+        }
+    })
+
+@face_bp.route('/admin/save-embeddings', methods=['POST'])
+def save_embeddings():
+    """
+    Bulk enrollment: receives several frames in one request (repeated multipart
+    'image' parts, or JSON with a list of Base64 data URLs in 'images').
+    - Detects the face of each frame; frames without a usable face are skipped
+    - Embeds every face crop in one batched inference
+    - Appends all embeddings to the store in one commit and updates the gallery once
+
+    Returns the number of accepted frames, the number of embeddings kept in the
+    gallery (lower when FACEAUTH_MAX_EMBEDDINGS_PER_USER drops some) and the
+    skipped frames (index and reason). Only accessible to authenticated admins.
+    """
+    if 'user' not in session or session.get('role') != 'admin':
+        return redirect(url_for('auth.manual_login'))
+    data = request_fields(request)
+    folder = data.get('folder')
+    if not folder:
+        return "folder not provided", 400
 
-    save_path = os.path.join(path, f"{folder}_{next_index:02d}.pkl")
-    with open(save_path, "wb") as f:
-        pickle.dump(embedding, f)
+    images = request_images_bytes(request)
+    if not images:
+        return "No image provided", 400
 
+    # Detect one face per frame and collect the crops
+    crops, skipped = [], []
+    for index, image_bytes in enumerate(images):
+        try:
+            frame, _ = decode_image(image_bytes)
+        except OSError:
+            skipped.append({"index": index, "reason": "Invalid image"})
+            continue
+        faces = embedder.detect_faces(frame)
+        if not faces:
+            skipped.append({"index": index, "reason": "No face detected"})
+            continue
+        (x, y, w, h) = faces[0]
+        face_crop = frame[y:y+h, x:x+w]
+        if face_crop.size == 0:
+            skipped.append({"index": index, "reason": "Invalid face crop"})
+            continue
+        crops.append(face_crop)
 
-    print(f"[DEBUG] Saved embedding: {save_path}")
+    if not crops:
+        return jsonify({"success": False, "accepted": 0, "saved": 0, "skipped": skipped,
+                        "message": "No face detected in any frame."}), 400
 
-    # Update global recognizer embeddings
-    recognizer.known_embeddings = recognizer.load_known_embeddings()
+    # One batched inference for all crops, one store commit and gallery update
+    embeddings = embedder.get_embeddings(crops)
+    rows = recognizer.save_embeddings(folder, embeddings)
 
+    print(f"[DEBUG] Saved {len(rows)} embeddings for {folder} ({len(skipped)} frames skipped)")
 
-    return "Saved successfully", 200
+    return jsonify({"success": True, "accepted": len(crops), "saved": len(rows), "skipped": skipped})
 
 
 from flask import request, render_template
@@ -186,7 +255,71 @@ def capture_more_embeddings():
 
 @face_bp.route('/admin/capture-more/process', methods=['POST'])
 def capture_embeddings_process():
-    folder = request.form.get('folder')
-    num_embeddings = int(request.form.get('num_embeddings', 5))
-    
-    return f"Capture {num_embeddings} embeddings for {folder}"
+    """
+    Starts a server-side capture job for a folder and returns immediately (202).
+    Fields: 'folder', 'num_embeddings' (1-100, default 5) and 'source':
+      - 'upload': frames sent with the request (repeated multipart 'image' parts)
+      - 'video': a video file sent as the multipart 'video' part
+      - 'camera': the device camera
+    Without 'source', the uploaded video or frames are used, otherwise the camera.
+
+    Returns the job id and the URL to poll for its progress.
+    Only accessible to authenticated admins.
+    """
+    if 'user' not in session or session.get('role') != 'admin':
+        return redirect(url_for('auth.manual_login'))
+    data = request_fields(request)
+    folder = data.get('folder')
+    if not folder:
+        return "folder not provided", 400
+    try:
+        num_embeddings = int(data.get('num_embeddings', 5))
+    except ValueError:
+        return "Invalid num_embeddings", 400
+    if not 1 <= num_embeddings <= 100:
+        return "num_embeddings must be between 1 and 100", 400
+
+    source = data.get('source') or ('video' if 'video' in request.files else
+                                    'upload' if 'image' in request.files else 'camera')
+    if source not in FRAME_SOURCES:
+        return f"Unknown source: {source}", 400
+
+    # Read everything the job needs from the request before it ends
+    if source == 'upload':
+        images = request_images_bytes(request)
+        if not images:
+            return "No image provided", 400
+        source_args = (images,)
+    elif source == 'video':
+        video = request.files.get('video')
+        if video is None:
+            return "No video provided", 400
+        fd, video_path = tempfile.mkstemp(suffix=os.path.splitext(video.filename or '')[1] or '.mp4')
+        with os.fdopen(fd, 'wb') as f:
+            video.save(f)  # Deleted by the frame source once the job is done
+        source_args = (video_path,)
+    else:
+        source_args = ()
+
+    job = start_capture_job(folder, num_embeddings, source, source_args, embedder, recognizer)
+    print(f"[INFO] Started capture job {job.id} for {folder} ({num_embeddings} embeddings from {source})")
+
+    return jsonify({
+        "job_id": job.id,
+        "status_url": url_for('face.capture_job_status', job_id=job.id)
+    }), 202
+
+@face_bp.route('/admin/capture-more/status/<job_id>', methods=['GET'])
+def capture_job_status(job_id):
+    """
+    Returns the progress of a capture job as JSON (404 if unknown or expired).
+    The progress is read from the job file, so any worker process can answer.
+    Only accessible to authenticated admins.
+    """
+    if 'user' not in session or session.get('role') != 'admin':
+        return redirect(url_for('auth.manual_login'))
+
+    progress = get_capture_job(job_id)
+    if progress is None:
+        return jsonify({"error": "Unknown capture job"}), 404
+    return jsonify(progress)
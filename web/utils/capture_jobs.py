@@ -0,0 +1,307 @@
+# ============================================
+# Server-Side Capture Jobs
+# File: capture_jobs.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-06-11
+#
+# Description:
+# This module runs the "capture more embeddings" work for a user folder in a
+# background thread, so the request that starts it returns immediately:
+# - Frames come from a pluggable frame source (FRAME_SOURCES): frames uploaded
+#   with the request, an uploaded video file, or the device camera.
+# - Every frame goes through a quality filter (exactly one face, large enough,
+#   sharp enough, not too dark or too bright).
+# - Accepted face crops are embedded in batches (one invoke per batch) and
+#   each batch is saved with one store commit.
+# - Progress is kept in a CaptureJob object and written to one JSON file per
+#   job (FACEAUTH_CAPTURE_JOBS_DIR), so the status route answers from any
+#   worker process, not only from the one running the job.
+# ============================================
+
+import json  # Job progress files
+import os  # Settings from the environment and temporary video files
+import re  # Job id validation
+import tempfile  # Default directory of the job progress files
+import threading  # Background job threads
+import time  # Job timeout and finished job cleanup
+import uuid  # Job identifiers
+
+import cv2  # Video decoding and frame quality measures
+
+from utils.image_io import decode_image
+
+# === Capture settings ===
+CAPTURE_BATCH_SIZE = int(os.getenv("FACEAUTH_CAPTURE_BATCH_SIZE", 8))  # Face crops embedded per invoke
+CAPTURE_TIMEOUT = float(os.getenv("FACEAUTH_CAPTURE_TIMEOUT", 120))  # Seconds before a job gives up
+CAPTURE_MIN_FACE = int(os.getenv("FACEAUTH_CAPTURE_MIN_FACE", 64))  # Smallest face side accepted (pixels)
+CAPTURE_MIN_SHARPNESS = float(os.getenv("FACEAUTH_CAPTURE_MIN_SHARPNESS", 40))  # Variance of the Laplacian
+CAPTURE_BRIGHTNESS = (40, 220)  # Accepted mean gray level of the face crop
+VIDEO_FRAME_STEP = int(os.getenv("FACEAUTH_CAPTURE_FRAME_STEP", 5))  # Every Nth frame of a video is examined
+CAMERA_INTERVAL = 0.3  # Seconds between two camera frames, so the captures differ
+FINISHED_JOB_TTL = 3600  # Seconds a finished job stays available to the status route
+PROGRESS_INTERVAL = 0.5  # Seconds between two progress file updates of a running job
+JOBS_DIR = os.getenv("FACEAUTH_CAPTURE_JOBS_DIR",  # Shared by every worker process of the node
+                     os.path.join(tempfile.gettempdir(), "faceauth-capture-jobs"))
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")  # uuid4().hex
+
+_camera_lock = threading.Lock()  # The camera can only be used by one job at a time
+
+
+# === Frame sources (generators of RGB frames) ===
+
+def uploaded_frames(images):
+    """
+    Yields the frames uploaded with the request (encoded images), skipping invalid ones.
+    """
+    for image_bytes in images:
+        try:
+            yield decode_image(image_bytes)[0]
+        except OSError:
+            print("[WARNING] Skipping an uploaded frame that is not a valid image")
+
+def video_frames(path, step=VIDEO_FRAME_STEP):
+    """
+    Yields every 'step'-th frame of a video file and deletes the file afterwards
+    (uploaded videos are saved to a temporary file by the route).
+    """
+    capture = cv2.VideoCapture(path)
+    try:
+        index = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            if index % step == 0:
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            index += 1
+    finally:
+        capture.release()
+        os.remove(path)
+
+def camera_frames(interval=CAMERA_INTERVAL):
+    """
+    Yields frames from the device camera (Picamera2, or OpenCV camera 0 when
+    Picamera2 is not available) until the job stops reading.
+    """
+    if not _camera_lock.acquire(blocking=False):
+        raise RuntimeError("The camera is being used by another capture job")
+    try:
+        try:
+            from picamera2 import Picamera2
+        except ImportError:
+            Picamera2 = None
+
+        if Picamera2 is not None:
+            picam2 = Picamera2()
+            picam2.configure(picam2.create_video_configuration(main={"format": "RGB888", "size": (640, 480)}))
+            picam2.start()
+            read, close = (lambda: picam2.capture_array()), picam2.close  # 'RGB888' arrays are in BGR order
+        else:
+            capture = cv2.VideoCapture(0)
+            read, close = (lambda: capture.read()[1]), capture.release
+        try:
+            while True:
+                frame = read()
+                if frame is None:
+                    raise RuntimeError("Could not read a frame from the camera")
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                time.sleep(interval)
+        finally:
+            close()
+    finally:
+        _camera_lock.release()
+
+# Name used in the request ('source') -> frame source
+FRAME_SOURCES = {
+    "upload": uploaded_frames,
+    "video": video_frames,
+    "camera": camera_frames,
+}
+
+
+# === Quality filter ===
+
+def check_quality(frame, faces):
+    """
+    Checks whether a frame is good enough to be enrolled.
+    Returns (face_crop, None) for an accepted frame, or (None, reason) otherwise.
+    """
+    if not faces:
+        return None, "no face"
+    if len(faces) > 1:
+        return None, "several faces"
+
+    (x, y, w, h) = faces[0]
+    if min(w, h) < CAPTURE_MIN_FACE:
+        return None, "face too small"
+    face_crop = frame[y:y+h, x:x+w]
+    if face_crop.size == 0:
+        return None, "invalid face crop"
+
+    gray = cv2.cvtColor(face_crop, cv2.COLOR_RGB2GRAY)
+    if not CAPTURE_BRIGHTNESS[0] <= gray.mean() <= CAPTURE_BRIGHTNESS[1]:
+        return None, "bad lighting"
+    if cv2.Laplacian(gray, cv2.CV_64F).var() < CAPTURE_MIN_SHARPNESS:
+        return None, "blurry"
+    return face_crop, None
+
+
+# === Class holding the state of one capture job ===
+class CaptureJob:
+    def __init__(self, folder, num_embeddings, source):
+        """
+        Creates a queued job that captures 'num_embeddings' embeddings for 'folder'
+        from the frame source named 'source'.
+        """
+        self.id = uuid.uuid4().hex
+        self.folder = folder
+        self.num_embeddings = num_embeddings
+        self.source = source
+        self.status = "queued"  # queued -> running -> done / failed
+        self.error = None
+        self.frames_examined = 0
+        self.frames_accepted = 0
+        self.saved = 0  # Embeddings saved to the store so far
+        self.rejected = {}  # Reason -> number of rejected frames
+        self.started_at = time.time()
+        self.finished_at = None
+        self._published_at = 0.0  # Last write of the progress file
+
+    def to_dict(self):
+        """
+        Returns the progress of the job (used by the status route).
+        """
+        return {
+            "job_id": self.id,
+            "folder": self.folder,
+            "source": self.source,
+            "status": self.status,
+            "error": self.error,
+            "requested": self.num_embeddings,
+            "frames_examined": self.frames_examined,
+            "frames_accepted": self.frames_accepted,
+            "saved": self.saved,
+            "rejected": dict(self.rejected),
+            "elapsed": round((self.finished_at or time.time()) - self.started_at, 1),
+        }
+
+    def publish(self, force=True):
+        """
+        Writes the progress to the job file (atomically: temporary file + rename),
+        at most every PROGRESS_INTERVAL seconds unless 'force' is set.
+        """
+        now = time.time()
+        if not force and now - self._published_at < PROGRESS_INTERVAL:
+            return
+        self._published_at = now
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        path = _job_path(self.id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    def run(self, frames, embedder, recognizer):
+        """
+        Reads frames until enough were accepted, the source is exhausted or the job times out.
+        Accepted crops are embedded and saved every CAPTURE_BATCH_SIZE frames.
+        """
+        self.status = "running"
+        self.publish()
+        crops = []
+        try:
+            deadline = time.time() + CAPTURE_TIMEOUT
+            for frame in frames:
+                self.frames_examined += 1
+                face_crop, reason = check_quality(frame, embedder.detect_faces(frame))
+                if face_crop is None:
+                    self.rejected[reason] = self.rejected.get(reason, 0) + 1
+                else:
+                    crops.append(face_crop)
+                    self.frames_accepted += 1
+                    if len(crops) == CAPTURE_BATCH_SIZE:
+                        self._save(crops, embedder, recognizer)
+                        crops = []
+
+                self.publish(force=False)
+
+                if self.frames_accepted >= self.num_embeddings:
+                    break
+                if time.time() > deadline:
+                    self.error = "Timed out before enough good frames were captured"
+                    break
+
+            if crops:
+                self._save(crops, embedder, recognizer)
+            if self.frames_accepted < self.num_embeddings and self.error is None:
+                self.error = "Not enough good frames in the source"
+            self.status = "done" if self.frames_accepted >= self.num_embeddings else "failed"
+        except Exception as e:
+            print(f"[WARNING] Capture job {self.id} for {self.folder} failed: {e}")
+            self.error = str(e)
+            self.status = "failed"
+        finally:
+            frames.close()  # Releases the camera / video file
+            self.finished_at = time.time()
+            self.publish()
+            print(f"[INFO] Capture job {self.id} for {self.folder}: {self.status}, "
+                  f"{self.saved} embeddings saved from {self.frames_examined} frames")
+
+    def _save(self, crops, embedder, recognizer):
+        """
+        Embeds a batch of face crops with one invoke and saves them with one store commit.
+        """
+        embeddings = embedder.get_embeddings(crops)
+        self.saved += len(recognizer.save_embeddings(self.folder, embeddings))
+
+
+# === Job registry (one progress file per job, shared by the worker processes) ===
+
+def _job_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+def _remove_expired_jobs():
+    """
+    Deletes the progress files not updated for FINISHED_JOB_TTL seconds
+    (running jobs update theirs while they look for frames).
+    """
+    now = time.time()
+    try:
+        files = os.listdir(JOBS_DIR)
+    except FileNotFoundError:
+        return
+    for file in files:
+        path = os.path.join(JOBS_DIR, file)
+        try:
+            if now - os.path.getmtime(path) > FINISHED_JOB_TTL:
+                os.remove(path)
+        except FileNotFoundError:
+            pass  # Removed by another worker meanwhile
+
+def start_capture_job(folder, num_embeddings, source, source_args, embedder, recognizer):
+    """
+    Starts a capture job in a background thread and returns it.
+    - 'source': a FRAME_SOURCES name, called with 'source_args'
+    - 'embedder': provides detect_faces() and get_embeddings()
+    - 'recognizer': provides save_embeddings()
+    """
+    job = CaptureJob(folder, num_embeddings, source)
+    frames = FRAME_SOURCES[source](*source_args)
+
+    _remove_expired_jobs()
+    job.publish()  # Visible to the status route of every worker before the id is returned
+    threading.Thread(target=job.run, args=(frames, embedder, recognizer), daemon=True).start()
+    return job
+
+def get_capture_job(job_id):
+    """
+    Returns the progress of the capture job with this id (see CaptureJob.to_dict),
+    read from its progress file, or None if it is unknown or expired.
+    """
+    if not JOB_ID_PATTERN.fullmatch(job_id):
+        return None  # Never build a path from an arbitrary id
+    try:
+        with open(_job_path(job_id), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
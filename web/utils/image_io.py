@@ -0,0 +1,103 @@
+# ============================================
+# Request Image Decoding
+# File: image_io.py
+# Authors: Diogo Azevedo and Letícia Loureiro
+# Date: 2025-06-09
+#
+# Description:
+# This module provides helper functions for reading the camera frame sent
+# with a request. The routes accept three formats:
+# - A raw body with an image Content-Type (e.g. 'image/jpeg' from canvas.toBlob),
+#   other fields in the query string
+# - multipart/form-data with an 'image' file part and the other fields as form fields
+# - JSON with a base64 data URL in 'image' (older clients)
+# Bulk requests carry several frames: repeated multipart 'image' parts, or
+# a JSON list of data URLs in 'images'.
+#
+# JPEG frames are decoded directly at a reduced scale (PIL draft mode, which
+# uses the 1/2, 1/4 or 1/8 scaling of the JPEG decoder), so a frame larger
+# than FACEAUTH_DECODE_MAX_SIDE pixels is never decoded at full resolution.
+# ============================================
+
+import base64
+import math
+import os
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# Longest side the frames are decoded at (0 = full resolution)
+DECODE_MAX_SIDE = int(os.getenv("FACEAUTH_DECODE_MAX_SIDE", 640))
+
+def request_fields(request):
+    """
+    Returns the fields sent with the frame (e.g. 'folder', 'email'):
+    the JSON body, or the form fields merged over the query string.
+    """
+    if request.is_json:
+        return request.get_json() or {}
+    fields = request.args.to_dict()
+    fields.update(request.form.to_dict())
+    return fields
+
+def request_image_bytes(request):
+    """
+    Returns the encoded image of a request (raw body, multipart 'image' part
+    or base64 data URL), or None if the request carries no image.
+    """
+    if request.mimetype.startswith('image/'):
+        return request.get_data() or None
+    if 'image' in request.files:
+        return request.files['image'].read() or None
+    if request.is_json:
+        data_url = (request.get_json() or {}).get('image')
+        if data_url:
+            return base64.b64decode(data_url.split(',')[-1])
+    return None
+
+def request_images_bytes(request):
+    """
+    Returns the list of encoded images of a bulk request (every multipart
+    'image' part, the JSON 'images' list, or the single image of the request).
+    """
+    if 'image' in request.files:
+        return [data for data in (part.read() for part in request.files.getlist('image')) if data]
+    if request.is_json:
+        data_urls = (request.get_json() or {}).get('images')
+        if data_urls:
+            return [base64.b64decode(data_url.split(',')[-1]) for data_url in data_urls]
+    image_bytes = request_image_bytes(request)
+    return [] if image_bytes is None else [image_bytes]
+
+def decode_image(image_bytes, max_side=DECODE_MAX_SIDE):
+    """
+    Decodes an encoded image into an RGB uint8 array.
+    JPEG images whose longest side exceeds 'max_side' are decoded at the
+    smallest reduced scale that still keeps at least 'max_side' pixels.
+
+    Returns:
+        tuple: (frame, scale), where 'scale' converts coordinates found in
+               'frame' back to the uploaded image (original width / decoded width).
+    """
+    image = Image.open(BytesIO(image_bytes))
+    width, height = image.size
+    if max_side and max(width, height) > max_side:
+        ratio = max_side / max(width, height)
+        image.draft('RGB', (math.ceil(width * ratio), math.ceil(height * ratio)))  # No-op for non-JPEG images
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return np.asarray(image), width / image.size[0]
+
+def read_request_frame(request, max_side=DECODE_MAX_SIDE):
+    """
+    Reads and decodes the frame sent with a request.
+
+    Returns:
+        tuple: (frame, scale) as returned by decode_image, or (None, 1.0)
+               if the request carries no image.
+    """
+    image_bytes = request_image_bytes(request)
+    if image_bytes is None:
+        return None, 1.0
+    return decode_image(image_bytes, max_side)
@@ -11,6 +11,8 @@
 # It is used by authentication and administration routes to:
 # - Load all registered users
 # - Persist new users or updates
+# - Look up the embedding folder of an email (cached index, rebuilt only
+#   when users.json changes)
 # ============================================
 
 import json
@@ -19,6 +21,9 @@ import os
 # Absolute path to the users.json file (one level up from this script)
 USERS_DB = os.path.join(os.path.dirname(__file__), '..', 'users.json')
 
+# Email -> folder index, cached with the modification time of users.json
+_folder_index = {"mtime": None, "folders": {}}
+
 def load_users():
     """
     Loads all user data from the local JSON file (users.json).
@@ -43,3 +48,21 @@ def save_users(users):
     """
     with open(USERS_DB, 'w') as f:
         json.dump(users, f, indent=4)
+
+def get_user_folder(email):
+    """
+    Returns the embedding folder of the user registered with 'email', or None.
+
+    The email -> folder index is built once and only rebuilt when users.json
+    changes (checked with a single stat), so lookups do not parse the file.
+    """
+    try:
+        mtime = os.stat(USERS_DB).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    if _folder_index["mtime"] != mtime:
+        users = load_users()
+        _folder_index["folders"] = {user_email: user.get('folder') for user_email, user in users.items()}
+        _folder_index["mtime"] = mtime
+    return _folder_index["folders"].get(email)